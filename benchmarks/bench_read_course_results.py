@@ -0,0 +1,91 @@
+'''
+Compare the streaming result reader with the old readlines()-based one.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_read_course_results 1000000
+
+Each reader runs in a fresh process, so that peak RSS is comparable.
+'''
+import argparse
+from datetime import date
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from benchmarks.synthetic import write_course_results
+from genomstromning.io import read_course_results
+
+
+def read_course_results_readlines(filenames, cutoff_date=date.today()):
+    '''
+    The reader as it was before it was made streaming, kept for comparison.
+    '''
+    headers = ['Personnummer', None, None, 'Kurskod', 'Kurs', 'Kurspoäng', 'Kurstillfälle', 'Modulkod', 'Modul', 'Modulpoäng', 'Betyg', 'Datum']
+    result = {}
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            lines = f.readlines()
+        for line in lines[8:]:
+            data = line.strip().split(';')
+            if len(data) < 5:
+                continue
+            pnr = data[0].strip('"')
+            if pnr not in result:
+                result[pnr] = dict()
+            line = dict()
+            for key, val in zip(headers[1:], data[1:]):
+                if key:
+                    line[key] = val.strip('"')
+            if 'Datum' in line:
+                res_date = date.fromisoformat(line['Datum'])
+                if res_date > cutoff_date:
+                    continue
+            kurskod = line['Kurskod']
+            if kurskod not in result[pnr]:
+                result[pnr][kurskod] = dict()
+            if len(line['Modulkod']) > 1:
+                grade = line['Betyg']
+                if grade != 'F' and grade != 'FX':
+                    modulkod = line['Modulkod']
+                    poang = line['Modulpoäng'].replace(',', '.')
+                    result[pnr][kurskod][modulkod] = float(poang)
+    return result
+
+
+READERS = {
+    'readlines': read_course_results_readlines,
+    'streaming': read_course_results,
+}
+
+
+def run_reader(name, filename, queue):
+    start = time.perf_counter()
+    READERS[name]([filename])
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rows', type=int, nargs='?', default=200000, help='Number of data rows in the synthetic export.')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'resultat.csv')
+        write_course_results(filename, args.rows)
+        print(f'{"reader":12} {"rows/s":>12} {"peak RSS (MB)":>14}')
+        for name in READERS:
+            queue = ctx.Queue()
+            p = ctx.Process(target=run_reader, args=(name, filename, queue))
+            p.start()
+            elapsed, maxrss = queue.get()
+            p.join()
+            print(f'{name:12} {args.rows / elapsed:12.0f} {maxrss / 1024:14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Compare the single-pass NyA merit reader with the old one, which ran three
+regular expressions per line and built a dict per applicant.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_read_nya_merits 1000000
+
+Each reader runs in a fresh process, so that peak RSS is comparable.
+'''
+import argparse
+import multiprocessing
+import os
+import re
+import resource
+import tempfile
+import time
+
+from benchmarks.synthetic import write_nya_merits
+from genomstromning.io import read_nya_merits
+
+
+bi =  re.compile('BI\\s+\\((\\d+\\.\\d+)\\)')
+bii = re.compile('BII\\s+\\((\\d+\\.\\d+)\\)')
+hp =  re.compile('HP\\s+\\((\\d+\\.\\d+)\\)')
+
+
+def parse_merits_three_regexes(meritstring):
+    data = {}
+    m_bi = bi.search(meritstring)
+    m_bii = bii.search(meritstring)
+    m_hp = hp.search(meritstring)
+    if m_bi:
+        data['BI'] = float(m_bi.group(1))
+    if m_bii:
+        data['BII'] = float(m_bii.group(1))
+    if m_hp:
+        data['HP'] = float(m_hp.group(1))
+    return data
+
+
+def read_nya_merits_three_regexes(filename):
+    '''
+    The reader as it was before it was made single-pass, kept for comparison.
+    '''
+    merits = {}
+    with open(filename) as h:
+        for line in h:
+            pnr, enamn, fnamn, program, prio, _, meritstring, _, _ = line.split(';')
+            merits[pnr] = parse_merits_three_regexes(meritstring)
+    return merits
+
+
+READERS = {
+    'three-regex': read_nya_merits_three_regexes,
+    'single-pass': read_nya_merits,
+}
+
+
+def run_reader(name, filename, queue):
+    start = time.perf_counter()
+    merits = READERS[name](filename)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, {pnr: merits[pnr] for pnr in list(merits)[:1000]}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rows', type=int, nargs='?', default=200000, help='Number of applicants in the synthetic export.')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'meriter.csv')
+        write_nya_merits(filename, args.rows)
+        print(f'{"reader":12} {"lines/s":>12} {"peak RSS (MB)":>14}')
+        samples = []
+        for name in READERS:
+            queue = ctx.Queue()
+            p = ctx.Process(target=run_reader, args=(name, filename, queue))
+            p.start()
+            elapsed, maxrss, sample = queue.get()
+            p.join()
+            samples.append(sample)
+            print(f'{name:12} {args.rows / elapsed:12.0f} {maxrss / 1024:14.1f}')
+        if samples[0] != samples[1]:
+            print('The readers disagree!')
+
+
+if __name__ == '__main__':
+    main()
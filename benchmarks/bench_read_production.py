@@ -0,0 +1,139 @@
+'''
+Compare the HÅP reader with the old single-file reader, which read one report and
+kept courses matching one prefix:
+
+  one report       the whole synthetic report, read with one prefix by both,
+  yearly reports   a decade of reports, one per year, read with the prefixes MM and
+                   DA, by the old reader one file and one prefix at a time.
+
+The yearly reports are cut from the synthetic report, each covering its year and
+the next, so that consecutive periods overlap. The new reader should count every
+round once, and so agree with the report they were cut from.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_read_production 200000
+'''
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import FIRST_INTAKE, LAST_INTAKE, write_production
+from genomstromning.production import read_production, production_matrix
+
+
+def read_production_one_file(filename, explicit, restriction, exclusion):
+    '''
+    The reader as it was before it read several reports, kept for comparison.
+    '''
+    with open(filename) as h:
+        lines = h.readlines()
+
+    metadata = dict()
+    for line_no, line in enumerate(lines):
+        line = line.rstrip()
+        tokens = line.split(';')
+        if len(tokens) > 1:
+            if tokens[0] == 'Kurskod':
+                break
+            metadata[tokens[0].strip('"')] = tokens[1].strip('"')
+
+    start_line = line_no + 1    # This is where the actual data starts
+    result = dict()
+    for line in lines[start_line:]:
+        elems = line.replace('"', '').split(';')
+        course_code = elems[0]
+        if is_a_keeper(course_code, explicit, restriction, exclusion):
+            round_info = (make_float(elems[12]), elems[4], elems[5], elems[9])
+            if course_code not in result:
+                result[course_code] = {'name': elems[1],
+                                       'credits': make_float(elems[2]),
+                                       'rounds': [round_info]}
+            else:
+                result[course_code]['rounds'].append(round_info)
+
+    return result, metadata
+
+
+def make_float(s):
+    return float(s.replace(',', '.'))
+
+
+def is_a_keeper(course, explicit, restriction, exclusion):
+    if explicit:
+        return course in explicit
+    if exclusion:
+        n = len(exclusion)
+        return course[:n] != exclusion
+    if restriction:
+        n = len(restriction)
+        return course[:n] == restriction
+    return True
+
+
+def best_time(f, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def split_by_year(filename, directory):
+    '''
+    Yearly reports, each with the rounds starting in its year or the next.
+    '''
+    with open(filename) as h:
+        lines = h.readlines()
+    header = lines.index(next(line for line in lines if line.startswith('Kurskod')))
+    files = []
+    for year in range(FIRST_INTAKE, LAST_INTAKE):
+        yearly = os.path.join(directory, f'hap{year}.csv')
+        with open(yearly, 'w') as h:
+            for line in lines[:header + 1]:
+                h.write(f'"Period";"{year} - {year + 1}"\n' if line.startswith('"Period"') else line)
+            for line in lines[header + 1:]:
+                if line.split(';')[9].strip('"')[:4] in (str(year), str(year + 1)):
+                    h.write(line)
+        files.append(yearly)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rows', type=int, nargs='?', default=100000, help='Number of course rounds in the synthetic report.')
+    parser.add_argument('--repeats', type=int, default=3, help='Best of this many runs. Default: 3')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'hap.csv')
+        write_production(filename, args.rows, n_courses=200)
+        files = split_by_year(filename, tmpdir)
+
+        def old_yearly():
+            for yearly in files:
+                read_production_one_file(yearly, None, 'MM', None)
+                read_production_one_file(yearly, None, 'DA', None)
+
+        timings = [('one report', best_time(lambda: read_production_one_file(filename, None, 'MM', None), args.repeats),
+                    best_time(lambda: read_production(filename, None, 'MM', None), args.repeats)),
+                   ('yearly reports', best_time(old_yearly, args.repeats),
+                    best_time(lambda: read_production(files, restriction='MM,DA'), args.repeats))]
+        print(f'{len(files)} yearly reports')
+        print(f'{"":16} {"old (s)":>12} {"now (s)":>8}')
+        for name, old, new in timings:
+            print(f'{name:16} {old:12.2f} {new:8.2f}')
+
+        codes, _, matrix = production_matrix(read_production(files, restriction='MM,DA')[0])
+        expected_codes, _, expected = production_matrix(read_production(filename, restriction='MM,DA')[0])
+        order = [codes.index(code) for code in expected_codes if code in codes]
+        if matrix.shape != expected.shape or not np.allclose(matrix[order], expected):
+            print('The yearly reports do not add up to the whole report!')
+
+
+if __name__ == '__main__':
+    main()
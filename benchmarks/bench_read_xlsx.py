@@ -0,0 +1,57 @@
+'''
+Check that reading Excel workbooks is streaming: peak memory when reading a
+result export saved as .xlsx should not grow with the number of rows.
+
+Run from the repository root (needs openpyxl):
+
+    python -m benchmarks.bench_read_xlsx 10000,100000,500000
+
+Each read runs in a fresh process, so that peak RSS is comparable.
+'''
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from benchmarks.synthetic import write_course_results, write_workbook
+from genomstromning.io import iter_course_results
+
+
+RESULT_PREAMBLE = 8
+SHEET_ROWS = 200000
+
+
+def run_reader(filename, queue):
+    start = time.perf_counter()
+    n_rows = sum(1 for _ in iter_course_results([filename]))
+    elapsed = time.perf_counter() - start
+    queue.put((n_rows, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sizes', nargs='?', default='10000,100000', help='Comma-separated numbers of data rows.')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{"format":6} {"rows":>8} {"rows/s":>10} {"peak RSS (MB)":>14}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n_rows in map(int, args.sizes.split(',')):
+            csv_filename = os.path.join(tmpdir, 'resultat.csv')
+            xlsx_filename = os.path.join(tmpdir, 'resultat.xlsx')
+            write_course_results(csv_filename, n_rows)
+            write_workbook(csv_filename, xlsx_filename, RESULT_PREAMBLE, SHEET_ROWS)
+            for filename in [csv_filename, xlsx_filename]:
+                queue = ctx.Queue()
+                p = ctx.Process(target=run_reader, args=(filename, queue))
+                p.start()
+                n_read, elapsed, maxrss = queue.get()
+                p.join()
+                assert n_read == n_rows, f'Read {n_read} rows of {n_rows} from {filename}'
+                print(f'{filename[-4:]:6} {n_rows:8} {n_rows / elapsed:10.0f} {maxrss / 1024:14.1f}')
+
+
+if __name__ == '__main__':
+    main()
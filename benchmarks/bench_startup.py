@@ -0,0 +1,55 @@
+'''
+Start-up time of the command-line tools.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup
+
+Times "--version" for each tool, and checks that importing the tools does not
+load matplotlib. With --max-seconds, exits with an error if any tool is slower,
+so that the check can be run in CI.
+'''
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+TOOLS = ['genomstromning.main', 'genomstromning.merit', 'genomstromning.production', 'genomstromning.produktion']
+
+
+def startup_time(module, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', module, '--version'], check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def loads_matplotlib(module):
+    code = f'import sys, {module}; print("matplotlib" in sys.modules)'
+    out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True)
+    return out.stdout.strip() == 'True'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='Runs per tool. The median is reported.')
+    parser.add_argument('--max-seconds', type=float, help='Fail if a tool needs more than this to start.')
+    args = parser.parse_args()
+
+    failed = False
+    print(f'{"tool":28} {"--version (s)":>14} {"matplotlib":>11}')
+    for module in TOOLS:
+        seconds = startup_time(module, args.repeats)
+        matplotlib = loads_matplotlib(module)
+        print(f'{module:28} {seconds:14.3f} {"loaded" if matplotlib else "-":>11}')
+        if matplotlib or (args.max_seconds and seconds > args.max_seconds):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Time parsing, aggregation and plotting for each tool on synthetic exports.
+
+Run from the repository root:
+
+    python -m benchmarks.harness --rows 1000,100000 --save baseline.json
+    ... change something ...
+    python -m benchmarks.harness --rows 1000,100000 --compare baseline.json
+
+With --compare, stages that got slower than the baseline by more than the
+tolerance are flagged, and the exit status is 1.
+'''
+import argparse
+from datetime import date
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_all
+from genomstromning.io import read_programstudents, read_result_files, read_nya_merits
+from genomstromning.main import compute_aggregates, create_student_bars
+from genomstromning.merit import merit_statistics, plot_merits
+from genomstromning.production import read_production, make_bar_diagrams
+
+
+NOISE_SECONDS = 0.01            # Differences smaller than this are never flagged
+
+
+def timed(timings, name, f, *args):
+    start = time.perf_counter()
+    value = f(*args)
+    timings[name] = time.perf_counter() - start
+    return value
+
+
+def run_stages(files):
+    '''
+    Run each tool's stages on the synthetic files, in the current directory.
+    Return a dict mapping stage names to seconds.
+    '''
+    timings = {}
+    program, students = timed(timings, 'genomstromning.parse_students', read_programstudents, files['studenter'])
+    results = timed(timings, 'genomstromning.parse_results', read_result_files, [files['resultat']])
+    results = timed(timings, 'genomstromning.cutoff', results.until, date.today())
+    aggregates = timed(timings, 'genomstromning.aggregate', compute_aggregates, students, results)
+    timed(timings, 'genomstromning.plot', create_student_bars, aggregates, program)
+
+    merits = timed(timings, 'merits.parse', read_nya_merits, files['meriter'])
+    credits = timed(timings, 'merits.aggregate', compute_aggregates, students, results).student_totals
+    merit_values = timed(timings, 'merits.join', merits.take, students)
+    stats = timed(timings, 'merits.statistics', merit_statistics, credits, merit_values, 1000)
+    timed(timings, 'merits.plot', plot_merits, credits, merit_values, 'bench', stats)
+
+    production, metadata = timed(timings, 'production.parse', read_production, files['hap'], None, None, None)
+    timed(timings, 'production.plot', make_bar_diagrams, production, None, None, 1, True)
+    return timings
+
+
+def benchmark(rows, courses, repeats):
+    '''
+    Best time per stage, over repeats, for an export of the given size.
+    '''
+    best = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = write_all(os.path.join(tmpdir, 'data'), rows, n_courses=courses)
+        cwd = os.getcwd()
+        os.chdir(tmpdir)        # The tools write their plots to the current directory
+        try:
+            for _ in range(repeats):
+                for stage, seconds in run_stages(files).items():
+                    best[stage] = min(seconds, best.get(stage, seconds))
+        finally:
+            os.chdir(cwd)
+    return best
+
+
+def compare(current, baseline, tolerance):
+    '''
+    Print current timings next to the baseline. Return the number of regressions.
+    '''
+    regressions = 0
+    print(f'{"rows":>9} {"stage":34} {"baseline":>9} {"now":>9} {"ratio":>6}')
+    for rows, timings in current.items():
+        for stage, seconds in timings.items():
+            before = baseline.get(rows, {}).get(stage)
+            if before is None:
+                print(f'{rows:>9} {stage:34} {"-":>9} {seconds:9.3f}')
+                continue
+            ratio = seconds / before if before > 0 else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance and seconds - before > NOISE_SECONDS:
+                flag = '  SLOWER'
+                regressions += 1
+            print(f'{rows:>9} {stage:34} {before:9.3f} {seconds:9.3f} {ratio:6.2f}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tools on synthetic Ladok exports.')
+    parser.add_argument('--rows', default='1000,100000', help='Comma-separated sizes of the result export. Default: 1000,100000')
+    parser.add_argument('--courses', type=int, default=15, help='Number of course codes. Default: 15')
+    parser.add_argument('--repeats', type=int, default=1, help='Report the best of this many runs. Default: 1')
+    parser.add_argument('--save', help='Store the timings in this JSON file, to use as a baseline later.')
+    parser.add_argument('--compare', help='JSON file with baseline timings to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown before a stage is flagged. Default: 0.2')
+    args = parser.parse_args()
+
+    current = {}
+    for rows in args.rows.split(','):
+        current[rows] = benchmark(int(rows), args.courses, args.repeats)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as h:
+            baseline = json.load(h)
+    regressions = compare(current, baseline, args.tolerance)
+
+    if args.save:
+        with open(args.save, 'w') as h:
+            json.dump(current, h, indent=2)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
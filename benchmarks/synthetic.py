@@ -0,0 +1,238 @@
+'''
+Synthetic Ladok and NyA exports, so that performance can be studied without real personal data.
+
+Run from the repository root, for example
+
+    python -m benchmarks.synthetic /tmp/synth --rows 1000000
+
+to write a student file, a result export, a NyA merit file and a HÅP report,
+all referring to the same made-up students.
+'''
+import argparse
+from datetime import date, timedelta
+from itertools import islice
+import os
+import random
+
+
+STUDENT_HEADER = '"Personnummer (Student)";"Förnamn (Student)";"Efternamn (Student)";"Kod (Kurspaketering)";"Benämning (Kurspaketering)";"Omf. (Kurspaketering)";"Enhet (Kurspaketering)";"Tillstånd (Sammanfattat tillstånd)";"Kod (Kurspaketeringstillfälle)";"Startdatum (Kurspaketeringstillfälle)";"Slutdatum (Kurspaketeringstillfälle)";"Studietakt (%) (Kurspaketeringstillfälle)";"Undervisningsform (Kurspaketeringstillfälle)";"Ort (Kurspaketeringstillfälle)";"Period i ordning"'
+RESULT_HEADER = '"Personnummer (Student)";"Efternamn (Student)";"Förnamn (Student)";"Kod (Kurs)";"Benämning (Kurs)";"Omfattning (Kurs)";"Kurstillfälle (Kurs)";"Kod (Modul)";"Benämning (Modul)";"Omfattning (Modul)";"Betyg (Resultat)";"Ex. datum (Resultat)"'
+PRODUCTION_HEADER = 'Kurskod;Kurs;Omfattning;Enhet;Kod;Studietakt;Finansieringsform;Undervisningsform;Studieort;Startdatum;Kvinnor;Män;Total'
+
+COURSES = {                     # Modules and their credits
+    'MM2001': {'0001': '7,5', '0002': '7,5', '0003': '15'},
+    'MM5012': {'0001': '4', '0002': '3,5'},
+    'MM5013': {'0001': '4', '0002': '3,5'},
+    'MM5016': {'0001': '6', '0002': '1,5'},
+    'DA2004': {'0001': '3', '0002': '3', '0003': '1,5'},
+    'DA3018': {'0001': '4,5', '0002': '3'},
+    'DA4006': {'0001': '7,5'},
+    'MT3001': {'0001': '5', '0002': '2,5'},
+}
+
+GRADES = ['A', 'B', 'C', 'D', 'E', 'G', 'E', 'C', 'F', 'FX']
+FIRST_INTAKE = 2015
+LAST_INTAKE = 2023
+
+
+def personnummer(i):
+    '''
+    A made-up, but well-formed and unique, personnummer for student number i.
+    '''
+    year = 1990 + i % 10
+    month = 1 + (i // 10) % 12
+    day = 1 + (i // 120) % 28
+    return f'{year}{month:02d}{day:02d}-{(i // 3360) % 10000:04d}'
+
+
+def start_date(i):
+    '''
+    Program start for student number i: late August, in one of the intake years.
+    '''
+    return date(FIRST_INTAKE + i % (LAST_INTAKE - FIRST_INTAKE + 1), 8, 28)
+
+
+def course_catalog(n_courses):
+    '''
+    The courses above, and as many made-up ones as needed to get n_courses.
+    '''
+    catalog = dict(list(COURSES.items())[:n_courses])
+    rng = random.Random(n_courses)
+    for i in range(len(catalog), n_courses):
+        prefix = ['MM', 'MT', 'DA'][i % 3]
+        modules = rng.choice([['7,5'], ['4', '3,5'], ['3', '3', '1,5'], ['7,5', '7,5']])
+        catalog[f'{prefix}{7000 + i}'] = {f'{j + 1:04d}': credits for j, credits in enumerate(modules)}
+    return catalog
+
+
+def course_credits(modules):
+    total = sum(float(credits.replace(',', '.')) for credits in modules.values())
+    return f'{total:g}'.replace('.', ',')
+
+
+def quoted(fields):
+    return ';'.join(f'"{field}"' for field in fields)
+
+
+def write_programstudents(filename, n_students, program='NMDVK'):
+    '''
+    Write a "Deltagande kurspaketering" export with the first n_students students.
+    '''
+    with open(filename, 'w') as h:
+        print('"Utdata";"Deltagande kurspaketering"', file=h)
+        print(f'"Utbildningskod";"{program} Kandidatprogram (syntetiskt)"', file=h)
+        print(f'"Startdatum";"{date(FIRST_INTAKE, 1, 1)} - {date(LAST_INTAKE, 12, 31)}"', file=h)
+        for _ in range(5):
+            print('', file=h)
+        print(STUDENT_HEADER, file=h)
+        for i in range(n_students):
+            start = start_date(i)
+            fields = [personnummer(i), f'Förnamn{i}', f'Efternamn{i}', program, 'Kandidatprogram', '180,0', 'HP',
+                      'Registrerad', f'{program}-{start.year}', start, start + timedelta(days=3 * 365), '100',
+                      'NML', 'Stockholm', '1']
+            print(quoted(fields), file=h)
+
+
+def write_course_results(filename, n_rows, n_students=None, n_courses=len(COURSES), seed=0):
+    '''
+    Write a result export ("Resultat", with modules) with n_rows data rows.
+
+    Half of the rows belong to the first tenth of the students, like the program
+    students among everyone taking the courses. Exam dates fall within three years
+    of the student's start, credits have decimal commas and some grades are F or FX.
+    '''
+    rng = random.Random(seed)
+    n_students = n_students or max(1, n_rows // 10)
+    catalog = course_catalog(n_courses)
+    codes = list(catalog)
+    with open(filename, 'w') as h:
+        print('"Utdata";"Resultat"', file=h)
+        print('"Utbildningskod";"' + ', '.join(codes[:20]) + '"', file=h)
+        print(f'"Resultatperiod";"{date(FIRST_INTAKE, 8, 1)} - {date(LAST_INTAKE + 3, 6, 30)}"', file=h)
+        print('"Visa moduler";"Ja"', file=h)
+        for _ in range(3):
+            print('', file=h)
+        print(RESULT_HEADER, file=h)
+        for _ in range(n_rows):
+            if rng.random() < 0.5:
+                i = rng.randrange(max(1, n_students // 10))
+            else:
+                i = rng.randrange(n_students)
+            code = rng.choice(codes)
+            modules = catalog[code]
+            module = rng.choice(list(modules))
+            exam_date = start_date(i) + timedelta(days=rng.randrange(3 * 365))
+            fields = [personnummer(i), f'Efternamn{i}', f'Förnamn{i}', code, 'Kurs ' + code,
+                      course_credits(modules), f'{exam_date.year}-{code}', module, 'Modul ' + module,
+                      modules[module], rng.choice(GRADES), exam_date.isoformat()]
+            print(quoted(fields), file=h)
+
+
+def write_nya_merits(filename, n_students, seed=0):
+    '''
+    Write a NyA export with merit values (BI, BII and/or HP) for n_students applicants.
+    '''
+    rng = random.Random(seed)
+    with open(filename, 'w') as h:
+        for i in range(n_students):
+            merits = []
+            if rng.random() < 0.8:
+                merits.append(f'BI ({rng.uniform(10, 22.5):.2f})')
+            if rng.random() < 0.5:
+                merits.append(f'BII ({rng.uniform(10, 22.5):.2f})')
+            if rng.random() < 0.4:
+                merits.append(f'HP ({rng.uniform(0.1, 2):.2f})')
+            fields = [personnummer(i), f'Efternamn{i}', f'Förnamn{i}', 'NMDVK', str(1 + i % 3), 'A',
+                      ', '.join(merits), 'Antagen', '']
+            print(';'.join(fields), file=h)
+
+
+def write_production(filename, n_rows, n_courses=len(COURSES), seed=0):
+    '''
+    Write a "Helårsprestationer" report with n_rows course rounds.
+    '''
+    rng = random.Random(seed)
+    catalog = course_catalog(n_courses)
+    codes = list(catalog)
+    with open(filename, 'w') as h:
+        print('"Utdata";"Helårsprestationer"', file=h)
+        print(f'"Period";"{FIRST_INTAKE} - {LAST_INTAKE}"', file=h)
+        print('"Organisation";"Matematiska institutionen"', file=h)
+        print(PRODUCTION_HEADER, file=h)
+        for i in range(n_rows):
+            code = rng.choice(codes)
+            year = rng.randrange(FIRST_INTAKE, LAST_INTAKE + 1)
+            start = date(year, rng.choice([1, 3, 6, 8, 11]), rng.randrange(1, 29))
+            women, men = rng.uniform(0, 10), rng.uniform(0, 15)
+            fields = [code, 'Kurs ' + code, course_credits(catalog[code]), 'HP', f'{i % 90000 + 10000}', '100',
+                      'Anslag', 'NML', 'Stockholm', start]
+            fields += [f'{x:.2f}'.replace('.', ',') for x in (women, men, women + men)]
+            print(quoted(fields), file=h)
+
+
+def cell_value(field):
+    '''
+    The value Ladok would put in a workbook cell for a CSV field: a date, a number or text.
+    '''
+    field = field.strip('"')
+    try:
+        return date.fromisoformat(field)
+    except ValueError:
+        pass
+    if field[:1] == '0' and field.isdigit():   # Codes like 0001 are text
+        return field
+    try:
+        return float(field.replace(',', '.'))
+    except ValueError:
+        return field
+
+
+def write_workbook(csv_filename, filename, n_preamble, sheet_rows=None):
+    '''
+    Save a CSV export, with n_preamble lines before the data, as an Excel workbook.
+    With sheet_rows, the data is split on sheets with that many rows each, every
+    sheet starting with the preamble. Needs openpyxl.
+    '''
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    with open(csv_filename) as h:
+        preamble = [line.rstrip('\n').split(';') for line in islice(h, n_preamble)]
+        sheet = None
+        for i, line in enumerate(h):
+            if sheet is None or (sheet_rows and i % sheet_rows == 0):
+                sheet = workbook.create_sheet()
+                for fields in preamble:
+                    sheet.append([cell_value(field) for field in fields if field])
+            sheet.append([cell_value(field) for field in line.rstrip('\n').split(';')])
+    workbook.save(filename)
+
+
+def write_all(directory, n_rows, n_students=None, n_courses=len(COURSES), seed=0):
+    '''
+    Write all four kinds of export to directory, scaled to n_rows result rows.
+    Returns a dict with the filenames.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    n_students = n_students or max(10, n_rows // 10)
+    files = {name: os.path.join(directory, name + '.csv') for name in ['studenter', 'resultat', 'meriter', 'hap']}
+    write_programstudents(files['studenter'], max(1, n_students // 10))
+    write_course_results(files['resultat'], n_rows, n_students, n_courses, seed)
+    write_nya_merits(files['meriter'], n_students, seed)
+    write_production(files['hap'], max(1, n_rows // 100), n_courses, seed)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic exports for benchmarking.')
+    parser.add_argument('directory', help='Where to put the files.')
+    parser.add_argument('-n', '--rows', type=int, default=100000, help='Rows in the result export. Default: 100000')
+    parser.add_argument('--students', type=int, help='Number of students taking courses. Default: a tenth of the rows.')
+    parser.add_argument('--courses', type=int, default=len(COURSES), help=f'Number of course codes. Default: {len(COURSES)}')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for name, filename in write_all(args.directory, args.rows, args.students, args.courses, args.seed).items():
+        print(f'{name}: {filename}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+On-disk cache of parsed result exports.
+
+Parsing a large Ladok export is slow, but the exports rarely change. The first
+time a file is read, its ResultTable is stored in the cache directory, and later
+reads memory map it instead. Entries are keyed by the file's path, size,
+modification time and content hash. The least recently used entries are
+removed when the cache grows beyond its size limit.
+'''
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from .table import ResultTable
+
+
+DEFAULT_MAX_BYTES = 1024**3
+
+
+def content_hash(filename):
+    '''
+    SHA-256 of the file's content, as a hex string.
+    '''
+    content = hashlib.sha256()
+    with open(filename, 'rb') as h:
+        for block in iter(lambda: h.read(1 << 20), b''):
+            content.update(block)
+    return content.hexdigest()
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'genomstromning')
+
+
+class ParseCache:
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def key(self, filename):
+        '''
+        Identify the file by path, size, modification time and content.
+        '''
+        stat = os.stat(filename)
+        identity = f'{os.path.abspath(filename)}\n{stat.st_size}\n{stat.st_mtime_ns}\n{content_hash(filename)}'
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def get(self, key):
+        '''
+        Return the cached table for key, or None.
+        '''
+        entry = os.path.join(self.directory, key)
+        if not os.path.isdir(entry):
+            return None
+        try:
+            table = ResultTable.load(entry)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring broken cache entry {entry}: {e}')
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        os.utime(entry)         # Mark as recently used
+        return table
+
+    def put(self, key, table):
+        '''
+        Store table under key, then evict old entries if the cache is too large.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        table.save(tmp)
+        try:
+            os.rename(tmp, os.path.join(self.directory, key))
+        except OSError:         # Someone else stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache is within its size limit.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry))
+            entries.append((os.stat(entry).st_mtime, size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the result files, without using the parse cache.')
+    parser.add_argument('--cache-dir', help=f'Directory for the parse cache. Default: {default_cache_dir()}')
+
+
+def cache_from_arguments(args):
+    if args.no_cache:
+        return None
+    return ParseCache(args.cache_dir)
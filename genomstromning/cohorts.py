@@ -0,0 +1,322 @@
+'''
+The cohorts subcommand: progression and retention per cohort.
+
+    genomstromning cohorts STUDENTFILES results...
+
+A cohort is the students of a program who started the same term, according to
+"Startdatum (Kurspaketeringstillfälle)" in the student file. Any number of
+student files can be given at once, like for batch mode of genomstromning, so
+all intakes of all programs are analysed in a single pass over the results.
+
+Terms are counted from each student's start date, six months at a time, so that
+the first term after an autumn start also covers the January exams. A passed
+module counts in the term it was first passed, and results without a date count
+in the first term. Terms after the cutoff date are not observed.
+
+In every observed term, a student is in one of the STATES:
+  aktiv:         at least --stall hp earned in the term,
+  stillastående: less than that, but credits are earned later on,
+  avhopp:        no credits in this or any later observed term,
+  klar:          at least --target hp in total.
+A drop-out in the last observed terms can of course not be told apart from a
+break in studies.
+
+Written tables, in the format given by --format:
+  PREFIX_progression:  per cohort and term, credits and the share of students
+                       reaching 60, 120 and 180 hp,
+  PREFIX_transitions:  per cohort, the number of students going from one state
+                       to another between consecutive terms,
+  PREFIX_bottlenecks:  per cohort and course, how many students have started
+                       but not finished the course.
+'''
+import argparse
+from collections import namedtuple
+from datetime import date
+import logging
+import numpy as np
+import sys
+
+from .cache import add_cache_arguments, cache_from_arguments
+from .export import FORMATS, export_table
+from .io import read_programstudents, read_result_files
+from .main import student_files
+from .produktion import TERMS, semester_index
+from .profiling import profiled, add_profile_arguments, start_from_arguments, finish_from_arguments
+from .table import round_credits
+
+
+TERM_MONTHS = 6
+THRESHOLDS = (60, 120, 180)
+STATES = ['aktiv', 'stillastående', 'avhopp', 'klar']
+ACTIVE, STALLED, DROPPED, DONE = range(len(STATES))
+
+Cohorts = namedtuple('Cohorts', ['labels', 'pnrs', 'cohort', 'start'])
+
+
+def read_cohorts(filenames):
+    '''
+    Group the students of the student files into cohorts by program and start term.
+
+    Returns Cohorts with the cohort labels, like "NMDVK HT15" (sorted by program and
+    start), the personnummer of the students, the cohort index of each student, and
+    the start dates as datetime64[D]. Students without a start date are left out.
+    A student in several files is counted in the last of them.
+    '''
+    students = {}
+    for filename in filenames:
+        _, program_students = read_programstudents(filename)
+        students.update(program_students)
+
+    pnrs = [pnr for pnr, student in students.items() if student['Startdatum']]
+    if len(pnrs) < len(students):
+        logging.warning(f'{len(students) - len(pnrs)} students without start date are left out')
+    start = np.array([students[pnr]['Startdatum'] for pnr in pnrs], dtype='datetime64[D]')
+    years, terms = semester_index(start)
+    keys = [(students[pnr]['Programkod'], year, term)
+            for pnr, year, term in zip(pnrs, years.tolist(), terms.tolist())]
+    ids = {key: i for i, key in enumerate(sorted(set(keys)))}
+    labels = [f'{program} {TERMS[term]}{year % 100:02d}' for program, year, term in ids]
+    cohort = np.array([ids[key] for key in keys], dtype=np.intp)
+    return Cohorts(labels, pnrs, cohort, start)
+
+
+def month_numbers(dates):
+    return dates.astype('datetime64[M]').astype(np.int64)
+
+
+def observed_terms(cohorts, cutoff_date, n_terms):
+    '''
+    The number of terms, at most n_terms, that each student has begun by the cutoff date.
+    '''
+    elapsed = month_numbers(np.datetime64(cutoff_date, 'D')) - month_numbers(cohorts.start)
+    return np.clip(elapsed // TERM_MONTHS + 1, 0, n_terms)
+
+
+@profiled('credits per term')
+def term_credits(cohorts, results, n_terms=None):
+    '''
+    Credits earned per student (rows, as cohorts.pnrs) and term since the student's
+    start (columns). The results are a ResultTable from first_passed. Credits earned
+    before the start, like transferred credits, count in the first term. Without
+    n_terms, there are as many terms as needed for the latest result.
+    '''
+    rows = results.student_rows(cohorts.pnrs)
+    mine = rows >= 0
+    rows = rows[mine]
+    dates = results.dates[mine]
+    terms = (month_numbers(dates) - month_numbers(cohorts.start)[rows]) // TERM_MONTHS
+    terms[np.isnat(dates)] = 0
+    terms = np.maximum(terms, 0)
+    if n_terms is None:
+        n_terms = int(terms.max()) + 1 if len(terms) else 1
+    inside = terms < n_terms
+
+    n_students = len(cohorts.pnrs)
+    earned = np.bincount(rows[inside] * n_terms + terms[inside],
+                         weights=results.credits[mine][inside].astype(np.float64),
+                         minlength=n_students * n_terms)
+    return round_credits(earned.reshape(n_students, n_terms))
+
+
+def student_states(earned, target, stall):
+    '''
+    The state (index into STATES) of each student in each term, given the credits earned
+    per student and term.
+    '''
+    cumulative = round_credits(earned.cumsum(axis=1))
+    remaining = round_credits(earned[:, ::-1].cumsum(axis=1)[:, ::-1])    # Credits in this and later terms
+    states = np.where(earned >= stall, ACTIVE, STALLED)
+    states[remaining == 0] = DROPPED
+    states[cumulative >= target] = DONE
+    return states
+
+
+def group_medians(groups, n_groups, values, seen):
+    '''
+    The median of the seen values of each group, in each column. NaN for no values.
+    '''
+    medians = np.full((n_groups, values.shape[1]), np.nan)
+    for t in range(values.shape[1]):
+        group = groups[seen[:, t]]
+        column = values[seen[:, t], t]
+        order = np.lexsort((column, group))
+        column = column[order]
+        counts = np.bincount(group, minlength=n_groups)
+        starts = np.concatenate([[0], counts.cumsum()[:-1]])
+        present = counts > 0
+        low = starts[present] + (counts[present] - 1) // 2
+        high = starts[present] + counts[present] // 2
+        medians[present, t] = (column[low] + column[high]) / 2
+    return medians
+
+
+@profiled('progression')
+def progression(cohorts, earned, observed, thresholds=THRESHOLDS):
+    '''
+    Per cohort (rows) and term (columns): the number of students observed, the mean
+    credits earned in the term, the mean and median total credits after the term,
+    and for each threshold the share of students that have reached it.
+    '''
+    n_cohorts = len(cohorts.labels)
+    n_terms = earned.shape[1]
+    cumulative = round_credits(earned.cumsum(axis=1))
+    seen = np.arange(n_terms) < observed[:, None]
+    cells = (cohorts.cohort[:, None] * n_terms + np.arange(n_terms))[seen]
+
+    def per_cell(weights=None):
+        return np.bincount(cells, weights=weights, minlength=n_cohorts * n_terms).reshape(n_cohorts, n_terms)
+
+    n = per_cell()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table = {'n': n,
+                 'earned': per_cell(earned[seen]) / n,
+                 'mean': per_cell(cumulative[seen]) / n,
+                 'median': group_medians(cohorts.cohort, n_cohorts, cumulative, seen)}
+        for threshold in thresholds:
+            table[threshold] = per_cell(cumulative[seen] >= threshold) / n
+    return table
+
+
+@profiled('transitions')
+def transitions(cohorts, states, observed):
+    '''
+    The number of students per cohort going from each state (second index) to each
+    state (third index) between consecutive observed terms.
+    '''
+    n_cohorts = len(cohorts.labels)
+    n_states = len(STATES)
+    both_seen = np.arange(1, states.shape[1]) < observed[:, None]
+    cohort = np.broadcast_to(cohorts.cohort[:, None], both_seen.shape)[both_seen]
+    cells = (cohort * n_states + states[:, :-1][both_seen]) * n_states + states[:, 1:][both_seen]
+    counts = np.bincount(cells, minlength=n_cohorts * n_states * n_states)
+    return counts.reshape(n_cohorts, n_states, n_states)
+
+
+@profiled('bottlenecks')
+def bottlenecks(cohorts, results):
+    '''
+    Per cohort (rows) and course (columns, as results.course_codes): the number of students
+    with credits in the course, and the number of those who have fewer credits than the
+    course gives. The credits of a course are taken as the most any student has got in it.
+    '''
+    n_courses = len(results.course_codes)
+    credits = results.credits.astype(np.float64)
+
+    keys, inverse = np.unique(results.student.astype(np.int64) * n_courses + results.course, return_inverse=True)
+    course_credits = np.zeros(n_courses)
+    np.maximum.at(course_credits, keys % n_courses, round_credits(np.bincount(inverse, weights=credits)))
+
+    rows = results.student_rows(cohorts.pnrs)
+    mine = rows >= 0
+    keys, inverse = np.unique(rows[mine].astype(np.int64) * n_courses + results.course[mine], return_inverse=True)
+    student_credits = round_credits(np.bincount(inverse, weights=credits[mine]))
+    course = keys % n_courses
+    unfinished = student_credits < course_credits[course] - 1e-3
+
+    n_cohorts = len(cohorts.labels)
+    cells = cohorts.cohort[keys // n_courses] * n_courses + course
+    started = np.bincount(cells, minlength=n_cohorts * n_courses).reshape(n_cohorts, n_courses)
+    stuck = np.bincount(cells, weights=unfinished, minlength=n_cohorts * n_courses).reshape(n_cohorts, n_courses)
+    return started, stuck
+
+
+def last_complete_terms(cohorts, observed):
+    '''
+    For each cohort, the last term observed for all of its students, or -1.
+    '''
+    last = np.full(len(cohorts.labels), observed.max(initial=0))
+    np.minimum.at(last, cohorts.cohort, observed)
+    return last - 1
+
+
+def write_summary(cohorts, table, states, observed, thresholds=THRESHOLDS, file=sys.stdout):
+    '''
+    A line per cohort with the share of students that have reached each threshold,
+    and the share that have dropped out, at the last term observed for all of them.
+    '''
+    last = last_complete_terms(cohorts, observed)
+    n_students = np.bincount(cohorts.cohort, minlength=len(cohorts.labels))
+    dropped = np.zeros(len(cohorts.labels))
+    at_last = last[cohorts.cohort]
+    known = at_last >= 0
+    np.add.at(dropped, cohorts.cohort[known], states[known, at_last[known]] == DROPPED)
+
+    print(';'.join(['"Kohort"', '"Studenter"', '"Terminer"'] + [f'"andel {t} hp"' for t in thresholds] + ['"andel avhopp"']), file=file)
+    for g, label in enumerate(cohorts.labels):
+        t = last[g]
+        shares = [f'{table[threshold][g, t]:.2f}' if t >= 0 else '' for threshold in thresholds]
+        drop_share = f'{dropped[g] / n_students[g]:.2f}' if t >= 0 else ''
+        print(';'.join([f'"{label}"', str(n_students[g]), str(t + 1)] + shares + [drop_share]), file=file)
+
+
+def write_tables(prefix, cohorts, table, counts, started, stuck, course_codes, min_students, thresholds, fmt):
+    n_cohorts, n_terms = table['n'].shape
+    seen = table['n'] > 0
+    g, t = np.nonzero(seen)
+    columns = {'Kohort': [cohorts.labels[i] for i in g.tolist()],
+               'Termin': t + 1,
+               'Studenter': table['n'][seen],
+               'hp i terminen': table['earned'][seen],
+               'hp medel': table['mean'][seen],
+               'hp median': table['median'][seen]}
+    columns.update({f'andel {threshold} hp': table[threshold][seen] for threshold in thresholds})
+    export_table(prefix + '_progression', columns, fmt)
+
+    totals = counts.sum(axis=2, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shares = counts / totals
+    g, i, j = np.nonzero(np.broadcast_to(totals > 0, counts.shape))
+    export_table(prefix + '_transitions', {'Kohort': [cohorts.labels[k] for k in g.tolist()],
+                                           'Från': [STATES[k] for k in i.tolist()],
+                                           'Till': [STATES[k] for k in j.tolist()],
+                                           'Antal': counts[g, i, j],
+                                           'Andel': shares[g, i, j]}, fmt)
+
+    g, c = np.nonzero(started >= max(min_students, 1))
+    order = np.lexsort((-stuck[g, c] / started[g, c], g))
+    g, c = g[order], c[order]
+    export_table(prefix + '_bottlenecks', {'Kohort': [cohorts.labels[k] for k in g.tolist()],
+                                           'Kurskod': [course_codes[k] for k in c.tolist()],
+                                           'Påbörjat': started[g, c],
+                                           'Ej klar': stuck[g, c],
+                                           'Andel ej klar': stuck[g, c] / started[g, c]}, fmt)
+
+
+def setup_arguments_parser(argv):
+    parser = argparse.ArgumentParser(prog='genomstromning cohorts',
+                                     description='Progression and retention per cohort: the students of a program who started the same term.')
+    parser.add_argument('studentfile', help='Student file, a directory of student files, or several student files separated by commas.')
+    parser.add_argument('results', nargs='+', help='Results file(s), result stores made with "genomstromning ingest" or result databases')
+    parser.add_argument('-d', '--date', help='Give a date in ISO format (YYYY-MM-DD) so results after this date are ignored.')
+    parser.add_argument('--terms', type=int, help='Number of terms to follow each cohort. Default: as many as there are results for.')
+    parser.add_argument('--target', type=float, default=180, help='Credits needed to be done with the program. Default: 180')
+    parser.add_argument('--stall', type=float, default=15, help='A student earning less than this in a term is stalled. Default: 15')
+    parser.add_argument('--min-students', type=int, default=5, help='Only list bottlenecks in courses started by at least this many students of the cohort. Default: 5')
+    parser.add_argument('-p', '--prefix', default='kohorter', help='Prefix of the written tables. Default: kohorter')
+    parser.add_argument('--format', choices=FORMATS, default='csv', help='Format of the written tables. Default: csv')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of result files to parse in parallel. Default: 1')
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = setup_arguments_parser(argv)
+    start_from_arguments(args)
+    cutoff_date = date.fromisoformat(args.date) if args.date else date.today()
+
+    cohorts = read_cohorts(student_files(args.studentfile))
+    results = read_result_files(args.results, cache_from_arguments(args), args.jobs)
+    results = results.take(~(results.dates > np.datetime64(cutoff_date, 'D'))).first_passed()
+
+    earned = term_credits(cohorts, results, args.terms)
+    observed = observed_terms(cohorts, cutoff_date, earned.shape[1])
+    states = student_states(earned, args.target, args.stall)
+    table = progression(cohorts, earned, observed)
+    counts = transitions(cohorts, states, observed)
+    started, stuck = bottlenecks(cohorts, results)
+
+    write_summary(cohorts, table, states, observed)
+    write_tables(args.prefix, cohorts, table, counts, started, stuck, results.course_codes,
+                 args.min_students, THRESHOLDS, args.format)
+    finish_from_arguments(args)
@@ -0,0 +1,194 @@
+'''
+An optional SQLite database of the exports, with indexes for lookups.
+
+Students, results, NyA merits and HÅP production are loaded into tables keyed
+and indexed on personnummer, course code, module code and exam date. The
+functions below answer common questions with indexed queries, and
+read_result_table can read results from a database file as well as from exports.
+Only the standard library's sqlite3 is needed.
+'''
+from datetime import date
+import numpy as np
+import sqlite3
+
+from .io import iter_course_results, read_nya_merits, read_programstudents, FAILING_GRADES, MeritTable
+from .table import CREDIT_DECIMALS, ResultTable
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS students (
+    pnr TEXT NOT NULL,
+    program TEXT NOT NULL,
+    first_name TEXT,
+    last_name TEXT,
+    PRIMARY KEY (pnr, program)
+);
+CREATE INDEX IF NOT EXISTS students_program ON students (program);
+
+CREATE TABLE IF NOT EXISTS results (
+    pnr TEXT NOT NULL,
+    course TEXT NOT NULL,
+    module TEXT NOT NULL,
+    credits REAL,
+    grade TEXT,
+    exam_date TEXT
+);
+-- NULLs are distinct in a UNIQUE constraint, so results without a date are keyed on an empty date
+CREATE UNIQUE INDEX IF NOT EXISTS results_key ON results (pnr, course, module, COALESCE(exam_date, ''));
+CREATE INDEX IF NOT EXISTS results_course_date ON results (course, exam_date);
+CREATE INDEX IF NOT EXISTS results_module ON results (module);
+CREATE INDEX IF NOT EXISTS results_date ON results (exam_date);
+
+CREATE TABLE IF NOT EXISTS merits (
+    pnr TEXT PRIMARY KEY,
+    bi REAL,
+    bii REAL,
+    hp REAL
+);
+
+CREATE TABLE IF NOT EXISTS production (
+    course TEXT NOT NULL,
+    name TEXT,
+    credits REAL,
+    event_code TEXT,
+    studietakt TEXT,
+    start_date TEXT,
+    hap REAL,
+    UNIQUE (course, event_code, start_date)
+);
+CREATE INDEX IF NOT EXISTS production_course_date ON production (course, start_date);
+'''
+
+PASSED = f"length(module) > 1 AND grade NOT IN ({', '.join(repr(g) for g in FAILING_GRADES)})"
+
+
+def is_database(filename):
+    '''
+    Predicate: is this an SQLite database file?
+    '''
+    try:
+        with open(filename, 'rb') as h:
+            return h.read(16) == b'SQLite format 3\x00'
+    except (IsADirectoryError, FileNotFoundError):
+        return False
+
+
+def connect(filename):
+    '''
+    Open (or create) the database and make sure the tables exist.
+    '''
+    connection = sqlite3.connect(filename)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def load_students(connection, filename):
+    program, students = read_programstudents(filename)
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO students VALUES (?, ?, ?, ?)',
+                               ((pnr, program, info.get('Förnamn'), info.get('Efternamn'))
+                                for pnr, info in students.items()))
+    return program
+
+
+def load_results(connection, filenames):
+    rows = ((pnr, kurskod, modulkod, poang, grade, res_date.isoformat() if res_date else None)
+            for pnr, kurskod, modulkod, poang, grade, res_date in iter_course_results(filenames))
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+def load_merits(connection, filename):
+    merits = read_nya_merits(filename)
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO merits VALUES (?, ?, ?, ?)',
+                               ((pnr, *[None if v != v else v for v in values])
+                                for pnr, values in zip(merits.pnrs, merits.values.tolist())))
+
+
+def load_production(connection, filename):
+    from .production import read_production
+    production, _ = read_production(filename, None, None, None)
+    rows = ((code, data['name'], data['credits'], event_code, studietakt, start_date, hap)
+            for code, data in production.items()
+            for hap, event_code, studietakt, start_date in data['rounds'])
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO production VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def module_results(connection, course, after=None, before=None):
+    '''
+    All module results (pnr, module, credits, grade, exam_date) in the course,
+    optionally only those after and/or before the given dates.
+    '''
+    query = 'SELECT pnr, module, credits, grade, exam_date FROM results WHERE course = ?'
+    params = [course]
+    if after:
+        query += ' AND exam_date > ?'
+        params.append(str(after))
+    if before:
+        query += ' AND exam_date <= ?'
+        params.append(str(before))
+    return connection.execute(query + ' ORDER BY exam_date, pnr', params).fetchall()
+
+
+def student_totals(connection, program, cutoff_date=None):
+    '''
+    Credits (pnr, first name, last name, hp) for every student in the program,
+    counting each passed module once, up to cutoff_date. As in ResultTable.until,
+    a module passed more than once counts with its last loaded result.
+    '''
+    cutoff_date = str(cutoff_date or date.today())
+    query = f'''
+        WITH passed AS (
+            SELECT pnr, course, module, credits, MAX(rowid) FROM results
+            WHERE {PASSED} AND (exam_date IS NULL OR exam_date <= ?)
+              AND pnr IN (SELECT pnr FROM students WHERE program = ?)
+            GROUP BY pnr, course, module)
+        SELECT s.pnr, s.first_name, s.last_name, ROUND(COALESCE(SUM(p.credits), 0), {CREDIT_DECIMALS}) AS total
+        FROM students s LEFT JOIN passed p ON p.pnr = s.pnr
+        WHERE s.program = ?
+        GROUP BY s.pnr ORDER BY total'''
+    return connection.execute(query, (cutoff_date, program, program)).fetchall()
+
+
+def students_below(connection, program, credits, cutoff_date=None):
+    '''
+    The students in the program with fewer than the given credits.
+    '''
+    return [row for row in student_totals(connection, program, cutoff_date) if row[3] < credits]
+
+
+def read_results(filename, students=None):
+    '''
+    The passed module results in the database as a ResultTable, like io.read_result_file
+    makes from an export, with every student with results in its code table. If
+    students are given, only their results are read, by lookups in the index on
+    personnummer rather than by a scan of all results.
+    '''
+    connection = sqlite3.connect(filename)
+    try:
+        source = 'results'
+        if students is not None:
+            connection.execute('CREATE TEMP TABLE wanted (pnr TEXT PRIMARY KEY)')
+            connection.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', ((pnr,) for pnr in students))
+            source = 'wanted CROSS JOIN results USING (pnr)'     # CROSS JOIN: loop over the wanted students
+        query = f'SELECT pnr, course, module, credits, exam_date FROM {source} WHERE {PASSED} ORDER BY results.rowid'
+        table = ResultTable.from_rows((pnr, course, module, credits, date.fromisoformat(exam_date) if exam_date else None)
+                                      for pnr, course, module, credits, exam_date in connection.execute(query))
+        return table.with_students(pnr for pnr, in connection.execute(f'SELECT DISTINCT pnr FROM {source}'))
+    finally:
+        connection.close()
+
+
+def read_merits(filename):
+    '''
+    The merits in the database, as a MeritTable like io.read_nya_merits returns.
+    '''
+    connection = sqlite3.connect(filename)
+    try:
+        rows = connection.execute('SELECT pnr, bi, bii, hp FROM merits').fetchall()
+        values = [[np.nan if v is None else v for v in values] for _, *values in rows]
+        return MeritTable([row[0] for row in rows], values)
+    finally:
+        connection.close()
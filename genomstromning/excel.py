@@ -0,0 +1,59 @@
+'''
+Ladok exports saved as Excel workbooks (.xlsx).
+
+The workbook is read with openpyxl in read-only mode, which streams the rows of
+one sheet at a time from the file instead of loading the whole workbook, so memory
+use does not depend on the size of the export. Each sheet is laid out like the
+corresponding CSV export, preamble and all.
+
+openpyxl is only needed for reading workbooks: pip install openpyxl
+'''
+from datetime import date, datetime
+
+
+def is_workbook(filename):
+    return str(filename).lower().endswith('.xlsx')
+
+
+def cell_text(value):
+    '''
+    The cell value as it would have been written in a CSV export.
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def row_fields(values):
+    '''
+    The cell values of a row as strings, without the empty cells at the end,
+    so that rows have as many fields as the lines of a CSV export.
+    '''
+    fields = [cell_text(value) for value in values]
+    while fields and not fields[-1]:
+        fields.pop()
+    return fields
+
+
+def iter_sheets(filename):
+    '''
+    For each sheet in the workbook, an iterator over its rows as lists of strings.
+    Each sheet's rows must be consumed before moving on to the next sheet.
+    '''
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportError(f'Reading {filename} requires openpyxl. Install it with "pip install openpyxl", '
+                          'or export to CSV from Ladok instead.') from None
+    workbook = load_workbook(filename, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield (row_fields(values) for values in sheet.iter_rows(values_only=True))
+    finally:
+        workbook.close()
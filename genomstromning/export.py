@@ -0,0 +1,123 @@
+'''
+Export of the aggregated tables (credit matrices, totals, merit joins and HÅP per
+semester) for dashboards and other tools.
+
+A table is given as columns: numpy arrays, or lists of strings such as
+personnummer and course codes. It is written a chunk of rows at a time, as
+Parquet if pyarrow is installed and otherwise as semicolon-separated CSV (like
+our other output) or JSON Lines. Only one chunk at a time is turned into text
+or Arrow arrays.
+'''
+import importlib.util
+import logging
+import numpy as np
+
+
+FORMATS = ['parquet', 'csv', 'json']
+SUFFIXES = {'parquet': '.parquet', 'csv': '.csv', 'json': '.jsonl'}
+CHUNK_ROWS = 1 << 16
+
+
+def has_parquet():
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def export_format(requested='auto'):
+    '''
+    The format to export in: Parquet when available, unless another one is requested.
+    '''
+    if requested == 'auto':
+        return 'parquet' if has_parquet() else 'csv'
+    if requested == 'parquet' and not has_parquet():
+        logging.warning('Parquet export requires pyarrow, writing CSV instead')
+        return 'csv'
+    return requested
+
+
+def chunks(columns, chunk_rows):
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+    for start in range(0, n_rows, chunk_rows):
+        yield {name: column[start:start + chunk_rows] for name, column in columns.items()}
+
+
+def is_text(column):
+    return not isinstance(column, np.ndarray) or column.dtype.kind in 'OSU'
+
+
+def text_values(column, json=False):
+    '''
+    A chunk of a column as a numpy array of strings. Text is quoted, and escaped
+    for JSON. Missing numbers, NaN, are empty, or null in JSON.
+    '''
+    if is_text(column):
+        values = np.asarray(column, dtype=str)
+        if json:
+            values = np.char.replace(np.char.replace(values, '\\', '\\\\'), '"', '\\"')
+        return np.char.add(np.char.add('"', values), '"')
+    column = np.asarray(column, dtype=float)
+    return np.where(np.isnan(column), 'null' if json else '', np.char.mod('%.10g', column))
+
+
+def write_csv(filename, columns, chunk_rows):
+    with open(filename, 'w') as h:
+        print(';'.join(f'"{name}"' for name in columns), file=h)
+        for chunk in chunks(columns, chunk_rows):
+            lines = None
+            for column in chunk.values():
+                values = text_values(column)
+                lines = values if lines is None else np.char.add(np.char.add(lines, ';'), values)
+            h.write('\n'.join(lines.tolist()) + '\n')
+
+
+def write_json(filename, columns, chunk_rows):
+    '''
+    JSON Lines: one object per row.
+    '''
+    keys = [text_values([name], json=True)[0] + ': ' for name in columns]
+    with open(filename, 'w') as h:
+        for chunk in chunks(columns, chunk_rows):
+            lines = None
+            for key, column in zip(keys, chunk.values()):
+                values = np.char.add(key, text_values(column, json=True))
+                lines = np.char.add('{', values) if lines is None else np.char.add(np.char.add(lines, ', '), values)
+            h.write('}\n'.join(lines.tolist()) + '}\n')
+
+
+def write_parquet(filename, columns, chunk_rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(name, pa.string() if is_text(column) else pa.float64()) for name, column in columns.items()])
+    with pq.ParquetWriter(filename, schema) as writer:
+        for chunk in chunks(columns, chunk_rows):
+            arrays = [pa.array(list(column) if is_text(column) else np.asarray(column, dtype=float),
+                               type=field.type, from_pandas=True)
+                      for field, column in zip(schema, chunk.values())]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+
+
+WRITERS = {'parquet': write_parquet, 'csv': write_csv, 'json': write_json}
+
+
+def export_table(prefix, columns, requested='auto', chunk_rows=CHUNK_ROWS):
+    '''
+    Write the table, a dict mapping column names to columns of equal length, to
+    prefix with the suffix of the format. Returns the filename.
+    '''
+    fmt = export_format(requested)
+    filename = prefix + SUFFIXES[fmt]
+    WRITERS[fmt](filename, columns, chunk_rows)
+    logging.info(f'Exported {filename}')
+    return filename
+
+
+def add_export_arguments(parser):
+    parser.add_argument('--export', action='store_true', help='Also write the aggregated tables, for other tools.')
+    parser.add_argument('--export-format', choices=['auto'] + FORMATS, default='auto',
+                        help='Format of the exported tables. Default: Parquet if pyarrow is installed, otherwise CSV.')
+
+
+def export_from_arguments(args):
+    '''
+    The export format to use, or None if nothing should be exported.
+    '''
+    return export_format(args.export_format) if args.export else None
@@ -0,0 +1,30 @@
+'''
+The ingest subcommand: add new result exports to a persistent result store.
+
+    genomstromning ingest STORE results...
+
+The store can then be given instead of (or together with) result files to
+genomstromning and merits.
+'''
+import argparse
+import sys
+
+from .cache import content_hash
+from .io import read_result_file
+from .store import add_to_store
+
+
+def setup_arguments_parser(argv):
+    parser = argparse.ArgumentParser(prog='genomstromning ingest',
+                                     description='Add result exports to a result store, skipping rows already there.')
+    parser.add_argument('store', help='Directory of the result store. Created if missing.')
+    parser.add_argument('results', nargs='+', help='Results file(s) to add')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = setup_arguments_parser(argv)
+    for filename in args.results:
+        table = read_result_file(filename)
+        added, updated, skipped = add_to_store(args.store, table, filename, content_hash(filename))
+        print(f'{filename}: {added} added, {updated} updated, {skipped} skipped', file=sys.stderr)
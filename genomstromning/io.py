@@ -1,6 +1,90 @@
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
-import re
+from itertools import chain, islice, repeat
+import logging
+import numpy as np
+from sys import intern
 
+from .excel import is_workbook, iter_sheets
+from .store import is_store, load_store
+from .table import ResultTable, ResultView
+from .profiling import profiled
+
+
+# Column indices in a result export: personnummer, kurskod, modulkod, modulpoäng, betyg, datum
+RESULT_COLUMNS = (0, 3, 7, 9, 10, 11)
+FAILING_GRADES = ('F', 'FX')
+STUDENT_FIELDS = ('Förnamn', 'Efternamn', 'Programkod', 'Program', 'Startdatum')
+STUDENT_COLUMNS = (1, 2, 3, 4, 9)   # Column index of each field in a student file
+
+
+class Student(Mapping):
+    '''
+    A program student. The fields are read as from a dict, like student['Förnamn'].
+    '''
+    __slots__ = STUDENT_FIELDS
+
+    def __init__(self, values):
+        for key, val in zip(STUDENT_FIELDS, values):
+            setattr(self, key, val)
+
+    def __getitem__(self, key):
+        if key not in STUDENT_FIELDS or not hasattr(self, key):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return (key for key in STUDENT_FIELDS if hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'Student({dict(self)})'
+
+
+def iter_tables(filename, unquote=False):
+    '''
+    The rows of an export, split into fields, for each table in it. A CSV file is one
+    table, with any quotes left on the fields unless unquote is set, and each sheet
+    of an Excel workbook (.xlsx) is one table. Rows are read one at a time, from
+    either kind of file.
+    '''
+    if is_workbook(filename):
+        yield from iter_sheets(filename)
+    else:
+        with open(filename, 'r') as f:
+            if unquote:
+                yield (line.replace('"', '').strip().split(';') for line in f)
+            else:
+                yield (line.strip().split(';') for line in f)
+
+
+def split_preamble(rows, header, is_data):
+    '''
+    Separate the preamble of a table from its data rows. The preamble ends with the
+    header row, whose first field starts with header, or, in a table without one,
+    like a later sheet of a workbook, before the first row for which is_data holds.
+    Returns the rows of the preamble, without the header row, and an iterator over
+    the data rows.
+    '''
+    preamble = []
+    for fields in rows:
+        first = fields[0].strip('"') if fields else ''
+        if first.startswith(header):
+            return preamble, rows
+        if is_data(fields):
+            return preamble, chain([fields], rows)
+        preamble.append(fields)
+    return preamble, rows
+
+
+def starts_with_personnummer(fields):
+    return len(fields) >= 5 and fields[0].strip('"')[:6].isdigit()
+
+
+@profiled('read students')
 def read_programstudents(filename):
     '''
     Read student data.
@@ -8,36 +92,62 @@ def read_programstudents(filename):
     Headers:
     "Personnummer (Student)";"Förnamn (Student)";"Efternamn (Student)";"Kod (Kurspaketering)";"Benämning (Kurspaketering)";"Omf. (Kurspaketering)";"Enhet (Kurspaketering)";"Tillstånd (Sammanfattat tillstånd)";"Kod (Kurspaketeringstillfälle)";"Startdatum (Kurspaketeringstillfälle)";"Slutdatum (Kurspaketeringstillfälle)";"Studietakt (%) (Kurspaketeringstillfälle)";"Undervisningsform (Kurspaketeringstillfälle)";"Ort (Kurspaketeringstillfälle)";"Period i ordning"
 
+    Returns the program code and a dict mapping personnummer to Student records.
+    The file can also be an Excel workbook, see iter_tables. Later sheets of a
+    workbook may repeat the preamble and header row, or start with the students.
     '''
-    headers = ["Personnummer (Student)", "Förnamn", "Efternamn", "Programkod", "Program"]
-    with open(filename, 'r') as f:
-        lines = f.readlines()
     student_info = {}
-
     program = None
-    for line in lines[:9]:
-        elems = line.split(';')
-        if len(elems) != 2:
-            continue
-        elif elems[0] == '"Utbildningskod"' or elems[0] == '"Utbildning"':
-            program = elems[1].strip('"').split()[0]
-    else:
+    for rows in iter_tables(filename):
+        preamble, rows = split_preamble(rows, 'Personnummer', starts_with_personnummer)
+        for elems in preamble:
+            if len(elems) == 2 and elems[0].strip('"') in ('Utbildningskod', 'Utbildning'):
+                program = program or elems[1].strip('"').split()[0]
         if not program:
             raise Exception('The student file is not generated the correct way. Expected a line like "Utbildningskod";"NMATK Kandidatprogram i matematik" eller liknande bland de första raderna.')
 
-    for line in lines[9:]:
-        data = line.strip().split(';')
-        if len(data) < 5:
-            continue
-            
-        pnr = data[0].strip('"')
-        student_info[pnr] = dict()
-        for key, val in zip(headers[1:], data[1:]):
-            student_info[pnr][key] = val.strip('"')
+        for data in rows:
+            if len(data) < 5:
+                continue
+            pnr = data[0].strip('"')
+            values = [data[i].strip('"') if i < len(data) else '' for i in STUDENT_COLUMNS]
+            values[2:5] = [intern(val) for val in values[2:5]]  # Program code, name and start are shared
+            student_info[pnr] = Student(values)
 
     return program, student_info
 
 
+def iter_course_results(filenames):
+    '''
+    Stream students' course results from the Ladok export(s), one row at a time.
+
+    Only the columns we actually use are kept. Each row is yielded as a tuple
+    (pnr, kurskod, modulkod, modulpoäng, betyg, datum), where modulpoäng is a
+    float (0.0 if missing) and datum is a date, or None if the row has no exam date.
+    Memory use does not depend on the size of the files, which can also be Excel
+    workbooks, with or without the preamble on each sheet.
+    '''
+    for filename in filenames:
+        for rows in iter_tables(filename):
+            _, rows = split_preamble(rows, 'Personnummer', starts_with_personnummer)
+            for data in rows:
+                if len(data) < 5:
+                    continue
+                yield parse_result_row(data)
+
+
+def parse_result_row(data):
+    '''
+    Pick out the interesting fields of a split line from a result export.
+    Short rows give empty strings for the missing fields.
+    '''
+    fields = [data[i].strip('"') if i < len(data) else '' for i in RESULT_COLUMNS]
+    pnr, kurskod, modulkod, poang, grade, res_date = fields
+    poang = float(poang.replace(',', '.')) if poang else 0.0
+    res_date = date.fromisoformat(res_date) if res_date else None
+    return pnr, kurskod, modulkod, poang, grade, res_date
+
+
 def read_course_results(filenames, cutoff_date=date.today()):
     '''
     Read students' course results.
@@ -45,72 +155,277 @@ def read_course_results(filenames, cutoff_date=date.today()):
     Headers:
     "Personnummer (Student)";"Efternamn (Student)";"Förnamn (Student)";"Kod (Kurs)";"Benämning (Kurs)";"Omfattning (Kurs)";"Kurstillfälle (Kurs)";"Kod (Modul)";"Benämning (Modul)";"Omfattning (Modul)";"Betyg (Resultat)";"Ex. datum (Resultat)"
 
+    Returns a mapping from personnummer to course codes to module codes to credits,
+    backed by a ResultTable. Every student in the exports is a key, and one with only
+    failed results, or only results after the cutoff date, maps to an empty dict.
+    Only courses with passed modules up to the cutoff date appear. The mapping can be given directly to compute_aggregates and the compute_*
+    functions in genomstromning.main.
+    A filename can also be a result store, see the ingest subcommand.
     '''
-    headers = ['Personnummer', None, None, 'Kurskod', 'Kurs', 'Kurspoäng', 'Kurstillfälle', 'Modulkod', 'Modul', 'Modulpoäng', 'Betyg', 'Datum']
-    result = {}
+    return ResultView(read_result_table(filenames, cutoff_date))
 
-    for filename in filenames:
-        with open(filename, 'r') as f:
-            lines = f.readlines()
-        for line in lines[8:]:
-            data = line.strip().split(';')
-            if len(data) < 5:
-                continue
-            
-            pnr = data[0].strip('"')
-            if pnr not in result:
-                result[pnr] = dict()
 
-            line = dict()
-            for key, val in zip(headers[1:], data[1:]):
-                if key:
-                    line[key] = val.strip('"')
+def read_result_table(filenames, cutoff_date=None, cache=None, jobs=1, students=None):
+    '''
+    Read students' passed module results into a ResultTable.
+    Results after cutoff_date are ignored, unless cutoff_date is None.
+    If a ParseCache is given, files already parsed are loaded from it.
+    With jobs > 1, that many files are parsed in parallel.
+    If students are given, result databases are only read for them.
+    '''
+    return read_result_files(filenames, cache, jobs, students).until(cutoff_date)
+
+
+@profiled('read results')
+def read_result_files(filenames, cache=None, jobs=1, students=None):
+    '''
+    Read all passed module results into one ResultTable, in file order.
+    Unlike read_result_table, no cutoff is applied and repeated results are kept.
+    '''
+    if jobs > 1 and len(filenames) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(filenames))) as pool:
+            tables = list(pool.map(read_result_file, filenames, repeat(cache), repeat(students)))
+    else:
+        tables = [read_result_file(filename, cache, students) for filename in filenames]
+    return ResultTable.concatenate(tables)
+
+
+def read_result_file(filename, cache=None, students=None):
+    '''
+    Read one result export into a ResultTable, going through the cache if there is one.
+    The file can also be a result store or a result database, which is only read
+    for the given students, if any, using its index.
+    '''
+    from .database import is_database, read_results  # Not at the top, since database uses this module
+    if is_store(filename):
+        return load_store(filename)
+    if is_database(filename):
+        return read_results(filename, students)
+    if cache:
+        key = cache.key(filename)
+        table = cache.get(key)
+        if table is not None:
+            return table
+    seen = {}  # Every personnummer in the file, with passed results or not
+    rows = ((pnr, kurskod, modulkod, poang, res_date)
+            for pnr, kurskod, modulkod, poang, grade, res_date in iter_course_results([filename])
+            if seen.setdefault(pnr, True) and len(modulkod) > 1 and grade not in FAILING_GRADES)
+    table = ResultTable.from_rows(rows).with_students(seen)
+    if cache:
+        cache.put(key, table)
+    return table
+
+
+MERIT_TYPES = ('BI', 'BII', 'HP')
+MERIT_FIELD = 6     # The field of a NyA line with the merits, counting from 0
+MAX_PNR = 32        # Longer first fields are not personnummer
+MAX_VALUE = 16      # Most characters between the parentheses of a merit
+
+CHUNK_SIZE = 1 << 22
+
+
+class MeritTable(Mapping):
+    '''
+    Merits of applicants, kept in columns: values has one row per applicant, in the
+    order of pnrs, and one column per merit type in MERIT_TYPES, NaN where the
+    applicant has no such merit.
+
+    It is also a mapping from personnummer to a dict of the merits the applicant
+    has, like {'BI': 17.25, 'HP': 1.1}, as the merits were read before.
+    '''
+    def __init__(self, pnrs, values):
+        self.pnrs = pnrs
+        self.values = np.asarray(values, dtype=float).reshape(len(pnrs), len(MERIT_TYPES))
+        self._index = None
+
+    @property
+    def index(self):
+        '''
+        Map personnummer to row, made when first needed.
+        '''
+        if self._index is None:
+            self._index = {pnr: i for i, pnr in enumerate(self.pnrs)}
+        return self._index
+
+    def take(self, pnrs):
+        '''
+        The merit values of the given applicants, one row each, all NaN for those
+        that are not in the table.
+        '''
+        rows = np.fromiter((self.index.get(pnr, -1) for pnr in pnrs), dtype=np.int64)
+        values = np.full((len(rows), len(MERIT_TYPES)), np.nan)
+        known = rows >= 0
+        values[known] = self.values[rows[known]]
+        return values
+
+    def __getitem__(self, pnr):
+        row = self.values[self.index[pnr]].tolist()
+        return {t: v for t, v in zip(MERIT_TYPES, row) if v == v}
+
+    def __iter__(self):
+        return iter(self.pnrs)
+
+    def __len__(self):
+        return len(self.pnrs)
+
+
+def iter_chunks(filename, size=CHUNK_SIZE):
+    '''
+    Read the file in chunks of about size bytes, ending at line breaks. Rows of an
+    Excel workbook are written out as semicolon-separated lines, so that chunks
+    always look like a CSV file.
+    '''
+    if is_workbook(filename):
+        for rows in iter_sheets(filename):
+            while lines := [';'.join(fields) + '\n' for fields in islice(rows, size // 64)]:
+                yield ''.join(lines).encode()
+        return
+    rest = b''
+    with open(filename, 'rb') as h:
+        while block := h.read(size):
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            if end:
+                yield block[:end]
+    if rest:
+        yield rest
 
-            if 'Datum' in line:
-                res_date = date.fromisoformat(line['Datum'])
-                if res_date > cutoff_date: # We ignore later results
-                    continue
 
-            kurskod = line['Kurskod']
-            if kurskod not in result[pnr]:
-                result[pnr][kurskod] = dict()
-            if len(line['Modulkod']) > 1:
-                grade = line['Betyg']
-                if grade != 'F' and grade != 'FX':
-                    modulkod = line['Modulkod']
-                    poang = line['Modulpoäng'].replace(',', '.')
-                    result[pnr][kurskod][modulkod] = float(poang)
-    return result
-
-
-bi =  re.compile('BI\\s+\\((\\d+\\.\\d+)\\)')
-bii = re.compile('BII\\s+\\((\\d+\\.\\d+)\\)')
-hp =  re.compile('HP\\s+\\((\\d+\\.\\d+)\\)')
-
-
-def parse_merits(meritstring):
-    data = {}
-    m_bi = bi.search(meritstring)
-    m_bii = bii.search(meritstring)
-    m_hp = hp.search(meritstring)
-    if m_bi:
-        data['BI'] = float(m_bi.group(1))
-    if m_bii:
-        data['BII'] = float(m_bii.group(1))
-    if m_hp:
-        data['HP'] = float(m_hp.group(1))
-    return data
+def strip_fields(data, start, end, chars=b' \t\r"'):
+    '''
+    Move the field boundaries start and end (exclusive), indices into data, past
+    any of the given characters at either end of the fields.
+    '''
+    strip = np.frombuffer(chars, dtype=np.uint8)
+    while (more := (start < end) & np.isin(data[np.minimum(start, len(data) - 1)], strip)).any():
+        start = start + more
+    while (more := (start < end) & np.isin(data[end - 1], strip)).any():
+        end = end - more
+    return start, end
 
 
+def gather_fields(data, start, end):
+    '''
+    The fields data[start:end] as a fixed-width byte matrix, padded with zeros.
+    '''
+    width = max(1, int((end - start).max(initial=0)))
+    index = start[:, None] + np.arange(width)
+    return np.where(index < end[:, None], data[np.minimum(index, len(data) - 1)], 0).astype(np.uint8)
+
+
+def separators(data, breaks):
+    '''
+    Positions of the field separators in data: the semicolons outside quotes. Quotes
+    are paired within each line, so that an unbalanced quote only affects its line.
+    '''
+    semicolons = np.flatnonzero(data == ord(';'))
+    quotes = np.cumsum(data == ord('"'), dtype=np.int32)
+    lines = np.searchsorted(breaks, semicolons, side='right') - 1
+    quoted = (quotes[semicolons] - quotes[breaks[lines]]) % 2 == 1
+    return semicolons[~quoted]
+
+
+def scan_merits(chunk):
+    '''
+    Find the personnummer of each line, and the merits, in a chunk of a NyA export.
+
+    Rather than splitting lines and running patterns on them, the bytes are searched
+    with numpy: line breaks start lines, semicolons outside quotes separate fields,
+    the personnummer is the first field, and a merit is a parenthesised number after
+    BI, BII or HP, as in "BI (17.25)", within the merit field (MERIT_FIELD).
+    Returns the personnummer per line, as bytes, and the line, column in MERIT_TYPES
+    and value of each merit.
+    '''
+    data = np.frombuffer(b'\n' + chunk, dtype=np.uint8)
+    breaks = np.flatnonzero(data == ord('\n'))
+    line_start = breaks + 1
+    line_end = np.append(breaks[1:], len(data))
+    seps = separators(data, breaks)
+    first = np.searchsorted(seps, line_start)
+    seps = np.append(seps, np.full(MERIT_FIELD + 1, len(data)))
+    start, end = strip_fields(data, line_start, np.minimum(line_end, seps[first]))
+    end = np.where(end - start > MAX_PNR, start, end)
+    fields = gather_fields(data, start, end)
+    pnrs = np.ascontiguousarray(fields).view(f'S{fields.shape[1]}').ravel()
+
+    # Only parentheses in the merit field count
+    field_start = np.minimum(seps[first + MERIT_FIELD - 1] + 1, line_end)
+    field_end = np.minimum(seps[first + MERIT_FIELD], line_end)
+    opening = np.flatnonzero(data == ord('('))
+    lines = np.searchsorted(breaks, opening, side='right') - 1
+    inside = (opening >= field_start[lines]) & (opening < field_end[lines])
+    opening, lines = opening[inside], lines[inside]
+    field_start, field_end = field_start[lines], field_end[lines]
+
+    # The merit type is the word before the parenthesis, after at least one space
+    word_end = opening - 1
+    spaced = data[word_end] == ord(' ')
+    while (more := (word_end > field_start) & (data[word_end] == ord(' '))).any():
+        word_end = word_end - more
+    last, previous, before = (data[np.maximum(word_end - k, 0)] for k in range(3))
+    is_hp = (last == ord('P')) & (previous == ord('H'))
+    is_bi = (last == ord('I')) & (previous == ord('B'))
+    is_bii = (last == ord('I')) & (previous == ord('I')) & (before == ord('B'))
+    column = np.select([is_bi, is_bii, is_hp], [MERIT_TYPES.index(t) for t in MERIT_TYPES], -1)
+    column[word_end - 1 < field_start] = -1
+
+    # The value is the number up to the closing parenthesis, within the field, with a
+    # decimal point or comma
+    closing = np.flatnonzero(data == ord(')'))
+    value_end = np.append(closing, len(data))[np.searchsorted(closing, opening)]
+    n_chars = value_end - opening - 1
+    closed = (value_end < field_end) & (n_chars > 0) & (n_chars <= MAX_VALUE)
+    value_end = np.where(closed, value_end, opening + 1)
+    digits = gather_fields(data, opening + 1, value_end)
+    is_digit = (digits >= ord('0')) & (digits <= ord('9'))
+    is_separator = (digits == ord('.')) | (digits == ord(','))
+    valid = ((column >= 0) & spaced & closed & is_digit[:, 0]
+             & ((is_digit | is_separator).sum(axis=1) == n_chars) & (is_separator.sum(axis=1) <= 1))
+    n_decimals = np.where(is_separator.any(axis=1), n_chars - 1 - is_separator.argmax(axis=1), 0)
+    mantissa = np.zeros(len(opening), dtype=np.int64)
+    for j in range(digits.shape[1]):
+        mantissa = np.where(is_digit[:, j], mantissa * 10 + (digits[:, j].astype(np.int64) - ord('0')), mantissa)
+    values = mantissa / 10.0 ** n_decimals      # Exact operands, so rounded just like float()
+    return pnrs, lines[valid], column[valid], values[valid]
+
+
+@profiled('read merits')
 def read_nya_merits(filename):
-    merits = {}
-    with open(filename) as h:
-        for line in h:
-            pnr, enamn, fnamn, program, prio, _, meritstring, _, _ = line.split(';')
-            merits[pnr] = parse_merits(meritstring)
-    return merits
+    '''
+    Read a NyA export, with the personnummer first on each line, and return a MeritTable.
+
+    The file, or Excel workbook, is read in one pass, in chunks that are scanned
+    with scan_merits. Fields may be quoted and there may be any number of fields after the
+    personnummer. An applicant occurring on several lines gets the merits of the
+    last one.
+    '''
+    pnr_chunks, merit_chunks = [], []
+    n_lines = 0
+    for chunk in iter_chunks(filename):
+        pnrs, lines, columns, values = scan_merits(chunk)
+        pnr_chunks.append(pnrs)
+        merit_chunks.append((lines + n_lines, columns, values))
+        n_lines += len(pnrs)
+    if not n_lines:
+        return MeritTable([], [])
+
+    # The first merit of a type on a line wins
+    lines, columns, values = (np.concatenate(parts) for parts in zip(*merit_chunks))
+    _, first = np.unique(lines * len(MERIT_TYPES) + columns, return_index=True)
+    line_values = np.full((n_lines, len(MERIT_TYPES)), np.nan)
+    line_values[lines[first], columns[first]] = values[first]
+
+    # One row per applicant, in order of first occurrence, with the values from its last line
+    last_line = {}
+    for line, pnr in enumerate(np.concatenate(pnr_chunks).tolist()):
+        last_line[pnr] = line
+    last_line.pop(b'', None)
+    pnrs = [pnr.decode() for pnr in last_line]
+    return MeritTable(pnrs, line_values[np.fromiter(last_line.values(), dtype=np.int64, count=len(pnrs))])
 
 
+@profiled('read personnummer')
 def read_personnummer(filename):
     '''
     Read a simple file containing one personnummer per line.
@@ -1,30 +1,62 @@
 import argparse
+import importlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
+from itertools import cycle, repeat
 import numpy as np
-import matplotlib.pyplot as plt
+import os
 import sys
 from .version import __version__
-from .io import read_programstudents, read_course_results
+from .cache import add_cache_arguments, cache_from_arguments
+from .database import is_database
+from .export import add_export_arguments, export_from_arguments, export_table
+from .io import read_programstudents, read_result_files
+from .table import as_result_table, round_credits
+from .timeseries import cutoff_dates_argument, credits_over_time, write_credits_over_time, plot_credits_over_time
+from .profiling import profiled, stage, add_profile_arguments, start_from_arguments, finish_from_arguments
 
 
 
 
+Aggregates = namedtuple('Aggregates', ['codes', 'matrix', 'student_totals', 'course_totals'])
+
+
+@profiled('aggregate')
+def compute_aggregates(students, results):
+    '''
+    Aggregate the results of the given students in a single pass. The results are
+    a ResultTable, or anything as_result_table accepts, like the ResultView from
+    read_course_results.
+
+    Returns Aggregates with
+      codes:          course codes with credits, sorted by total hp generated,
+      matrix:         points per student (rows, in the order of students) and course (columns, as codes),
+      student_totals: points per student,
+      course_totals:  points per course in codes.
+    '''
+    results = as_result_table(results)
+    n_courses = len(results.course_codes)
+    rows = results.student_rows(students)
+    mine = rows >= 0
+    cells = rows[mine] * n_courses + results.course[mine]
+    matrix = np.bincount(cells, weights=results.credits[mine], minlength=len(students) * n_courses)
+    matrix = round_credits(matrix.reshape(len(students), n_courses))
+
+    course_totals = round_credits(matrix.sum(axis=0))
+    sorted_ids = np.argsort(-course_totals, kind='stable')
+    sorted_ids = sorted_ids[course_totals[sorted_ids] > 0]
+    codes = [results.course_codes[i] for i in sorted_ids]
+    return Aggregates(codes, matrix[:, sorted_ids], round_credits(matrix.sum(axis=1)), course_totals[sorted_ids])
+
+
 def compute_scores_per_period(students, results):
     '''
     For each student, report the number of points managed during the implicitly defined period.
+    The results are given as for compute_aggregates.
     '''
-    scores = {}
-    for pnr in students:
-        sc = 0
-        if pnr in results:
-            if pnr not in scores:
-                scores[pnr] = 0                
-            for res in results[pnr]:
-                for module in results[pnr][res]:
-                    scores[pnr] += results[pnr][res][module]
-        else:
-            scores[pnr] = 0
-    return scores
+    aggregates = compute_aggregates(students, results)
+    return dict(zip(students, aggregates.student_totals.tolist()))
 
 
 def get_course_codes(students, results):
@@ -32,38 +64,30 @@ def get_course_codes(students, results):
     Return a list of course codes, sorted by the order of total hp generated.
     This should place MM2001 first, but it is discovered in the data.
     '''
-    codes = dict()
-    for pnr, res in results.items():
-        for code in res:
-            if code not in codes:
-                codes[code] = 0
-            for module, hp in res[code].items():
-                if pnr in students:
-                    codes[code] += hp
+    return compute_aggregates(students, results).codes
 
-    sorted_codes = sorted(codes.keys(), key=lambda code: codes[code], reverse=True)
-    non_zero_credits = filter(lambda code: codes[code] > 0, sorted_codes)
-    return list(non_zero_credits)
+
+def compute_student_course_matrix(students, results):
+    '''
+    Return the course codes, sorted as by get_course_codes, and a matrix with one row
+    per student (in the order of students) and one column per course, holding the
+    number of points the student has in the course.
+    '''
+    aggregates = compute_aggregates(students, results)
+    return aggregates.codes, aggregates.matrix
 
 
 def compute_student_scores_per_course(students, results):
-    student_scores = {}
-    codes = get_course_codes(students, results)
+    '''
+    Map course code to a dict mapping personnummer to the student's points in the course.
+    '''
+    codes, matrix = compute_student_course_matrix(students, results)
+    return {code: dict(zip(students, matrix[:, j].tolist())) for j, code in enumerate(codes)}
 
-    scores = dict()             # Map course code to student points
-    for code in codes:
-        scores[code] = dict()
-        for pnr in students:
-            sc = 0
-            if pnr in results and code in results[pnr]:
-                for module in results[pnr][code]:
-                    sc += results[pnr][code][module]
-            scores[code][pnr] = sc
-    return scores
-        
 
 def colors_and_hatches():
-    prop_cycle = plt.rcParams['axes.prop_cycle']
+    import matplotlib
+    prop_cycle = matplotlib.rcParams['axes.prop_cycle']
     colors = prop_cycle.by_key()['color']    
 
     hatches = [' ', '//', '\\\\', '+']
@@ -104,6 +128,7 @@ available = [
     '#bcbd22',
     '#17becf'        
 ]
+more_colors_and_hatches = cycle(colors_and_hatches())  # When the available colors are used up
 
 def colors_and_hatches_by_course(code):
 
@@ -111,42 +136,120 @@ def colors_and_hatches_by_course(code):
         return course_color_and_hatch[code]
     else:
         print(f'Added color for {code}', file=sys.stderr)
-        color = available.pop()
-        hatch = '\\\\'
+        if available:
+            color = available.pop()
+            hatch = '\\\\'
+        else:
+            color, hatch = next(more_colors_and_hatches)
         course_color_and_hatch[code] = (color, hatch)
         return color, hatch    
 
 
-def create_student_bars(students, results, title):
+def assign_colors(codes):
     '''
-    Create bar diagrams where each bar is a student and each course adds a rectangle 
-    to the bar. Sort by bar height.
+    Give each of the course codes its color and hatch now, rather than as the
+    diagrams are drawn, so that several diagrams draw a course alike.
+    Returns the colors and hatches of all courses.
     '''
-    filename = title + '_per_student.pdf'
-    offset = np.zeros(len(students))
-    scores = compute_student_scores_per_course(students, results)
-    total_scores = compute_scores_per_period(students, results)
+    for code in codes:
+        colors_and_hatches_by_course(code)
+    return dict(course_color_and_hatch)
 
-    ranked_students = sorted(total_scores.keys(), key=lambda s: total_scores[s], reverse=True)
 
-    index = np.arange(len(students))
+def student_bars_figure(aggregates, title, bins=None, rasterized=False, layered=False):
+    '''
+    The figure of create_student_bars, as a matplotlib Figure not tied to pyplot, so
+    that it can be saved anywhere, also from other threads and processes. With
+    layered, each course is drawn as one area over all students.
+    '''
+    from matplotlib.figure import Figure  # Imported here, since it is slow to load
+    n_students = len(aggregates.student_totals)
+    ranked_students = np.argsort(-aggregates.student_totals, kind='stable')
+    matrix = aggregates.matrix[ranked_students]
+    ylabel = 'student (anonymt)'
+    if bins and n_students > 0:
+        bins = min(bins, n_students)
+        starts = np.arange(bins) * n_students // bins
+        sizes = np.diff(np.append(starts, n_students))
+        matrix = np.add.reduceat(matrix, starts, axis=0) / sizes[:, None]
+        ylabel = 'percentil (medel per grupp)'
+        layered = False
+
+    index = np.arange(len(matrix))
+    offset = np.zeros(len(matrix))
     bar_width = 0.6
 
     #style = colors_and_hatches()
 
-    plt.clf()
-    fig, ax = plt.subplots(layout='constrained')
-    for course in scores:
-        student_results = np.array([scores[course][pnr] for pnr in ranked_students])
+    fig = Figure(layout='constrained')
+    ax = fig.subplots()
+    for course, student_results in zip(aggregates.codes, matrix.T):
         #color, hatch = next(style)
         color, hatch = colors_and_hatches_by_course(course)
-        ax.barh(index, student_results, bar_width, left=offset, label=course, color=color, hatch=hatch)
+        if layered:
+            ax.fill_betweenx(index, offset, offset + student_results, step='mid', label=course,
+                             color=color, hatch=hatch, rasterized=rasterized, linewidth=0)
+        else:
+            ax.barh(index, student_results, bar_width, left=offset, label=course, color=color, hatch=hatch)
         offset += student_results
+    if bins and n_students > 0:
+        ax.set_yticks(index, [f'{100 * start // n_students}–{100 * (start + size) // n_students} %'
+                              for start, size in zip(starts, sizes)])
+        ax.invert_yaxis()
     fig.legend(loc='outside right upper')
-    plt.xlabel('hp')
-    plt.ylabel('student (anonymt)')
-    plt.title(f'{title}: Resultat per student och kurs')
-    plt.savefig(filename)
+    ax.set_xlabel('hp')
+    ax.set_ylabel(ylabel)
+    ax.set_title(f'{title}: Resultat per student och kurs')
+    return fig
+
+
+@profiled('plot per student')
+def create_student_bars(aggregates, title, bins=None, rasterized=False, image_format='pdf'):
+    '''
+    Create bar diagrams where each bar is a student and each course adds a rectangle 
+    to the bar. Sort by bar height.
+
+    For large cohorts, bins gives an aggregated view: the ranked students are put in
+    that many percentile bins, and each bar shows the bin's mean hp per course, so the
+    number of rectangles does not grow with the cohort. With rasterized, the bars are
+    embedded as an image even in a PDF, and image_format can be 'png' instead of 'pdf'.
+    For such image output, each course is drawn as one area over all students, rather
+    than as a rectangle per student, which is much faster for large cohorts.
+    '''
+    layered = rasterized or image_format != 'pdf'  # A filled area per course instead of a bar per student
+    fig = student_bars_figure(aggregates, title, bins, rasterized, layered)
+    fig.savefig(f'{title}_per_student.{image_format}', dpi=150)
+
+
+@profiled('plot per course')
+def create_course_multiples(aggregates, title, image_format='pdf', n_points=101):
+    '''
+    Small multiples, one diagram per course, showing the hp in the course of the
+    students ranked by those hp. Each course is drawn as a single filled curve over
+    n_points percentiles, however many students there are.
+    '''
+    import matplotlib.pyplot as plt
+    filename = f'{title}_per_course.{image_format}'
+    n_courses = len(aggregates.codes)
+    if n_courses == 0:
+        return
+    n_cols = int(np.ceil(np.sqrt(n_courses)))
+    n_rows = int(np.ceil(n_courses / n_cols))
+    fig, axs = plt.subplots(n_rows, n_cols, sharex=True, sharey=True, squeeze=False,
+                            figsize=(2.5 * n_cols, 2 * n_rows), layout='constrained')
+    shares = np.linspace(0, 100, n_points)
+    for ax, course, course_results in zip(axs.flat, aggregates.codes, aggregates.matrix.T):
+        color, hatch = colors_and_hatches_by_course(course)
+        curve = np.percentile(course_results, 100 - shares) if len(course_results) else np.zeros(n_points)
+        ax.fill_between(shares, curve, color=color, hatch=hatch, step='mid')
+        ax.set_title(course, fontsize=9)
+    for ax in axs.flat[n_courses:]:
+        ax.set_visible(False)
+    fig.supxlabel('andel studenter (%)')
+    fig.supylabel('hp')
+    fig.suptitle(f'{title}: Resultat per kurs')
+    fig.savefig(filename, dpi=150)
+    plt.close(fig)
 
 
 def create_histogram(data_dict, program):
@@ -154,50 +257,176 @@ def create_histogram(data_dict, program):
     Create a histogram of the values in the dict (ignoring the keys) 
     and save a the histogram in the filename (should end in ".pdf").
     '''
+    import matplotlib.pyplot as plt
     filename = program + '_hp_per_year.pdf'
     values = data_dict.values()
     plt.hist(values, bins=10, range=(0, max(values)))  # adjust the number of bins as needed
-    plt.xlim = max(values)
+    plt.xlim(0, max(values))
     plt.xlabel('hp')
     plt.ylabel('Antal')
     plt.title(f'{program}: fördelning av hp')
     plt.savefig(filename)
 
 
+SUBCOMMANDS = {
+    'ingest': 'genomstromning.ingest',
+    'query': 'genomstromning.query',
+    'cohorts': 'genomstromning.cohorts',
+    'serve': 'genomstromning.serve',
+    'watch': 'genomstromning.watch',
+}
+
+
 def setup_arguments_parser():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(epilog='Subcommands: ' + ', '.join(SUBCOMMANDS) + '. See "genomstromning SUBCOMMAND -h".')
     #parser.add_argument('program', help='For example NMATK, NMDVK, etc. Used to create output filename(s).')
     parser.add_argument('--version', action='version', version=f'{__version__}')
     parser.add_argument('-d', '--date', help='Give a date in ISO format (YYYY-MM-DD) so results after this date are ignored, for retrospective comparisons.')
+    parser.add_argument('--dates', type=cutoff_dates_argument, help='Instead of a single cutoff date, compute credits over time at several dates: '
+                        'either comma-separated ISO dates, or START:END:STEP where STEP is a number of days, '
+                        '"week", "month" or "term". Writes a table and a plot instead of the per-student diagram.')
     parser.add_argument('-s', '--students', action='store_true', help='Print student result summary to stdout')
+    parser.add_argument('--no-plot', action='store_true', help='Only produce text and CSV output, no diagrams.')
+    parser.add_argument('--bins', type=int, help='For large cohorts: instead of a bar per student, rank the students '
+                        'and draw the mean of each of this many percentile groups, like 10 or 20.')
+    parser.add_argument('--rasterize', action='store_true', help='Embed the bars as an image, which keeps large diagrams small and quick to open.')
+    parser.add_argument('--format', choices=['pdf', 'png'], default='pdf', help='File format of the diagrams. Default: pdf')
+    parser.add_argument('--per-course', action='store_true', help='Also draw small multiples: a diagram per course with the distribution of hp.')
     parser.add_argument('-t', '--title', help='Title of diagram. Without this option, a title is inferred.')
-    parser.add_argument('studentfile', help='Student file')
-    parser.add_argument('results', nargs='+', help='Results file(s)')
+    parser.add_argument('studentfile', help='Student file. For several programs at once (batch mode), give a directory '
+                        'of student files, or several student files separated by commas.')
+    parser.add_argument('results', nargs='+', help='Results file(s), result stores made with "genomstromning ingest" or result databases')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes for parsing result files '
+                        'and, in batch mode, for producing the program reports. Default: 1')
+    add_cache_arguments(parser)
+    add_export_arguments(parser)
+    add_profile_arguments(parser)
     return parser.parse_args(sys.argv[1:])
 
 
+def export_aggregates(title, pnrs, aggregates, export_format):
+    '''
+    Export the student x course credit matrix, a column per course, and the student totals.
+    '''
+    matrix = {code: aggregates.matrix[:, j] for j, code in enumerate(aggregates.codes)}
+    export_table(title + '_student_course', {'Personnummer': pnrs, **matrix}, export_format)
+    export_table(title + '_student_totals', {'Personnummer': pnrs, 'hp': aggregates.student_totals}, export_format)
+
+
+def student_files(spec):
+    '''
+    The student file argument is a file, a directory of student files, or
+    several files separated by commas. Return the list of student files.
+    '''
+    if os.path.isdir(spec):
+        names = sorted(name for name in os.listdir(spec) if not name.startswith('.'))
+        return [os.path.join(spec, name) for name in names if os.path.isfile(os.path.join(spec, name))]
+    return spec.split(',')
+
+
+def program_report(studentfile, results, title=None, cutoffs=None, summary=False, plot=True,
+                   bins=None, rasterized=False, image_format='pdf', per_course=False, export=None):
+    '''
+    Produce the report for the program in studentfile: the per-student diagram or,
+    with cutoffs, credits over time. Results are a ResultTable, which with cutoffs
+    should include results after the last cutoff. Return the student summary
+    lines if summary is wanted. Without plot, matplotlib is never used.
+    The next options are for the diagrams, see create_student_bars and
+    create_course_multiples. With an export format, the credit matrix and the
+    student totals are exported as well.
+    '''
+    program, students = read_programstudents(studentfile)
+    title = title or program
+    if cutoffs:
+        student_credits, codes, course_credits = credits_over_time(students, results, cutoffs)
+        write_credits_over_time(title + '_hp_over_time.csv', cutoffs, students, student_credits, codes, course_credits)
+        if plot:
+            plot_credits_over_time(title + '_hp_over_time.pdf', cutoffs, student_credits, title)
+        return program, []
+
+    aggregates = compute_aggregates(students, results)
+    if export:
+        export_aggregates(title, list(students), aggregates, export)
+    if plot:
+        create_student_bars(aggregates, title, bins, rasterized, image_format)
+        if per_course:
+            create_course_multiples(aggregates, title, image_format)
+    lines = []
+    if summary:
+        scores = dict(zip(students, aggregates.student_totals.tolist()))
+        for pnr, score in sorted(scores.items(), key=lambda ps: ps[1]):
+            fname = students[pnr]['Förnamn']
+            lname = students[pnr]['Efternamn']
+            lines.append(f'{score:5} {fname} {lname}')
+    return program, lines
+
+
+worker_results = None  # The results of a worker process of the batch reports
+
+
+def init_report_worker(results, colors):
+    '''
+    Set up a worker process for the batch reports, with the results, passed once
+    per process rather than once per program, and the course colors of the parent.
+    '''
+    global worker_results
+    worker_results = results
+    course_color_and_hatch.update(colors)
+
+
+def worker_program_report(studentfile, *args):
+    return program_report(studentfile, worker_results, *args)
+
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        subcommand = importlib.import_module(SUBCOMMANDS[sys.argv[1]])
+        return subcommand.main(sys.argv[2:])
+
     args = setup_arguments_parser()
+    start_from_arguments(args)
     if args.date:
         cutoff_date = date.fromisoformat(args.date)
     else:
         cutoff_date = date.today()
 
-    program, students = read_programstudents(args.studentfile)
-    results = read_course_results(args.results, cutoff_date)
-    scores = compute_scores_per_period(students, results)
-
-    if args.title:
-        create_student_bars(students, results, args.title)
-    else:
-        create_student_bars(students, results, program)
-    
-    if args.students:
-        for pnr, score in sorted(scores.items(), key=lambda ps: ps[1]):
-            fname = students[pnr]['Förnamn']
-            lname = students[pnr]['Efternamn']
-            print(f'{score:5} {fname} {lname}')
+    studentfiles = student_files(args.studentfile)
+    batch = len(studentfiles) > 1
+    title = None if batch else args.title
+    cutoffs = args.dates
+
+    # The result files are read once, for all programs. A result database is only
+    # read for the students of the programs.
+    students = None
+    if batch or any(is_database(filename) for filename in args.results):
+        students = {pnr for filename in studentfiles for pnr in read_programstudents(filename)[1]}
+    results = read_result_files(args.results, cache_from_arguments(args), args.jobs, students)
+    if not cutoffs:
+        results = results.until(cutoff_date)
+
+    colors = course_color_and_hatch
+    if batch and not args.no_plot and not cutoffs:
+        # The courses of all programs get their colors here, the same in every diagram
+        courses = np.unique(results.course[results.student_rows(students) >= 0])
+        colors = assign_colors(sorted(results.course_codes[i] for i in courses.tolist()))
+
+    report_args = (repeat(title), repeat(cutoffs), repeat(args.students), repeat(not args.no_plot),
+                   repeat(args.bins), repeat(args.rasterize), repeat(args.format), repeat(args.per_course),
+                   repeat(export_from_arguments(args)))
+    with stage('program reports'):
+        if batch and args.jobs > 1:
+            with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_report_worker,
+                                     initargs=(results, colors)) as pool:
+                reports = list(pool.map(worker_program_report, studentfiles, *report_args))
+        else:
+            reports = list(map(program_report, studentfiles, repeat(results), *report_args))
+
+    for program, lines in reports:
+        if batch and lines:
+            print(f'# {program}')
+        for line in lines:
+            print(line)
+    finish_from_arguments(args)
 
 if __name__ == '__main__':
     main()
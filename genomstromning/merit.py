@@ -1,33 +1,227 @@
-from .main import read_programstudents, read_course_results
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
-import matplotlib.pyplot as plt
+from itertools import repeat
+import numpy as np
 import sys
 from .version import __version__
-from .io import read_nya_merits, read_programstudents, read_course_results, read_personnummer
-from .main import compute_scores_per_period
+from .cache import add_cache_arguments, cache_from_arguments
+from .export import add_export_arguments, export_from_arguments, export_table
+from .io import MERIT_TYPES, read_nya_merits, read_programstudents, read_result_table, read_personnummer
+from .main import compute_aggregates
+from .database import is_database, read_merits as read_database_merits
 import logging
+from .profiling import profiled, add_profile_arguments, start_from_arguments, finish_from_arguments
 
 
-def plot_merits(student_scores, merits, outfileprefix='plot'):
-    for merit_type in ['BI', 'BII', 'HP']:
-        xvals = []
-        yvals = []
-        for pnr, scores in student_scores.items():
-            if (pnr in merits) and (merit_type in merits[pnr]):
-                xvals.append(merits[pnr][merit_type])
-                yvals.append(student_scores[pnr])
-        if len(xvals) == 0:
-            logging.warn(f'No data for {merit_type}')
-        else:
-            plt.clf()
-            plt.title(outfileprefix + ' ' + merit_type)
-            plt.xlabel('Merit')
-            plt.ylabel('hp')
-            plt.plot(xvals, yvals, 'o')
-            filename = outfileprefix + f'_{merit_type}.pdf'
-            plt.savefig(filename)
-            logging.info(f'Saved plot in {filename}')
+N_BANDS = 5
+
+
+def positive_int(text):
+    '''
+    Argument type for counts that must be at least 1.
+    '''
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {value}')
+    return value
+
+
+def ranks(a):
+    '''
+    Ranks of the values in a, starting at 1, with ties given their average rank.
+    '''
+    sorter = np.argsort(a, kind='stable')
+    inverse = np.empty_like(sorter)
+    inverse[sorter] = np.arange(len(a))
+    sorted_a = a[sorter]
+    new_value = np.r_[True, sorted_a[1:] != sorted_a[:-1]]
+    dense = new_value.cumsum()[inverse]
+    bounds = np.r_[np.flatnonzero(new_value), len(a)]
+    return 0.5 * (bounds[dense] + bounds[dense - 1] + 1)
+
+
+def correlation_and_slope(x, y):
+    '''
+    Pearson correlation and least-squares slope of y on x, along the last axis,
+    so that many resamples can be handled at once.
+    '''
+    xm = x - x.mean(axis=-1, keepdims=True)
+    ym = y - y.mean(axis=-1, keepdims=True)
+    sxy = (xm * ym).sum(axis=-1)
+    sxx = (xm * xm).sum(axis=-1)
+    syy = (ym * ym).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sxy / np.sqrt(sxx * syy), sxy / sxx
+
+
+def band_means(bands, y, n_bands):
+    '''
+    Mean of y per band, along the last axis.
+    '''
+    rows = np.arange(bands.size // bands.shape[-1]).reshape(bands.shape[:-1] + (1,))
+    cells = (rows * n_bands + bands).ravel()
+    sums = np.bincount(cells, weights=y.ravel(), minlength=rows.size * n_bands)
+    counts = np.bincount(cells, minlength=rows.size * n_bands)
+    with np.errstate(invalid='ignore'):
+        return (sums / counts).reshape(bands.shape[:-1] + (n_bands,))
+
+
+def bootstrap_chunk(x, y, bands, n_bands, n_resamples, seed):
+    '''
+    Correlations, slopes and band means for n_resamples resamples of the students.
+    '''
+    rng = np.random.default_rng(seed)
+    resamples = rng.integers(0, len(x), size=(n_resamples, len(x)))
+    r, slope = correlation_and_slope(x[resamples], y[resamples])
+    return r, slope, band_means(bands[resamples], y[resamples], n_bands)
+
+
+def bootstrap(x, y, bands, n_bands, n_resamples, jobs=1, seed=None, chunk_size=250):
+    '''
+    Run the resampling in chunks, in parallel with jobs > 1. Each chunk gets its own
+    random stream from seed, so results do not depend on the number of jobs.
+    Without resamples, the arrays are empty.
+    '''
+    if n_resamples < 1:
+        return [np.empty(0), np.empty(0), np.empty((0, n_bands))]
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = (repeat(x), repeat(y), repeat(bands), repeat(n_bands), sizes, seeds)
+    if jobs > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            chunks = list(pool.map(bootstrap_chunk, *args))
+    else:
+        chunks = list(map(bootstrap_chunk, *args))
+    return [np.concatenate(parts) for parts in zip(*chunks)]
+
+
+def interval(samples):
+    '''
+    Percentile 95% interval of the bootstrap samples, NaN if there are none.
+    '''
+    if len(samples) == 0:
+        return np.full(2, np.nan)
+    return np.nanpercentile(samples, [2.5, 97.5])
+
+
+@profiled('merit statistics')
+def merit_statistics(credits, merit_values, n_resamples=1000, jobs=1, seed=None):
+    '''
+    Statistics on how credits depend on each merit type, for all types at once.
+
+    Returns a dict per merit type with the number of students n, Pearson r and
+    Spearman rho, the slope and intercept of a linear regression of credits on the
+    merit, and a list of merit bands (quintiles of the merit) with mean credits.
+    Percentile bootstrap 95% intervals are given for r, the slope and the band means,
+    or NaN without resamples.
+    '''
+    stats = {}
+    for j, merit_type in enumerate(MERIT_TYPES):
+        known = ~np.isnan(merit_values[:, j])
+        x, y = merit_values[known, j], credits[known]
+        if len(x) < 2:
+            continue
+        r, slope = correlation_and_slope(x, y)
+        rho, _ = correlation_and_slope(ranks(x), ranks(y))
+        edges = np.unique(np.quantile(x, np.linspace(0, 1, N_BANDS + 1)))
+        if len(edges) < 2:      # All students have the same merit: one band
+            edges = np.repeat(edges, 2)
+        bands = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, len(edges) - 2)
+        n_bands = len(edges) - 1
+        means = band_means(bands, y, n_bands)
+
+        boot_r, boot_slope, boot_means = bootstrap(x, y, bands, n_bands, n_resamples, jobs, seed)
+        stats[merit_type] = {
+            'n': len(x),
+            'r': r, 'r_ci': interval(boot_r),
+            'rho': rho,
+            'slope': slope, 'slope_ci': interval(boot_slope),
+            'intercept': y.mean() - slope * x.mean(),
+            'bands': [{'from': edges[b], 'to': edges[b + 1],
+                       'n': int(np.count_nonzero(bands == b)),
+                       'mean': means[b],
+                       'mean_ci': interval(boot_means[:, b])}
+                      for b in range(n_bands)],
+        }
+    return stats
+
+
+def write_merit_statistics(outfileprefix, stats, file=sys.stdout):
+    '''
+    Write the statistics to <prefix>_merit_stats.csv and the bands to <prefix>_merit_bands.csv,
+    and print a summary.
+    '''
+    with open(outfileprefix + '_merit_stats.csv', 'w') as h:
+        print('"Merit";"n";"r";"r låg";"r hög";"rho";"lutning";"lutning låg";"lutning hög";"intercept"', file=h)
+        for merit_type, st in stats.items():
+            values = [st['n'], st['r'], *st['r_ci'], st['rho'], st['slope'], *st['slope_ci'], st['intercept']]
+            print(';'.join([f'"{merit_type}"'] + [f'{v:.4g}' for v in values]), file=h)
+    with open(outfileprefix + '_merit_bands.csv', 'w') as h:
+        print('"Merit";"Från";"Till";"n";"hp medel";"hp låg";"hp hög"', file=h)
+        for merit_type, st in stats.items():
+            for band in st['bands']:
+                values = [band['from'], band['to'], band['n'], band['mean'], *band['mean_ci']]
+                print(';'.join([f'"{merit_type}"'] + [f'{v:.4g}' for v in values]), file=h)
+
+    for merit_type, st in stats.items():
+        print(f'{merit_type:4} n={st["n"]:<5} r={st["r"]:.2f} [{st["r_ci"][0]:.2f}, {st["r_ci"][1]:.2f}]  '
+              f'rho={st["rho"]:.2f}  hp/merit={st["slope"]:.1f} [{st["slope_ci"][0]:.1f}, {st["slope_ci"][1]:.1f}]', file=file)
+
+
+@profiled('plot merits')
+def merit_figure(x, y, title, st=None):
+    '''
+    Scatter plot of credits y against merits x, as a matplotlib Figure. With st, the
+    statistics of the merit type from merit_statistics, the regression line and the
+    band means are drawn too.
+    '''
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
+    ax.set_title(title)
+    ax.set_xlabel('Merit')
+    ax.set_ylabel('hp')
+    ax.plot(x, y, 'o', alpha=0.5)
+    if st:
+        xs = np.array([x.min(), x.max()])
+        ax.plot(xs, st['intercept'] + st['slope'] * xs, '-', label=f'r = {st["r"]:.2f}')
+        middles = [(b['from'] + b['to']) / 2 for b in st['bands']]
+        errors = np.abs(np.array([b['mean_ci'] for b in st['bands']]).T - [b['mean'] for b in st['bands']])
+        ax.errorbar(middles, [b['mean'] for b in st['bands']], yerr=errors, fmt='s', capsize=3, label='medel per band')
+        ax.legend()
+    return fig
+
+
+def plot_merits(credits, merit_values, outfileprefix='plot', stats=None):
+    '''
+    Scatter plot credits against each merit type. With stats, from merit_statistics,
+    the regression line and the band means are drawn too.
+    '''
+    for j, merit_type in enumerate(MERIT_TYPES):
+        known = ~np.isnan(merit_values[:, j])
+        if not known.any():
+            logging.warning(f'No data for {merit_type}')
+            continue
+        fig = merit_figure(merit_values[known, j], credits[known], outfileprefix + ' ' + merit_type,
+                           stats.get(merit_type) if stats else None)
+        filename = outfileprefix + f'_{merit_type}.pdf'
+        fig.savefig(filename)
+        logging.info(f'Saved plot in {filename}')
+
+
+@profiled('write merits')
+def write_merits(filename, students, credits, merit_values):
+    '''
+    Write each student's merits and hp to a semicolon-separated file.
+    '''
+    with open(filename, 'w') as h:
+        print(';'.join(['"Personnummer"'] + [f'"{t}"' for t in MERIT_TYPES] + ['"hp"']), file=h)
+        for pnr, score, values in zip(students, credits.tolist(), merit_values.tolist()):
+            if any(v == v for v in values):     # At least one merit is not NaN
+                values = ['' if v != v else f'{v:g}' for v in values]
+                print(';'.join([f'"{pnr}"'] + values + [f'{score:g}']), file=h)
+    logging.info(f'Saved merits in {filename}')
 
 
 def setup_arguments_parser():
@@ -36,16 +230,24 @@ def setup_arguments_parser():
     parser.add_argument('--version', action='version', version=f'{__version__}')
     parser.add_argument('-d', '--date', help='Give a date in ISO format (YYYY-MM-DD) so results after this date are ignored, for retrospective comparisons.')
     parser.add_argument('-p', '--prefix', help='Filename prefix for plot output.')
+    parser.add_argument('--no-plot', action='store_true', help='Write merits and hp to a CSV file instead of plotting them.')
     parser.add_argument('-s', '--studentpersonnummer', action='store_true', help='The student file is simply a list of personnummer, not a raw Ladok student file.')
     parser.add_argument('studentfile', help='File with a list of program students')
-    parser.add_argument('gradefile', help='File with "meritvärden", as exported from NyA.')
-    parser.add_argument('results', nargs='+', help='Results file(s)')
+    parser.add_argument('gradefile', help='File with "meritvärden", as exported from NyA, or a database made with "genomstromning query DB load".')
+    parser.add_argument('results', nargs='+', help='Results file(s), result stores made with "genomstromning ingest" or result databases')
+    parser.add_argument('-b', '--bootstrap', type=positive_int, default=1000, help='Number of bootstrap resamples for the confidence intervals. Default: 1000')
+    parser.add_argument('--seed', type=int, help='Random seed for the bootstrap, for reproducible intervals.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes for parsing result files and for the bootstrap. Default: 1')
+    add_cache_arguments(parser)
+    add_export_arguments(parser)
+    add_profile_arguments(parser)
     return parser.parse_args(sys.argv[1:])
 
 
 
 def main():
     args = setup_arguments_parser()
+    start_from_arguments(args)
     if args.date:
         cutoff_date = date.fromisoformat(args.date)
     else:
@@ -55,14 +257,28 @@ def main():
         students  = read_personnummer(args.studentfile)
     else:
         program, students = read_programstudents(args.studentfile)
-    merits = read_nya_merits(args.gradefile)
-    results = read_course_results(args.results, cutoff_date)
-    scores = compute_scores_per_period(students, results)
+    if is_database(args.gradefile):
+        merits = read_database_merits(args.gradefile)
+    else:
+        merits = read_nya_merits(args.gradefile)
+    results = read_result_table(args.results, cutoff_date, cache_from_arguments(args), args.jobs, students)
+    credits = compute_aggregates(students, results).student_totals
+    merit_values = merits.take(students)
+    stats = merit_statistics(credits, merit_values, args.bootstrap, args.jobs, args.seed)
 
     title = 'merit_plot'
     if args.prefix:
         title = args.prefix
-    plot_merits(scores, merits, title)
+    write_merit_statistics(title, stats)
+    if args.export:
+        columns = {t: merit_values[:, j] for j, t in enumerate(MERIT_TYPES)}
+        export_table(title + '_merit_join', {'Personnummer': list(students), **columns, 'hp': credits},
+                     export_from_arguments(args))
+    if args.no_plot:
+        write_merits(title + '_merits.csv', students, credits, merit_values)
+    else:
+        plot_merits(credits, merit_values, title, stats)
+    finish_from_arguments(args)
     
 
 
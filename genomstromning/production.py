@@ -1,59 +1,194 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from itertools import repeat
+import json
 import numpy as np
-import matplotlib.pyplot as plt
+import os
+import re
 import sys
+from .version import __version__
+from .io import iter_tables, split_preamble
+from .export import add_export_arguments, export_from_arguments, export_table
+from .produktion import TERMS, semester_index, semester_labels
+from .profiling import profiled, add_profile_arguments, start_from_arguments, finish_from_arguments
+
+
+PLOT_MANIFEST = '.hap_plots.json'   # Digests of the data in the diagrams last drawn
 
 
 def setup_arguments_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('infile', help='Filename for "Helårsprestationer", a CSV file.')
+    parser.add_argument('--version', action='version', version=f'{__version__}')
+    parser.add_argument('infiles', nargs='+', help='Filename(s) for "Helårsprestationer", CSV files or Excel workbooks (.xlsx), '
+                        'for instance one per year. Rounds in files with overlapping periods are counted once.')
     parser.add_argument('-c', '--courses', help='Comma-separated list of course codes.')
-    parser.add_argument('-r', '--restriction', help='Restrict to courses matching the given prefix.')
-    parser.add_argument('-e', '--exclude', help='Do not include courses matching the given prefix.')
+    parser.add_argument('-r', '--restriction', help='Restrict to courses matching one of the given prefixes, separated by commas. Eg.: "MM,MT"')
+    parser.add_argument('-e', '--exclude', help='Do not include courses matching any of the given prefixes, separated by commas.')
+    parser.add_argument('--no-plot', action='store_true', help='Only list the production, no diagrams.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes drawing diagrams. Default: 1')
+    parser.add_argument('-f', '--force', action='store_true', help=f'Redraw all diagrams, also those whose data has not changed since they were drawn (as noted in {PLOT_MANIFEST}).')
+    add_export_arguments(parser)
+    add_profile_arguments(parser)
     
     return parser.parse_args(sys.argv[1:])
 
 
 
-def read_production(filename, explicit, restriction, exclusion):
+class PrefixIndex:
+    '''
+    Course code prefixes, like MM or DA20, grouped by length, so that a course code
+    is matched with one set lookup per prefix length, however many prefixes there are.
     '''
-    Read report on Helårsprestationer from LADOK.
+    def __init__(self, prefixes):
+        self.by_length = {}
+        for prefix in prefixes:
+            self.by_length.setdefault(len(prefix), set()).add(prefix)
 
-    Headers:
-    Kurskod;Kurs;Omfattning;Enhet;Kod;Studietakt;Finansieringsform;Undervisningsform;Studieort;Startdatum;Kvinnor;Män;Total
+    def __bool__(self):
+        return bool(self.by_length)
+
+    def matches(self, course):
+        return any(course[:n] in prefixes for n, prefixes in self.by_length.items())
+
+
+def prefix_index(prefixes):
     '''
-    with open(filename) as h:
-        lines = h.readlines()
+    A PrefixIndex from a comma-separated string or a list of prefixes, or None.
+    '''
+    if prefixes is None or isinstance(prefixes, PrefixIndex):
+        return prefixes
+    if isinstance(prefixes, str):
+        prefixes = prefixes.split(',')
+    return PrefixIndex(prefix.strip() for prefix in prefixes if prefix.strip())
+
 
+def period_years(metadata):
+    '''
+    The first and last year of the period of a HÅP report, like "2015 - 2023", or None.
+    '''
+    years = re.findall(r'\d{4}', metadata.get('Period', ''))
+    return (int(years[0]), int(years[-1])) if years else None
+
+
+def read_production_file(filename, explicit=None, restriction=None, exclusion=None, decisions=None):
+    '''
+    The metadata and the courses of one HÅP report, as read_production returns them,
+    with a round per row of the report. The courses to keep are given as for
+    read_production. decisions, if given, keeps the verdict on each course code
+    from one report to the next.
+    '''
+    if decisions is None:
+        decisions = dict()
     metadata = dict()
-    for line_no, line in enumerate(lines):
-        line = line.rstrip()
-        tokens = line.split(';')
-        if len(tokens) > 1:
-            if tokens[0] == 'Kurskod':
-                break
-            metadata[tokens[0].strip('"')] = tokens[1].strip('"')
-            
-    start_line = line_no + 1    # This is where the actual data starts
     result = dict()
-    for line in lines[start_line:]:
-        elems = line.replace('"', '').split(';')
-        course_code = elems[0]
-        if is_a_keeper(course_code, explicit, restriction, exclusion):
-            course_name = elems[1]
-            course_credits = make_float(elems[2])
-            course_event_code = elems[4]
-            course_studietakt = elems[5]
-            course_start_date = elems[9]
-            course_hap = make_float(elems[12])
-            round_info = (course_hap, course_event_code, course_studietakt, course_start_date)
-            if course_code not in result:
-                result[course_code] = {'name': course_name,
-                                       'credits': course_credits,
+    for rows in iter_tables(filename, unquote=True):
+        preamble, rows = split_preamble(rows, 'Kurskod', lambda fields: len(fields) >= 13)
+        for tokens in preamble:
+            if len(tokens) > 1:
+                metadata[tokens[0]] = tokens[1]
+
+        for elems in rows:
+            if len(elems) < 13:
+                continue
+            course_code = elems[0]
+            keep = decisions.get(course_code)
+            if keep is None:
+                keep = decisions[course_code] = is_a_keeper(course_code, explicit, restriction, exclusion)
+            if not keep:
+                continue
+            round_info = (make_float(elems[12]), elems[4], elems[5], elems[9])
+            course = result.get(course_code)
+            if course is None:
+                result[course_code] = {'name': elems[1],
+                                       'credits': make_float(elems[2]),
                                        'rounds': [ round_info ]}
             else:
-                result[course_code]['rounds'].append(round_info)
+                course['rounds'].append(round_info)
+    return metadata, result
+
+
+def rounds_years(result):
+    '''
+    The first and last year rounds start in, for a report without a Period, or None.
+    '''
+    years = [int(start_date[:4]) for course in result.values()
+             for _, _, _, start_date in course['rounds'] if start_date[:4].isdigit()]
+    return (min(years), max(years)) if years else None
+
+
+def merge_reports(reports):
+    '''
+    The courses of several reports, given as (period, order, metadata, courses) sorted
+    by the end of the period, with each round counted once.
+    '''
+    counted = dict()    # Round -> [HÅP, order and period of the last report counted, its HÅP]
+    result = dict()
+    for period, order, _, courses in reports:
+        for course_code, course in courses.items():
+            if course_code not in result:
+                result[course_code] = {'name': course['name'], 'credits': course['credits'], 'rounds': []}
+            for hap, event_code, studietakt, start_date in course['rounds']:
+                key = (course_code, event_code, studietakt, start_date)
+                before = counted.get(key)
+                if before is None:
+                    counted[key] = [hap, order, period, hap]
+                elif before[1] == order:        # Another row of the round in the same report
+                    before[0] += hap
+                    before[3] += hap
+                else:
+                    if before[2][1] >= period[0]:   # Overlapping periods: the later report replaces the earlier
+                        before[0] -= before[3]
+                    before[0] += hap
+                    before[1:] = order, period, hap
+
+    for (course_code, event_code, studietakt, start_date), (hap, *_) in counted.items():
+        result[course_code]['rounds'].append((hap, event_code, studietakt, start_date))
+    return result
+
+
+@profiled('read production')
+def read_production(filenames, explicit=None, restriction=None, exclusion=None):
+    '''
+    Read reports on Helårsprestationer from LADOK, for instance one per year.
 
+    Headers:
+    Kurskod;Kurs;Omfattning;Enhet;Kod;Studietakt;Finansieringsform;Undervisningsform;Studieort;Startdatum;Kvinnor;Män;Total
+
+    The reports can be CSV files or Excel workbooks, as exported from Ladok, and are
+    read a row at a time. Only courses in explicit are kept, if given, or else those
+    matching a restriction prefix (if any) and no exclusion prefix. Prefixes are
+    given as lists or as comma-separated strings.
+
+    A round, identified by course code, Kod, Studietakt and Startdatum, that is
+    reported in files with overlapping periods is only counted once, using the file
+    whose period ends last. The HÅP of files with separate periods add up, as do
+    the rows of a round within a file.
+
+    Returns a dict from course code to the course's name, credits and rounds, a list
+    of (HÅP, Kod, Studietakt, Startdatum), and the metadata of the reports, with the
+    Period covering all of them.
+    '''
+    if isinstance(filenames, (str, os.PathLike)):
+        filenames = [filenames]
+    explicit = set(explicit) if explicit else None
+    restriction = prefix_index(restriction)
+    exclusion = prefix_index(exclusion)
+    decisions = dict()
+
+    reports = []
+    for i, filename in enumerate(filenames):
+        metadata, courses = read_production_file(filename, explicit, restriction, exclusion, decisions)
+        period = period_years(metadata) or rounds_years(courses) or (0, 0)
+        reports.append((period, i, metadata, courses))
+    reports.sort(key=lambda report: (report[0][1], report[1]))
+    result = reports[0][3] if len(reports) == 1 else merge_reports(reports)
+
+    metadata = dict()
+    for _, _, report_metadata, _ in reports:
+        metadata.update(report_metadata)
+    if reports:
+        metadata['Period'] = f'{min(r[0][0] for r in reports)} - {max(r[0][1] for r in reports)}'
     return result, metadata
 
 
@@ -68,19 +203,18 @@ def make_float(s):
 def is_a_keeper(course, explicit, restriction, exclusion):
     '''
     Predicate: do we want to keep this course?
-    Yes, if it matches the restriction prefix and does not match exclusion prefix.
-    Yes, if it is a coures explicitly listed.
+    Yes, if it is a course explicitly listed.
+    Otherwise yes, if it matches a restriction prefix (if there are any) and no exclusion prefix.
+    The prefixes are given as PrefixIndex.
     '''
     if explicit:
         return course in explicit
-    
-    if exclusion:
-        n = len(exclusion)
-        return course[:n] != exclusion
+
+    if exclusion and exclusion.matches(course):
+        return False
 
     if restriction:
-        n = len(restriction)
-        return course[:n] == restriction
+        return restriction.matches(course)
 
     return True
 
@@ -121,73 +255,174 @@ def generate_semesters(start_year, end_year):
             yield semester + str(year)
         
 
-def make_bar_diagrams_with_subplots(results, start_year, end_year):
-    fig, axs = plt.subplots(len(results), sharex=True)
+def full_year(year):
+    return year + 2000 if year < 100 else year
+
+
+def production_matrix(results, start_year=None, end_year=None):
+    '''
+    HÅP per course and semester, for all courses at once. The semester of each round
+    is computed once, from its start date, for all rounds together. Start and end
+    year are taken from the rounds, unless given (with two or four digits).
+
+    Returns the course codes, the semesters, like those from generate_semesters,
+    and a matrix with one row per course and one column per semester. Rounds
+    starting outside the period are left out.
+    '''
+    codes = list(results)
+    n_rounds = [len(data['rounds']) for data in results.values()]
+    course = np.repeat(np.arange(len(codes)), n_rounds)
+    rounds = [round_info for data in results.values() for round_info in data['rounds']]
+    hap = np.array([round_info[0] for round_info in rounds], dtype=float)
+    start_dates = np.array([round_info[3] or 'NaT' for round_info in rounds], dtype='datetime64[D]')
+    dated = ~np.isnat(start_dates)
+    years, terms = semester_index(start_dates[dated])
+    if start_year is None or end_year is None:
+        if len(years) == 0:
+            return codes, [], np.zeros((len(codes), 0))
+        start_year = int(years.min()) if start_year is None else start_year
+        end_year = int(years.max()) if end_year is None else end_year
+    start_year, end_year = full_year(start_year), full_year(end_year)
+
+    semesters = semester_labels(start_year, len(TERMS) * (end_year - start_year + 1))
+    column = (years - start_year) * len(TERMS) + terms
+    inside = (column >= 0) & (column < len(semesters))
+    cells = course[dated][inside] * len(semesters) + column[inside]
+    matrix = np.bincount(cells, weights=hap[dated][inside], minlength=len(codes) * len(semesters))
+    return codes, semesters, matrix.reshape(len(codes), len(semesters))
+
+
+def make_bar_diagrams_with_subplots(results, start_year=None, end_year=None):
+    from matplotlib.figure import Figure
+    codes, semesters, matrix = production_matrix(results, start_year, end_year)
+    fig = Figure()
+    axs = np.atleast_1d(fig.subplots(len(codes), sharex=True))
     fig.suptitle('HÅP-produktion')
 
-    subfig_counter = 0
-    for course_code, data in results.items():
-        title = f'{course_code} {data["name"]}'
-        
-        production = dict()
-        for data in data['rounds']:
-            hap, event_code, _, start_date = data
-            semester = year_semester(start_date)
-            if semester in production:
-                production[semester] += hap
-            else:
-                production[semester] = hap
+    for ax, course_code, hap in zip(axs, codes, matrix):
+        ax.bar(semesters, hap)
+        ax.set_title(f'{course_code} {results[course_code]["name"]}', fontsize=10)
+    fig.savefig('tmp.pdf')
 
-        semesters = list(generate_semesters(start_year, end_year))
-        hap = list(map(lambda sem: production.get(sem, 0.0), semesters))
 
-        axs[subfig_counter].bar(semesters, hap)
-        axs[subfig_counter].set_title(title, fontsize=10)
-        subfig_counter += 1
-    plt.savefig('tmp.pdf')
-        
+def plot_digest(title, semesters, hap):
+    '''
+    A digest of everything that goes into a course's plot.
+    '''
+    content = json.dumps([__version__, title, semesters, hap.tolist()])
+    return hashlib.sha256(content.encode()).hexdigest()
 
-def make_bar_diagrams(results, start_year, end_year):
-    subfig_counter = 0
-    for course_code, data in results.items():
-        title = f'{course_code} {data["name"]}'
-        
-        production = dict()
-        for data in data['rounds']:
-            hap, event_code, _, start_date = data
-            semester = year_semester(start_date)
-            if semester in production:
-                production[semester] += hap
-            else:
-                production[semester] = hap
 
-        semesters = list(generate_semesters(start_year, end_year))
-        hap = list(map(lambda sem: production.get(sem, 0.0), semesters))
+def start_plot_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def course_figure(title, semesters, hap):
+    '''
+    Bar diagram of a course's production per semester, as a matplotlib Figure.
+    '''
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
+    ax.bar(semesters, hap)
+    ax.set_title(title)
+    ax.set_xlabel('Termin')
+    ax.set_ylabel('HÅP')
+    return fig
+
 
-        plt.bar(semesters, hap)
-        plt.title(title)
-        plt.xlabel = 'Termin'
-        plt.ylabel = 'HÅP'
+def plot_course(outfile, title, semesters, hap):
+    '''
+    Bar diagram of a course's production per semester, saved in outfile.
+    A figure of its own is used, so that plots can be made in parallel.
+    '''
+    course_figure(title, semesters, hap).savefig(outfile)
+    return outfile
+
+
+def load_manifest():
+    '''
+    The digests of the diagrams last drawn, by filename, from PLOT_MANIFEST.
+    '''
+    if os.path.exists(PLOT_MANIFEST):
+        with open(PLOT_MANIFEST) as h:
+            return json.load(h)
+    return {}
+
+
+def save_manifest(manifest):
+    with open(PLOT_MANIFEST, 'w') as h:
+        json.dump(manifest, h, indent=2)
 
+
+def outdated_diagrams(results, hap_matrix, manifest, force=False):
+    '''
+    The course diagrams whose data has changed since they were drawn, according to
+    manifest, or that are missing: lists of output files, titles and HÅP per semester,
+    and the semesters. The HÅP are given as from production_matrix. The manifest
+    is updated with the new digests. With force, all diagrams are listed.
+    '''
+    codes, semesters, matrix = hap_matrix
+    outfiles, titles, haps = [], [], []
+    for course_code, hap in zip(codes, matrix):
+        title = f'{course_code} {results[course_code]["name"]}'
         outfile = course_code + '.pdf'
-        plt.savefig(outfile)
-        print(f'Saved {outfile}', file=sys.stderr)
-        plt.clf()
-        
+        digest = plot_digest(title, semesters, hap)
+        if force or manifest.get(outfile) != digest or not os.path.exists(outfile):
+            outfiles.append(outfile)
+            titles.append(title)
+            haps.append(hap)
+        manifest[outfile] = digest
+    print(f'Drawing {len(outfiles)} of {len(codes)} diagrams', file=sys.stderr)
+    return outfiles, titles, semesters, haps
+
+
+@profiled('plot production')
+def make_bar_diagrams(results, start_year=None, end_year=None, jobs=1, force=False, hap_matrix=None):
+    '''
+    Save a bar diagram per course, with its production per semester, in <course>.pdf.
+    The years are as for production_matrix, unless its result is given as hap_matrix.
+
+    With jobs > 1, diagrams are drawn in that many processes. A diagram is only
+    redrawn if its data changed since it was last drawn, according to the digests
+    kept in PLOT_MANIFEST, or if force is true.
+    '''
+    if hap_matrix is None:
+        hap_matrix = production_matrix(results, start_year, end_year)
+    manifest = load_manifest()
+    outfiles, titles, semesters, haps = outdated_diagrams(results, hap_matrix, manifest, force)
+
+    if jobs > 1 and len(outfiles) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=start_plot_worker) as pool:
+            saved = pool.map(plot_course, outfiles, titles, repeat(semesters), haps, chunksize=8)
+            for outfile in saved:
+                print(f'Saved {outfile}', file=sys.stderr)
+    else:
+        for outfile in map(plot_course, outfiles, titles, repeat(semesters), haps):
+            print(f'Saved {outfile}', file=sys.stderr)
+
+    save_manifest(manifest)
+
 
 def main():
     args = setup_arguments_parser()
+    start_from_arguments(args)
     explicit_courses = None
     if args.courses:
         explicit_courses = args.courses.split(',')
-    results, metadata = read_production(args.infile, explicit_courses, args.restriction, args.exclude)
-
-    period = metadata['Period']
-    start_year = int(period[2:4])
-    end_year = int(period[9:11])
+    results, metadata = read_production(args.infiles, explicit_courses, args.restriction, args.exclude)
 
     list_course_production(results)
-    make_bar_diagrams(results, start_year, end_year)
+    hap_matrix = production_matrix(results)
+    if args.export:
+        codes, semesters, matrix = hap_matrix
+        columns = {semester: matrix[:, j] for j, semester in enumerate(semesters)}
+        export_table('hap_per_semester', {'Kurskod': codes, 'Kurs': [results[code]['name'] for code in codes], **columns},
+                     export_from_arguments(args))
+    if not args.no_plot:
+        make_bar_diagrams(results, jobs=args.jobs, force=args.force, hap_matrix=hap_matrix)
+    finish_from_arguments(args)
 
 if __name__ == '__main__':
     main()
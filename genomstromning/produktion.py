@@ -1,24 +1,141 @@
+'''
+Helårsprestationer (HÅP) per course and semester, computed from module results.
+
+Every passed module gives its credits divided by 60 to the course, in the semester
+of the exam date: VT up to May, ST in June and July, and HT from August.
+'''
 import argparse
+from collections import namedtuple
+from datetime import date
+import numpy as np
+import sys
 
 from .version import __version__
-import .genomstromning as g
+from .cache import add_cache_arguments, cache_from_arguments
+from .io import read_result_table
+from .export import add_export_arguments, export_from_arguments, export_table
+from .profiling import profiled, add_profile_arguments, start_from_arguments, finish_from_arguments
+
+
+CREDITS_PER_YEAR = 60
+TERMS = ['VT', 'ST', 'HT']
+
+Production = namedtuple('Production', ['courses', 'semesters', 'hap'])
+
+
+def semester_index(dates):
+    '''
+    The year and the term (index into TERMS) of each date in an array of datetime64[D].
+    '''
+    months = dates.astype('datetime64[M]').astype(np.int64)
+    years = months // 12 + 1970
+    months = months % 12 + 1
+    terms = np.where(months < 6, 0, np.where(months < 8, 1, 2))
+    return years, terms
+
+
+def semester_labels(first_year, n_semesters, first_term=0):
+    '''
+    Labels like HT20, VT21, ST21, ... for n_semesters semesters from first_term of first_year.
+    '''
+    return [f'{TERMS[i % 3]}{(first_year + i // 3) % 100:02d}' for i in range(first_term, first_term + n_semesters)]
+
+
+@profiled('production')
+def compute_production(results, courses=None):
+    '''
+    HÅP per course and semester from the results, a ResultTable.
+
+    Returns Production with the course codes, the semester labels (consecutive,
+    from the first to the last semester with any production) and a matrix with
+    one row per course and one column per semester. Results without exam date
+    are not counted. With courses, only those course codes are included, in
+    that order.
+    '''
+    dated = ~np.isnat(results.dates)
+    if courses is not None:
+        wanted = [results.course_ids[code] for code in courses if code in results.course_ids]
+        dated &= np.isin(results.course, wanted)
+    years, terms = semester_index(results.dates[dated])
+    if len(years) == 0:
+        return Production([], [], np.zeros((0, 0)))
+
+    first_year = int(years.min())
+    semesters = (years - first_year) * len(TERMS) + terms
+    n_semesters = int(semesters.max()) + 1
+    n_courses = len(results.course_codes)
+    cells = results.course[dated].astype(np.int64) * n_semesters + semesters
+    hap = np.bincount(cells, weights=results.credits[dated].astype(np.float64) / CREDITS_PER_YEAR, minlength=n_courses * n_semesters)
+    hap = hap.reshape(n_courses, n_semesters)
+
+    if courses is not None:
+        rows = [results.course_ids[code] for code in courses if code in results.course_ids]
+    else:
+        rows = np.flatnonzero(hap.any(axis=1))
+    first_term = int(np.argmax(hap.any(axis=0)))
+    return Production([results.course_codes[i] for i in rows],
+                      semester_labels(first_year, n_semesters - first_term, first_term),
+                      hap[rows][:, first_term:])
+
+
+def sort_courses(production):
+    '''
+    The production with the courses sorted by total production, largest first.
+    '''
+    order = np.argsort(-production.hap.sum(axis=1), kind='stable')
+    return Production([production.courses[i] for i in order], production.semesters, production.hap[order])
+
+
+def at_least(production, min_production):
+    '''
+    The production of the courses that have produced at least min_production HÅP.
+    '''
+    keep = production.hap.sum(axis=1) >= min_production
+    return Production([c for c, k in zip(production.courses, keep) if k], production.semesters, production.hap[keep])
 
 
-def sort_courses(
+def write_production(production, file=sys.stdout):
+    '''
+    Write the production as a semicolon-separated table, a course per line.
+    '''
+    print(';'.join(['"Kurskod"'] + [f'"{s}"' for s in production.semesters] + ['"Totalt"']), file=file)
+    for code, row in zip(production.courses, production.hap.tolist()):
+        print(';'.join([f'"{code}"'] + [f'{hap:.2f}' for hap in row] + [f'{sum(row):.2f}']), file=file)
 
 
 def setup_arg_parser():
+    parser = argparse.ArgumentParser(description='Helårsprestationer (HÅP) per course and semester, computed from module results.')
     parser.add_argument('--version', action='version', version=f'{__version__}')
     parser.add_argument('-c', '--courses', help='List course codes as a comma-separated string. Eg.: "MM2001,DA2004"')
     parser.add_argument('-m', '--min_production', type=float, help='Only output courses that have produced at least this many HÅP')
-    parser.add_argument('results', nargs='+', help='Results file(s)')
+    parser.add_argument('-d', '--date', help='Give a date in ISO format (YYYY-MM-DD) so results after this date are ignored.')
+    parser.add_argument('results', nargs='+', help='Results file(s), result stores made with "genomstromning ingest" or result databases')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of result files to parse in parallel. Default: 1')
+    add_cache_arguments(parser)
+    add_export_arguments(parser)
+    add_profile_arguments(parser)
     return parser.parse_args(sys.argv[1:])
 
 
-def production():
+def main():
     args = setup_arg_parser()
-    results = g.read_course_results(args.results)
-    courses = sort_courses(results)
+    start_from_arguments(args)
+    cutoff_date = date.fromisoformat(args.date) if args.date else date.today()
+    courses = args.courses.split(',') if args.courses else None
 
+    results = read_result_table(args.results, cutoff_date, cache_from_arguments(args), args.jobs)
+    production = compute_production(results, courses)
+    if not courses:
+        production = sort_courses(production)
+    if args.min_production is not None:
+        production = at_least(production, args.min_production)
+    write_production(production)
+    if args.export:
+        columns = {semester: production.hap[:, j] for j, semester in enumerate(production.semesters)}
+        export_table('produktion_per_semester', {'Kurskod': production.courses, **columns, 'Totalt': production.hap.sum(axis=1)},
+                     export_from_arguments(args))
+    finish_from_arguments(args)
 
 
+if __name__ == '__main__':
+    main()
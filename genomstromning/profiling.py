@@ -0,0 +1,131 @@
+'''
+Timing and memory instrumentation of the stages of a run.
+
+Stages are marked with the profiled decorator or the stage context manager.
+Nothing is measured unless profiling has been enabled, typically with --profile,
+so the overhead is a flag check per stage. When enabled, each stage records its
+wall-clock time, the process' peak RSS after the stage and how much the stage
+raised it. Tracing memory (--profile-memory) also gives each stage's own peak of
+allocated memory, Python objects and NumPy arrays, but slows Python-heavy stages
+such as plotting considerably.
+'''
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import json
+import sys
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:             # Not on Windows
+    resource = None
+
+
+enabled = False
+records = []
+_open_stages = []
+
+
+def enable(trace_memory=False):
+    global enabled
+    enabled = True
+    if trace_memory:
+        tracemalloc.start()
+
+
+@contextmanager
+def stage(name):
+    '''
+    Measure the enclosed code as the stage name.
+    '''
+    if not enabled:
+        yield
+        return
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        if _open_stages:        # Keep the enclosing stage's peak before resetting it
+            _open_stages[-1]['peak'] = max(_open_stages[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    frame = {'peak': 0, 'rss': max_rss_mb(), 'start': time.perf_counter()}
+    _open_stages.append(frame)
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - frame['start']
+        rss = max_rss_mb()
+        peak = None
+        if tracing:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        _open_stages.pop()
+        if tracing and _open_stages:
+            _open_stages[-1]['peak'] = max(_open_stages[-1]['peak'], peak)
+        records.append({'stage': name,
+                        'depth': len(_open_stages),
+                        'seconds': seconds,
+                        'max_rss_mb': rss,
+                        'rss_growth_mb': rss - frame['rss'],
+                        'peak_mb': peak / 2**20 if tracing else None})
+
+
+def profiled(name):
+    '''
+    Decorator measuring every call of the function as the stage name.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def max_rss_mb():
+    if resource is None:
+        return 0.0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10  # Bytes on macOS, otherwise kB
+
+
+def report(file=sys.stderr):
+    '''
+    Print a summary of the recorded stages, in the order they finished.
+    '''
+    print(f'{"stage":40} {"seconds":>9} {"max RSS MB":>11} {"growth MB":>10} {"peak MB":>9}', file=file)
+    for record in records:
+        name = '  ' * record['depth'] + record['stage']
+        peak = '-' if record['peak_mb'] is None else f'{record["peak_mb"]:.1f}'
+        print(f'{name:40} {record["seconds"]:9.3f} {record["max_rss_mb"]:11.1f} {record["rss_growth_mb"]:10.1f} {peak:>9}', file=file)
+
+
+def write_trace(filename):
+    '''
+    Write the recorded stages, with the command line and time of the run, as JSON.
+    '''
+    trace = {'command': sys.argv,
+             'finished': datetime.now().isoformat(timespec='seconds'),
+             'stages': records}
+    with open(filename, 'w') as h:
+        json.dump(trace, h, indent=2)
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', action='store_true', help='Print time and memory use per stage to stderr.')
+    parser.add_argument('--profile-memory', action='store_true', help='Also trace the peak memory allocated in each stage. Slow. Implies --profile.')
+    parser.add_argument('--profile-json', metavar='FILE', help='Also write the stage measurements to FILE, as JSON. Implies --profile.')
+
+
+def start_from_arguments(args):
+    if args.profile or args.profile_memory or args.profile_json:
+        enable(args.profile_memory)
+
+
+def finish_from_arguments(args):
+    if not enabled:
+        return
+    report()
+    if args.profile_json:
+        write_trace(args.profile_json)
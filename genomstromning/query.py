@@ -0,0 +1,67 @@
+'''
+The query subcommand: load exports into an SQLite database and query it.
+
+    genomstromning query DB load --students FILE --results FILE...
+    genomstromning query DB module-results MM5012 --after 2023-01-01
+    genomstromning query DB below NMDVK 30
+    genomstromning query DB sql "SELECT ..."
+
+Rows are printed semicolon-separated to stdout.
+'''
+import argparse
+import sys
+
+from . import database
+
+
+def setup_arguments_parser(argv):
+    parser = argparse.ArgumentParser(prog='genomstromning query', description='Load exports into, and query, a result database.')
+    parser.add_argument('database', help='SQLite database file. Created if missing.')
+    actions = parser.add_subparsers(dest='action', required=True)
+
+    load = actions.add_parser('load', help='Load exports into the database.')
+    load.add_argument('--students', nargs='+', default=[], help='Student file(s), "Deltagande kurspaketering".')
+    load.add_argument('--results', nargs='+', default=[], help='Results file(s)')
+    load.add_argument('--merits', nargs='+', default=[], help='NyA merit file(s)')
+    load.add_argument('--production', nargs='+', default=[], help='"Helårsprestationer" file(s)')
+
+    module_results = actions.add_parser('module-results', help='All module results in a course.')
+    module_results.add_argument('course', help='Course code, like MM5012')
+    module_results.add_argument('--after', help='Only results after this date (YYYY-MM-DD).')
+    module_results.add_argument('--before', help='Only results up to this date (YYYY-MM-DD).')
+
+    below = actions.add_parser('below', help='Students in a program with fewer credits than a limit.')
+    below.add_argument('program', help='Program code, like NMDVK')
+    below.add_argument('credits', type=float, help='The limit, in hp')
+    below.add_argument('-d', '--date', help='Ignore results after this date (YYYY-MM-DD).')
+
+    sql = actions.add_parser('sql', help='Run an SQL query.')
+    sql.add_argument('query')
+    return parser.parse_args(argv)
+
+
+def print_rows(rows):
+    for row in rows:
+        print(';'.join('' if value is None else str(value) for value in row))
+
+
+def main(argv):
+    args = setup_arguments_parser(argv)
+    connection = database.connect(args.database)
+    if args.action == 'load':
+        for filename in args.students:
+            program = database.load_students(connection, filename)
+            print(f'{filename}: students in {program}', file=sys.stderr)
+        if args.results:
+            database.load_results(connection, args.results)
+        for filename in args.merits:
+            database.load_merits(connection, filename)
+        for filename in args.production:
+            database.load_production(connection, filename)
+    elif args.action == 'module-results':
+        print_rows(database.module_results(connection, args.course, args.after, args.before))
+    elif args.action == 'below':
+        print_rows(database.students_below(connection, args.program, args.credits, args.date))
+    elif args.action == 'sql':
+        print_rows(connection.execute(args.query))
+    connection.close()
@@ -0,0 +1,388 @@
+'''
+The serve subcommand: a local HTTP server answering report queries from exports
+kept in memory.
+
+    genomstromning serve --students studenter/ --results resultat.csv --merits meriter.csv
+
+The exports are parsed once, and again only when one of the files changes. Answers
+are cached until then, and diagrams are drawn in a pool of worker processes, so
+that matplotlib is loaded once per worker rather than once per request.
+
+Endpoints, all taking date=YYYY-MM-DD to ignore later results:
+  /programs                           the programs and their number of students
+  /totals?program=NMDVK               hp per student
+  /matrix?program=NMDVK               hp per student and course
+  /merits?program=NMDVK               merits and hp per student (needs --merits)
+  /hap?courses=MM2001,DA2004&min=10   HÅP per course and semester, both parameters optional
+  /plot/students.png?program=NMDVK    the diagram per student, also .svg and with bins=20
+  /plot/merits/BI.svg?program=NMDVK   hp against a merit type (BI, BII or HP)
+  /plot/hap/MM2001.png                HÅP per semester in a course
+
+Tables are JSON objects mapping column names to columns, as in the exported tables,
+with null for missing values. The program can be left out if there is only one.
+'''
+import argparse
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from io import BytesIO
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from .cache import add_cache_arguments, cache_from_arguments
+from .database import is_database, read_merits as read_database_merits
+from .io import MERIT_TYPES, read_nya_merits, read_programstudents, read_result_files
+from .main import compute_aggregates, student_bars_figure, student_files
+from .merit import merit_figure
+from .production import course_figure, start_plot_worker
+from .produktion import compute_production, sort_courses, at_least
+
+
+CHECK_INTERVAL = 1.0    # Seconds between checks for changed files
+MAX_TABLES = 8          # Result tables kept, for different cutoff dates
+CONTENT_TYPES = {'json': 'application/json', 'png': 'image/png', 'svg': 'image/svg+xml'}
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+FIGURES = {'students': student_bars_figure, 'merits': merit_figure, 'hap': course_figure}
+
+
+class NotFound(Exception):
+    pass
+
+
+def render(kind, image_format, *args):
+    '''
+    Draw a figure, with the function in FIGURES, and return it as PNG or SVG data.
+    Run in the worker processes.
+    '''
+    buffer = BytesIO()
+    FIGURES[kind](*args).savefig(buffer, format=image_format, dpi=100)
+    return buffer.getvalue()
+
+
+def json_column(column):
+    if isinstance(column, np.ndarray):
+        column = column.tolist()
+    return [None if value != value else value for value in column]     # NaN is not JSON
+
+
+def json_table(columns):
+    return json.dumps({name: json_column(column) for name, column in columns.items()}, ensure_ascii=False).encode()
+
+
+class Exports:
+    '''
+    The parsed exports: the students of each program, all results, and the merits.
+    '''
+    def __init__(self, studentfiles, resultfiles, meritfile=None, cache=None, jobs=1):
+        self.studentfiles = studentfiles
+        self.resultfiles = resultfiles
+        self.meritfile = meritfile
+        self.cache = cache
+        self.jobs = jobs
+        self.signature = None
+        self.generation = 0
+        self.programs = {}
+        self.merits = None
+        self.results = None
+        self.tables = OrderedDict()
+        self.tables_lock = threading.Lock()     # Tables are made in threads, see ReportServer
+
+    def files(self):
+        return self.studentfiles + self.resultfiles + ([self.meritfile] if self.meritfile else [])
+
+    def current_signature(self):
+        '''
+        Size and modification time of every file. A missing file is None.
+        '''
+        signature = []
+        for filename in self.files():
+            try:
+                stat = os.stat(filename)
+                signature.append((stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def changed(self):
+        return self.current_signature() != self.signature
+
+    def load(self):
+        '''
+        Parse all exports. If parsing fails, for instance because a file is being
+        written, the data loaded before is kept, and loading is tried again later.
+        '''
+        signature = self.current_signature()
+        start = time.perf_counter()
+        try:
+            programs = dict(read_programstudents(filename) for filename in self.studentfiles)
+            results = read_result_files(self.resultfiles, self.cache, self.jobs)
+            merits = None
+            if self.meritfile:
+                merits = read_database_merits(self.meritfile) if is_database(self.meritfile) else read_nya_merits(self.meritfile)
+        except Exception:
+            logging.exception('Could not load the exports, keeping the data loaded before')
+            return
+        with self.tables_lock:
+            self.programs, self.results, self.merits = programs, results, merits
+            self.tables.clear()
+        self.signature = signature
+        self.generation += 1
+        logging.info(f'Loaded {len(programs)} programs and {len(results)} results in {time.perf_counter() - start:.1f} s')
+
+    def table(self, cutoff_date):
+        '''
+        The results up to cutoff_date, as with read_result_table.
+        '''
+        with self.tables_lock:
+            table = self.tables.get(cutoff_date)
+            if table is None:
+                table = self.results.until(cutoff_date)
+                self.tables[cutoff_date] = table
+                if len(self.tables) > MAX_TABLES:
+                    self.tables.popitem(last=False)
+            self.tables.move_to_end(cutoff_date)
+            return table
+
+    def students(self, program):
+        if program is None:
+            if len(self.programs) != 1:
+                raise ValueError(f'Give a program, one of {", ".join(self.programs)}')
+            program = next(iter(self.programs))
+        if program not in self.programs:
+            raise NotFound(f'Unknown program {program}')
+        return program, self.programs[program]
+
+
+class ReportServer:
+    '''
+    Answers queries from the exports, caching up to cache_size answers.
+    '''
+    def __init__(self, exports, pool, cache_size=256):
+        self.exports = exports
+        self.pool = pool
+        self.cache_size = cache_size
+        self.answers = OrderedDict()    # (path, query) -> task giving (content type, body)
+        self.loading = asyncio.Lock()
+        self.last_check = 0.0
+
+    async def refresh(self):
+        '''
+        Reload the exports if a file has changed since the last load.
+        '''
+        now = time.monotonic()
+        if now - self.last_check < CHECK_INTERVAL:
+            return
+        self.last_check = now
+        async with self.loading:
+            if self.exports.changed():
+                generation = self.exports.generation
+                await asyncio.to_thread(self.exports.load)
+                if self.exports.generation != generation:
+                    self.answers.clear()
+
+    async def answer(self, path, query):
+        '''
+        The content type and body answering the query, from the cache if possible.
+        Identical queries arriving together share one computation.
+        '''
+        await self.refresh()
+        key = (path, tuple(sorted(query.items())))
+        task = self.answers.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.compute(path, query))
+            self.answers[key] = task
+            if len(self.answers) > self.cache_size:
+                self.answers.popitem(last=False)
+        self.answers.move_to_end(key)
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if self.answers.get(key) is task:
+                del self.answers[key]
+            raise
+
+    async def compute(self, path, query):
+        parts = path.strip('/').split('/')
+        if parts[0] == 'plot' and len(parts) >= 2:
+            name, dot, image_format = parts[-1].rpartition('.')
+            if not dot or image_format not in ('png', 'svg'):
+                raise NotFound(f'Diagrams are drawn as .png or .svg, not {parts[-1]}')
+            kind, args = await asyncio.to_thread(self.figure_arguments, parts[1:-1] + [name], query, image_format)
+            body = await asyncio.get_running_loop().run_in_executor(self.pool, render, kind, image_format, *args)
+            return CONTENT_TYPES[image_format], body
+        if len(parts) == 1 and parts[0] in TABLES:
+            body = await asyncio.to_thread(lambda: json_table(TABLES[parts[0]](self, query)))
+            return CONTENT_TYPES['json'], body
+        if parts == ['programs']:
+            programs = {program: len(students) for program, students in self.exports.programs.items()}
+            return CONTENT_TYPES['json'], json.dumps(programs).encode()
+        raise NotFound(f'No such report: {path}')
+
+    def query_table(self, query):
+        cutoff_date = date.fromisoformat(query['date']) if 'date' in query else date.today()
+        return self.exports.table(cutoff_date)
+
+    def aggregates(self, query):
+        program, students = self.exports.students(query.get('program'))
+        return program, students, compute_aggregates(students, self.query_table(query))
+
+    def totals(self, query):
+        _, students, aggregates = self.aggregates(query)
+        return {'Personnummer': list(students), 'hp': aggregates.student_totals}
+
+    def matrix(self, query):
+        _, students, aggregates = self.aggregates(query)
+        return {'Personnummer': list(students), **{code: aggregates.matrix[:, j] for j, code in enumerate(aggregates.codes)}}
+
+    def merit_join(self, query):
+        if self.exports.merits is None:
+            raise NotFound('No merit file given')
+        _, students, aggregates = self.aggregates(query)
+        merit_values = self.exports.merits.take(students)
+        return {'Personnummer': list(students), **{t: merit_values[:, j] for j, t in enumerate(MERIT_TYPES)},
+                'hp': aggregates.student_totals}
+
+    def production(self, query):
+        courses = query['courses'].split(',') if 'courses' in query else None
+        production = compute_production(self.query_table(query), courses)
+        if not courses:
+            production = sort_courses(production)
+        if 'min' in query:
+            production = at_least(production, float(query['min']))
+        return production
+
+    def hap(self, query):
+        production = self.production(query)
+        columns = {semester: production.hap[:, j] for j, semester in enumerate(production.semesters)}
+        return {'Kurskod': production.courses, **columns, 'Totalt': production.hap.sum(axis=1)}
+
+    def figure_arguments(self, parts, query, image_format):
+        '''
+        The kind of figure (a key in FIGURES) and the arguments for drawing it.
+        '''
+        if parts == ['students']:
+            program, _, aggregates = self.aggregates(query)
+            bins = int(query['bins']) if 'bins' in query else None
+            return 'students', (aggregates, program, bins, False, image_format == 'png')
+        if len(parts) == 2 and parts[0] == 'merits' and parts[1] in MERIT_TYPES:
+            columns = self.merit_join(query)
+            x, y = columns[parts[1]], columns['hp']
+            known = ~np.isnan(x)
+            program, _ = self.exports.students(query.get('program'))
+            return 'merits', (x[known], y[known], f'{program} {parts[1]}')
+        if len(parts) == 2 and parts[0] == 'hap':
+            production = compute_production(self.query_table(query), [parts[1]])
+            if not production.courses:
+                raise NotFound(f'No production in {parts[1]}')
+            return 'hap', (parts[1], production.semesters, production.hap[0])
+        raise NotFound(f'No such diagram: {"/".join(parts)}')
+
+    async def handle(self, reader, writer):
+        '''
+        Serve the requests of a connection, keeping it open between requests
+        unless the client asks otherwise.
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.send(writer, 400, 'text/plain', b'Malformed request', keep_alive=False)
+                    break
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                status, content_type, body = await self.respond(method, target)
+                await self.send(writer, status, content_type, body if method != 'HEAD' else b'',
+                                keep_alive, len(body))
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target):
+        if method not in ('GET', 'HEAD'):
+            return 405, 'text/plain', b'Only GET and HEAD'
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        start = time.perf_counter()
+        try:
+            content_type, body = await self.answer(url.path, query)
+            status = 200
+        except NotFound as e:
+            status, content_type, body = 404, 'text/plain', str(e).encode()
+        except ValueError as e:
+            status, content_type, body = 400, 'text/plain', str(e).encode()
+        except Exception:
+            logging.exception(f'Failed to answer {target}')
+            status, content_type, body = 500, 'text/plain', b'Internal error, see the server log'
+        logging.info(f'{method} {target} {status} {1000 * (time.perf_counter() - start):.1f} ms')
+        return status, content_type, body
+
+    async def send(self, writer, status, content_type, body, keep_alive=True, length=None):
+        head = (f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Length: {len(body) if length is None else length}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+TABLES = {'totals': ReportServer.totals, 'matrix': ReportServer.matrix,
+          'merits': ReportServer.merit_join, 'hap': ReportServer.hap}
+
+
+async def serve(exports, host, port, jobs, cache_size):
+    with ProcessPoolExecutor(max_workers=jobs, initializer=start_plot_worker) as pool:
+        for _ in range(jobs):
+            pool.submit(time.sleep, 0)     # Start the workers now
+        server = ReportServer(exports, pool, cache_size)
+        async with await asyncio.start_server(server.handle, host, port) as listener:
+            print(f'Serving on http://{host}:{port}/', file=sys.stderr)
+            await listener.serve_forever()
+
+
+def setup_arguments_parser(argv):
+    parser = argparse.ArgumentParser(prog='genomstromning serve',
+                                     description='Serve reports over HTTP on localhost, keeping the parsed exports in memory.')
+    parser.add_argument('--students', required=True, help='Student file, a directory of student files, or several student files separated by commas.')
+    parser.add_argument('--results', nargs='+', required=True, help='Results file(s), result stores made with "genomstromning ingest" or result databases')
+    parser.add_argument('--merits', help='File with "meritvärden", as exported from NyA, or a result database.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Default: 127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8050, help='Port to listen on. Default: 8050')
+    parser.add_argument('-j', '--jobs', type=int, default=2, help='Number of worker processes drawing diagrams and parsing result files. Default: 2')
+    parser.add_argument('--max-answers', type=int, default=256, help='Number of answers to keep in memory. Default: 256')
+    add_cache_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = setup_arguments_parser(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    exports = Exports(student_files(args.students), args.results, args.merits, cache_from_arguments(args), args.jobs)
+    exports.load()
+    if exports.results is None:
+        sys.exit('Could not load the exports')
+    try:
+        asyncio.run(serve(exports, args.host, args.port, args.jobs, args.max_answers))
+    except KeyboardInterrupt:
+        pass
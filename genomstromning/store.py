@@ -0,0 +1,167 @@
+'''
+A persistent result store that grows by appending new exports.
+
+A store is a directory of segments, each a saved ResultTable, and a manifest
+listing the segments and the exports they came from. Adding an export only
+writes a segment with the rows that are new or changed. Each segment also keeps
+a sorted index of its rows' keys, a hash of (personnummer, course, module, date),
+with their credits. An export is compared with the stored results through these
+indexes alone, which are memory mapped and binary searched, so the cost of an
+ingestion is proportional to the new data, not to the whole archive. Loading
+concatenates the segments and keeps the most recent row for each key.
+
+As in the tables, only passed module results are kept, so a result that is
+later changed to a failing grade stays in the store.
+'''
+from datetime import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .table import ResultTable
+
+
+MANIFEST = 'manifest.json'
+KEYS = 'keys.npy'                   # In each segment: the sorted keys of its rows
+KEY_CREDITS = 'key_credits.npy'     # and their credits, in the same order
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def read_manifest(directory):
+    if not is_store(directory):
+        return {'segments': [], 'sources': []}
+    with open(os.path.join(directory, MANIFEST)) as h:
+        return json.load(h)
+
+
+def write_manifest(directory, manifest):
+    tmp = os.path.join(directory, MANIFEST + '.tmp')
+    with open(tmp, 'w') as h:
+        json.dump(manifest, h, indent=2)
+    os.replace(tmp, os.path.join(directory, MANIFEST))
+
+
+def row_groups(table):
+    '''
+    Number the distinct (student, course, module, date) of the table's rows.
+    Returns one group number per row.
+    '''
+    columns = np.stack([table.student, table.course, table.module, table.dates.view(np.int64)], axis=1)
+    _, groups = np.unique(columns, axis=0, return_inverse=True)
+    return groups.ravel()
+
+
+def mix(x):
+    '''
+    The splitmix64 finaliser, on an array of uint64.
+    '''
+    x = (x ^ (x >> 30)) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> 27)) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> 31)
+
+
+def code_hashes(codes):
+    return np.array([int.from_bytes(hashlib.blake2b(code.encode(), digest_size=8).digest(), 'little')
+                     for code in codes], dtype=np.uint64)
+
+
+def row_keys(table):
+    '''
+    A 64-bit hash of each row's (personnummer, course, module, date), the same in
+    every table whatever its code tables. Only the table's codes are hashed one by one.
+    '''
+    key = mix(code_hashes(table.student_codes)[table.student])
+    key = mix(key ^ code_hashes(table.course_codes)[table.course])
+    key = mix(key ^ code_hashes(table.module_codes)[table.module])
+    return mix(key ^ table.dates.view(np.int64).astype(np.uint64))
+
+
+def save_segment(directory, name, table, keys):
+    '''
+    Save the table as a segment, with the index of its keys, which must be distinct.
+    '''
+    path = os.path.join(directory, name)
+    table.save(path)
+    order = np.argsort(keys)
+    np.save(os.path.join(path, KEYS), keys[order])
+    np.save(os.path.join(path, KEY_CREDITS), table.credits[order])
+
+
+def stored_credits(directory, segments, keys):
+    '''
+    The stored credits for each key, from the latest segment that has it, or NaN
+    for keys not in the store. Only the key indexes are searched.
+    '''
+    credits = np.full(len(keys), np.nan)
+    missing = np.arange(len(keys))
+    for name in reversed(segments):
+        if not len(missing):
+            break
+        segment_keys = np.load(os.path.join(directory, name, KEYS), mmap_mode='r')
+        if not len(segment_keys):
+            continue
+        at = np.minimum(np.searchsorted(segment_keys, keys[missing]), len(segment_keys) - 1)
+        found = segment_keys[at] == keys[missing]
+        segment_credits = np.load(os.path.join(directory, name, KEY_CREDITS), mmap_mode='r')
+        credits[missing[found]] = segment_credits[at[found]]
+        missing = missing[~found]
+    return credits
+
+
+def load_store(directory):
+    '''
+    Return the stored results as one ResultTable, with updated rows replacing older ones.
+    '''
+    manifest = read_manifest(directory)
+    segments = [ResultTable.load(os.path.join(directory, name)) for name in manifest['segments']]
+    table = ResultTable.concatenate(segments)
+    if len(segments) > 1:
+        groups = row_groups(table)
+        _, first_in_reversed = np.unique(groups[::-1], return_index=True)
+        table = table.take(np.sort(len(groups) - 1 - first_in_reversed))
+    return table
+
+
+def add_to_store(directory, table, source, digest):
+    '''
+    Add the rows of table, parsed from the export source with content hash digest,
+    to the store in directory, which is created if needed.
+
+    Rows whose (personnummer, course, module, date) is already stored with the same
+    credits are skipped, and rows with other credits are stored as updates. An export
+    that has already been added, judging by its hash, is skipped altogether.
+    Returns the number of added, updated and skipped rows.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    if any(s['sha256'] == digest for s in manifest['sources']):
+        return 0, 0, len(table)
+
+    # Within the new export, the last row for a key counts
+    keys = row_keys(table)
+    _, first_in_reversed = np.unique(keys[::-1], return_index=True)
+    latest = np.sort(len(keys) - 1 - first_in_reversed)
+    keys = keys[latest]
+
+    old = stored_credits(directory, manifest['segments'], keys)
+    added = np.isnan(old)
+    updated = ~added & (old != table.credits[latest])
+
+    changed = added | updated
+    delta = table.take(latest[changed])
+    if len(delta):
+        name = f'{len(manifest["segments"]) + 1:05d}'
+        save_segment(directory, name, delta, keys[changed])
+        manifest['segments'].append(name)
+    manifest['sources'].append({'file': os.path.abspath(source),
+                                'sha256': digest,
+                                'ingested': datetime.now().isoformat(timespec='seconds'),
+                                'rows': len(delta)})
+    write_manifest(directory, manifest)
+    n_added, n_updated = int(added.sum()), int(updated.sum())
+    return n_added, n_updated, len(table) - n_added - n_updated
@@ -0,0 +1,245 @@
+'''
+Columnar storage of course results.
+
+Instead of nested dicts (personnummer -> course -> module -> credits), results are
+kept as parallel NumPy arrays with one element per passed module. Codes are
+stored once, in code tables, and the arrays refer to them by integer id.
+'''
+from array import array
+from collections.abc import Mapping
+import json
+import os
+import numpy as np
+from .profiling import profiled
+
+
+NO_DATE = np.iinfo(np.int64).min  # The integer value of NaT
+EPOCH_ORDINAL = 719163            # date(1970, 1, 1).toordinal()
+COLUMNS = ['student', 'course', 'module', 'credits', 'dates']
+CREDIT_DECIMALS = 3               # Credits are given with at most this many decimals
+
+
+class ResultTable:
+    '''
+    Passed module results as columns.
+
+    student, course and module are integer ids. The code with id i is
+    student_codes[i] (and likewise for courses and modules), while the dicts
+    student_ids, course_ids and module_ids map codes back to ids.
+    '''
+    def __init__(self, student_codes, course_codes, module_codes, student, course, module, credits, dates):
+        self.student_codes = student_codes
+        self.course_codes = course_codes
+        self.module_codes = module_codes
+        self.student_ids = {code: i for i, code in enumerate(student_codes)}
+        self.course_ids = {code: i for i, code in enumerate(course_codes)}
+        self.module_ids = {code: i for i, code in enumerate(module_codes)}
+        self.student = student
+        self.course = course
+        self.module = module
+        self.credits = credits
+        self.dates = dates
+
+    def __len__(self):
+        return len(self.credits)
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        Build a table from (pnr, kurskod, modulkod, poäng, datum) tuples.
+        The datum is a date, or None if unknown.
+        '''
+        student_ids, course_ids, module_ids = {}, {}, {}
+        student, course, module = array('i'), array('i'), array('i')
+        credits, dates = array('d'), array('q')
+        for pnr, kurskod, modulkod, poang, res_date in rows:
+            student.append(student_ids.setdefault(pnr, len(student_ids)))
+            course.append(course_ids.setdefault(kurskod, len(course_ids)))
+            module.append(module_ids.setdefault(modulkod, len(module_ids)))
+            credits.append(poang)
+            dates.append(res_date.toordinal() - EPOCH_ORDINAL if res_date else NO_DATE)
+        return cls(list(student_ids), list(course_ids), list(module_ids),
+                   np.frombuffer(student, dtype=np.int32),
+                   np.frombuffer(course, dtype=np.int32),
+                   np.frombuffer(module, dtype=np.int32),
+                   np.frombuffer(credits, dtype=np.float64),
+                   np.frombuffer(dates, dtype=np.int64).view('datetime64[D]'))
+
+    @classmethod
+    def concatenate(cls, tables):
+        '''
+        Join tables into one, in the given order. Code tables are merged, so ids
+        are renumbered in order of first appearance.
+        '''
+        student_ids, course_ids, module_ids = {}, {}, {}
+        columns = {name: [] for name in COLUMNS}
+        for table in tables:
+            for name, codes, ids in [('student', table.student_codes, student_ids),
+                                     ('course', table.course_codes, course_ids),
+                                     ('module', table.module_codes, module_ids)]:
+                renumber = np.array([ids.setdefault(code, len(ids)) for code in codes], dtype=np.int32)
+                columns[name].append(renumber[getattr(table, name)])
+            columns['credits'].append(table.credits)
+            columns['dates'].append(table.dates)
+        if not tables:
+            return cls.from_rows([])
+        return cls(list(student_ids), list(course_ids), list(module_ids),
+                   *[np.concatenate(columns[name]) for name in COLUMNS])
+
+    def save(self, directory):
+        '''
+        Store the table in a directory, one .npy file per column and the code tables in JSON.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        for name in COLUMNS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'codes.json'), 'w') as h:
+            json.dump([self.student_codes, self.course_codes, self.module_codes], h)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        '''
+        Load a table stored with save(). With mmap, the columns are memory mapped
+        rather than read.
+        '''
+        with open(os.path.join(directory, 'codes.json')) as h:
+            student_codes, course_codes, module_codes = json.load(h)
+        mmap_mode = 'r' if mmap else None
+        columns = [np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in COLUMNS]
+        return cls(student_codes, course_codes, module_codes, *columns)
+
+    def rows(self):
+        '''
+        Generate the rows as (pnr, kurskod, modulkod, poäng, datum) tuples, like from_rows takes.
+        '''
+        dates = self.dates.astype(object)  # datetime.date, or None for NaT
+        for s, c, m, credits, res_date in zip(self.student.tolist(), self.course.tolist(), self.module.tolist(),
+                                              self.credits.tolist(), dates):
+            yield self.student_codes[s], self.course_codes[c], self.module_codes[m], credits, res_date
+
+    def take(self, rows):
+        '''
+        Return a new table with the given rows (an index array or boolean mask).
+        The code tables are shared with this table.
+        '''
+        return ResultTable(self.student_codes, self.course_codes, self.module_codes,
+                           self.student[rows], self.course[rows], self.module[rows],
+                           self.credits[rows], self.dates[rows])
+
+    def with_students(self, students):
+        '''
+        Return the table with the personnummer in students added to its student
+        code table, even those without rows. The students come first, in the given
+        order, followed by any others of the table.
+        '''
+        codes = list(dict.fromkeys([*students, *self.student_codes]))
+        ids = {code: i for i, code in enumerate(codes)}
+        renumber = np.array([ids[code] for code in self.student_codes], dtype=np.int32)
+        return ResultTable(codes, self.course_codes, self.module_codes,
+                           renumber[self.student], self.course, self.module, self.credits, self.dates)
+
+    @profiled('cutoff')
+    def until(self, cutoff_date):
+        '''
+        Return the results up to and including cutoff_date. Results without a date are kept.
+
+        As with the nested dicts, a module passed more than once is only counted once,
+        using the last occurrence.
+        '''
+        table = self
+        if cutoff_date is not None:
+            table = self.take(~(self.dates > np.datetime64(cutoff_date, 'D')))
+        return table.take(table.last_occurrences())
+
+    def last_occurrences(self):
+        '''
+        Indices of the last row for each (student, course, module), in row order.
+        '''
+        key = self.module_keys()
+        _, first_in_reversed = np.unique(key[::-1], return_index=True)
+        return np.sort(len(key) - 1 - first_in_reversed)
+
+    def first_passed(self):
+        '''
+        Return a table, sorted by date, with only the first time each module was passed.
+        Results without a date are placed last.
+        '''
+        table = self.take(np.argsort(self.dates, kind='stable'))
+        _, first = np.unique(table.module_keys(), return_index=True)
+        return table.take(np.sort(first))
+
+    def module_keys(self):
+        '''
+        A single integer per row identifying its (student, course, module).
+        '''
+        key = self.student.astype(np.int64) * len(self.course_codes) + self.course
+        return key * len(self.module_codes) + self.module
+
+    def student_rows(self, students):
+        '''
+        For each row, the position of its student in the iterable students, or -1
+        for results belonging to students not in students.
+        '''
+        lookup = np.full(len(self.student_codes), -1, dtype=np.intp)
+        for i, pnr in enumerate(students):
+            student_id = self.student_ids.get(pnr)
+            if student_id is not None:
+                lookup[student_id] = i
+        return lookup[self.student]
+
+
+def round_credits(credits):
+    '''
+    Sums of credits rounded to the precision of the credits, so that 1,1 + 2,3 hp
+    is 3.4 rather than 3.4000000000000004.
+    '''
+    return np.round(credits, CREDIT_DECIMALS)
+
+
+class ResultView(Mapping):
+    '''
+    Read-only view of a ResultTable as nested mappings: personnummer -> course code ->
+    module code -> credits. A student's courses are looked up as needed, so only the
+    arrays of the table are kept in memory. Every student in the code table is a key,
+    so a student seen in the export without passed results maps to an empty dict.
+    '''
+    def __init__(self, table):
+        order = np.lexsort((table.module, table.course, table.student))
+        self.table = table.take(order)
+        self.starts = np.searchsorted(self.table.student, np.arange(len(table.student_codes) + 1))
+
+    def __getitem__(self, pnr):
+        student_id = self.table.student_ids[pnr]
+        start, end = self.starts[student_id], self.starts[student_id + 1]
+        courses = {}
+        table = self.table
+        for c, m, credits in zip(table.course[start:end].tolist(), table.module[start:end].tolist(),
+                                 table.credits[start:end].tolist()):
+            courses.setdefault(table.course_codes[c], {})[table.module_codes[m]] = credits
+        return courses
+
+    def __iter__(self):
+        return iter(self.table.student_codes)
+
+    def __len__(self):
+        return len(self.table.student_codes)
+
+    def __contains__(self, pnr):
+        return pnr in self.table.student_ids
+
+
+def as_result_table(results):
+    '''
+    The results as a ResultTable. They can also be given as a ResultView, from
+    read_course_results, or as nested mappings personnummer -> course code ->
+    module code -> credits, as the results were kept before.
+    '''
+    if isinstance(results, ResultTable):
+        return results
+    if isinstance(results, ResultView):
+        return results.table
+    table = ResultTable.from_rows((pnr, course, module, credits, None)
+                                  for pnr, courses in results.items()
+                                  for course, modules in courses.items()
+                                  for module, credits in modules.items())
+    return table.with_students(results)
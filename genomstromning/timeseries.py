@@ -0,0 +1,139 @@
+'''
+Credits at many cutoff dates, computed in one pass over the results.
+
+The results are sorted by exam date once. Each result is then placed in the
+bin of the first cutoff it counts for, and prefix sums over the bins give the
+cumulative credits at every cutoff.
+'''
+import argparse
+import calendar
+from datetime import date, timedelta
+import numpy as np
+from .profiling import profiled
+from .table import round_credits
+
+
+STEPS = {'week': 7}
+TERM_ENDS = [(5, 31), (7, 31), (12, 31)]  # Last days of VT, ST and HT, as in production.year_semester
+
+
+def parse_cutoff_dates(spec):
+    '''
+    Interpret a --dates argument. Either a comma-separated list of ISO dates,
+    or a range START:END:STEP, where STEP is a number of days, "week", "month" or "term".
+    '''
+    if ':' not in spec:
+        return sorted(date.fromisoformat(d) for d in spec.split(','))
+
+    start, end, step = spec.split(':')
+    start = date.fromisoformat(start)
+    end = date.fromisoformat(end)
+    if step == 'month':
+        return list(monthly(start, end))
+    elif step == 'term':
+        return [d for year in range(start.year, end.year + 1)
+                for d in (date(year, month, day) for month, day in TERM_ENDS)
+                if start <= d <= end]
+    else:
+        days = STEPS.get(step) or int(step)
+        if days < 1:
+            raise ValueError(f'the step must be at least 1 day, not {days}')
+        return [start + timedelta(days=i) for i in range(0, (end - start).days + 1, days)]
+
+
+def cutoff_dates_argument(spec):
+    '''
+    Argument type for --dates: the cutoff dates, or an error for argparse to report.
+    '''
+    try:
+        return parse_cutoff_dates(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f'{spec!r}: {e}')
+
+
+def monthly(start, end):
+    '''
+    Generate the same day of the month as start, for every month up to end.
+    Days that do not exist in a month, like 31, are moved to the last day of that month.
+    '''
+    year, month = start.year, start.month
+    while True:
+        day = min(start.day, calendar.monthrange(year, month)[1])
+        d = date(year, month, day)
+        if d > end:
+            return
+        yield d
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+@profiled('credits over time')
+def credits_over_time(students, results, cutoffs):
+    '''
+    Cumulative credits per student and per course at each of the sorted cutoff dates.
+
+    The results are a ResultTable, including results after the last cutoff.
+    Returns a matrix of credits per cutoff (rows) and student (columns, in the order
+    of students), the course codes with credits, sorted by their final total, and a
+    matrix of credits per cutoff and course. Only results of the given students count.
+    '''
+    table = results.first_passed()
+    cutoffs = np.array(cutoffs, dtype='datetime64[D]')
+    n_cutoffs = len(cutoffs)
+    bins = np.searchsorted(cutoffs, table.dates, side='left')
+    bins[np.isnat(table.dates)] = 0      # Results without a date always count
+
+    rows = table.student_rows(students)
+    mine = (rows >= 0) & (bins < n_cutoffs)
+    credits = table.credits[mine]
+
+    n_students = len(students)
+    student_credits = np.bincount(bins[mine] * n_students + rows[mine], weights=credits,
+                                  minlength=n_cutoffs * n_students)
+    student_credits = round_credits(student_credits.reshape(n_cutoffs, n_students).cumsum(axis=0))
+
+    n_courses = len(table.course_codes)
+    course_credits = np.bincount(bins[mine] * n_courses + table.course[mine], weights=credits,
+                                 minlength=n_cutoffs * n_courses)
+    course_credits = round_credits(course_credits.reshape(n_cutoffs, n_courses).cumsum(axis=0))
+    if n_cutoffs == 0:
+        return student_credits, [], course_credits
+
+    sorted_ids = np.argsort(-course_credits[-1], kind='stable')
+    sorted_ids = sorted_ids[course_credits[-1, sorted_ids] > 0]
+    codes = [table.course_codes[i] for i in sorted_ids]
+    return student_credits, codes, course_credits[:, sorted_ids]
+
+
+@profiled('write credits over time')
+def write_credits_over_time(filename, cutoffs, students, student_credits, codes, course_credits):
+    '''
+    Write credits at each cutoff to a semicolon-separated file, one line per
+    date and student, and one line per date and course.
+    '''
+    with open(filename, 'w') as h:
+        print('"Datum";"Typ";"Kod";"hp"', file=h)
+        for i, cutoff in enumerate(cutoffs):
+            for pnr, credits in zip(students, student_credits[i].tolist()):
+                print(f'"{cutoff}";"student";"{pnr}";{credits:g}', file=h)
+            for code, credits in zip(codes, course_credits[i].tolist()):
+                print(f'"{cutoff}";"kurs";"{code}";{credits:g}', file=h)
+
+
+@profiled('plot credits over time')
+def plot_credits_over_time(filename, cutoffs, student_credits, title):
+    '''
+    Plot the median and quartiles of the students' credits at each cutoff.
+    '''
+    import matplotlib.pyplot as plt
+    q1, median, q3 = np.percentile(student_credits, [25, 50, 75], axis=1)
+    plt.clf()
+    fig, ax = plt.subplots(layout='constrained')
+    ax.fill_between(cutoffs, q1, q3, alpha=0.3, label='kvartiler')
+    ax.plot(cutoffs, median, label='median')
+    ax.plot(cutoffs, student_credits.mean(axis=1), '--', label='medel')
+    ax.legend(loc='upper left')
+    fig.autofmt_xdate()
+    plt.xlabel('datum')
+    plt.ylabel('hp')
+    plt.title(f'{title}: hp över tid')
+    plt.savefig(filename)
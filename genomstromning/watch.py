@@ -0,0 +1,296 @@
+'''
+The watch subcommand: keep the reports on a directory of exports up to date.
+
+    genomstromning watch EXPORTS
+
+The directory is polled for student files, result files, NyA merit files and HÅP
+reports, as CSV files or Excel workbooks, recognised by their headers. Once files
+have changed and then stayed the same for a few seconds (while they are copied),
+only the changed files are parsed again, and only the reports that depend on them
+are made again, in parallel:
+
+  <program>_per_student.pdf    depends on the student file and the results of its students,
+  <program>_merit_*            also on the merit files,
+  <course>.pdf                 on the HÅP reports, read together.
+
+A diagram whose data is the same as when it was last drawn, according to the
+manifest shared with genomstromning.production, is not drawn again. The reports
+are written in the current directory.
+'''
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import hashlib
+from itertools import islice
+import json
+import numpy as np
+import os
+import sys
+import time
+
+from .version import __version__
+from .cache import add_cache_arguments, cache_from_arguments
+from .io import MERIT_TYPES, iter_tables, read_nya_merits, read_programstudents, read_result_file, scan_merits
+from .main import compute_aggregates, create_student_bars
+from .merit import merit_statistics, write_merit_statistics, plot_merits, positive_int
+from .production import (read_production, production_matrix, outdated_diagrams, plot_course,
+                         load_manifest, save_manifest, start_plot_worker)
+from .table import ResultTable
+
+
+KINDS = ('students', 'results', 'merits', 'production')
+HEADER_ROWS = 20    # Rows to look through for the header of an export
+
+Input = namedtuple('Input', ['signature', 'kind', 'data'])
+
+
+def export_kind(filename):
+    '''
+    What kind of export the file is, one of KINDS, or None if it is not an export.
+    '''
+    tables = iter_tables(filename)
+    try:
+        for rows in tables:
+            for fields in islice(rows, HEADER_ROWS):
+                first = fields[0].strip('"') if fields else ''
+                if first == 'Kurskod':
+                    return 'production'
+                if first.startswith('Personnummer'):
+                    header = [field.strip('"') for field in fields]
+                    return 'students' if 'Kod (Kurspaketering)' in header else 'results'
+                if first[:6].isdigit() and len(scan_merits(';'.join(fields).encode())[1]):
+                    return 'merits'         # NyA files have no header, but merits after a personnummer
+            return None
+    except Exception:       # Not readable as CSV or as a workbook
+        return None
+    finally:
+        tables.close()
+
+
+def read_export(kind, filename):
+    if kind == 'students':
+        return read_programstudents(filename)
+    if kind == 'merits':
+        return read_nya_merits(filename)
+    # HÅP reports are read together, in Watcher.rebuild, so that overlaps count once
+
+
+def table_students(table):
+    return {table.student_codes[i] for i in np.unique(table.student).tolist()}
+
+
+def data_digest(*parts):
+    '''
+    A digest of the data of a report: strings, lists and numpy arrays.
+    '''
+    digest = hashlib.sha256(__version__.encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part, dtype=np.float64).tobytes())
+        else:
+            digest.update(json.dumps(part).encode())
+    return digest.hexdigest()
+
+
+def merit_report(prefix, credits, merit_values, n_resamples, seed):
+    '''
+    Merit statistics and plots, as made by merits. Run in the worker processes.
+    '''
+    stats = merit_statistics(credits, merit_values, n_resamples, seed=seed)
+    with open(os.devnull, 'w') as quiet:
+        write_merit_statistics(prefix, stats, file=quiet)
+    plot_merits(credits, merit_values, prefix, stats)
+    return prefix
+
+
+def student_report(aggregates, title, image_format):
+    create_student_bars(aggregates, title, image_format=image_format)
+    return f'{title}_per_student.{image_format}'
+
+
+class Watcher:
+    '''
+    The parsed exports of a directory, and the reports made from them.
+    '''
+    def __init__(self, directory, pool, cache=None, image_format='pdf', n_resamples=1000, seed=None):
+        self.directory = directory
+        self.pool = pool
+        self.cache = cache
+        self.image_format = image_format
+        self.n_resamples = n_resamples
+        self.seed = seed
+        self.inputs = {}        # Filename -> Input
+        self.results = None
+        self.manifest = load_manifest()
+
+    def scan(self):
+        '''
+        Size and modification time of each file in the directory.
+        '''
+        snapshot = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def up_to_date(self, snapshot):
+        return snapshot == {filename: given.signature for filename, given in self.inputs.items()}
+
+    def files(self, kind):
+        return sorted(filename for filename, given in self.inputs.items() if given.kind == kind)
+
+    def update(self, snapshot):
+        '''
+        Parse the new and changed files. Returns the changed files of each kind and
+        the personnummer of the students whose results may have changed.
+        '''
+        changed = {kind: set() for kind in KINDS}
+        touched = set()
+        for filename in set(self.inputs) - set(snapshot):
+            removed = self.inputs.pop(filename)
+            if removed.kind:
+                changed[removed.kind].add(filename)
+            if removed.kind == 'results':
+                touched |= table_students(removed.data)
+
+        new = {filename: signature for filename, signature in snapshot.items()
+               if filename not in self.inputs or self.inputs[filename].signature != signature}
+        kinds = {filename: export_kind(filename) for filename in new}
+        result_files = [filename for filename in new if kinds[filename] == 'results']
+        parsing = {filename: self.pool.submit(read_result_file, filename, self.cache) for filename in result_files}
+        for filename, signature in new.items():
+            kind = kinds[filename]
+            old = self.inputs.get(filename)
+            try:
+                data = parsing[filename].result() if kind == 'results' else read_export(kind, filename)
+            except Exception as e:
+                print(f'Could not read {filename}: {e}', file=sys.stderr)
+                kind, data = None, None
+            self.inputs[filename] = Input(signature, kind, data)
+            for given in (old, self.inputs[filename]):
+                if given and given.kind:
+                    changed[given.kind].add(filename)
+                if given and given.kind == 'results':
+                    touched |= table_students(given.data)
+        return changed, touched
+
+    def merit_values(self, students):
+        '''
+        The merits of the students, from the merit files. A later file, by name,
+        takes precedence.
+        '''
+        merit_values = np.full((len(students), len(MERIT_TYPES)), np.nan)
+        for filename in self.files('merits'):
+            values = self.inputs[filename].data.take(students)
+            known = ~np.isnan(values).all(axis=1)
+            merit_values[known] = values[known]
+        return merit_values
+
+    def outdated(self, outfile, digest, exists=None):
+        '''
+        Whether the report in outfile must be made again. The digest is noted as drawn.
+        '''
+        outdated = self.manifest.get(outfile) != digest or not os.path.exists(exists or outfile)
+        self.manifest[outfile] = digest
+        return outdated
+
+    def rebuild(self, snapshot):
+        '''
+        Parse what has changed in the directory, and make the reports depending on it.
+        '''
+        start = time.perf_counter()
+        changed, touched = self.update(snapshot)
+        if changed['results']:
+            tables = [self.inputs[filename].data for filename in self.files('results')]
+            self.results = ResultTable.concatenate(tables).until(date.today()) if tables else None
+
+        jobs = []   # Futures of the reports being made, with their outfiles
+        for filename in self.files('students'):
+            program, students = self.inputs[filename].data
+            if self.results is None:
+                continue
+            affected = filename in changed['students'] or not touched.isdisjoint(students)
+            if not affected and not changed['merits']:
+                continue
+            aggregates = compute_aggregates(students, self.results)
+            if affected:
+                outfile = f'{program}_per_student.{self.image_format}'
+                if self.outdated(outfile, data_digest(aggregates.codes, aggregates.matrix)):
+                    jobs.append((self.pool.submit(student_report, aggregates, program, self.image_format), outfile))
+            if self.files('merits'):
+                prefix = f'{program}_merit'
+                merit_values = self.merit_values(students)
+                digest = data_digest(aggregates.student_totals, merit_values, self.n_resamples, self.seed)
+                if self.outdated(prefix, digest, prefix + '_merit_stats.csv'):
+                    jobs.append((self.pool.submit(merit_report, prefix, aggregates.student_totals, merit_values,
+                                                  self.n_resamples, self.seed), prefix))
+
+        if changed['production'] and self.files('production'):
+            try:
+                production, _ = read_production(self.files('production'), None, None, None)
+            except Exception as e:
+                print(f'Could not read the HÅP reports: {e}', file=sys.stderr)
+                production = {}
+            if production:
+                outfiles, titles, semesters, haps = outdated_diagrams(production, production_matrix(production), self.manifest)
+                for outfile, title, hap in zip(outfiles, titles, haps):
+                    jobs.append((self.pool.submit(plot_course, outfile, title, semesters, hap), outfile))
+
+        for future, outfile in jobs:
+            try:
+                future.result()
+                print(f'Saved {outfile}', file=sys.stderr)
+            except Exception as e:
+                print(f'Could not make {outfile}: {e}', file=sys.stderr)
+                self.manifest.pop(outfile, None)
+        save_manifest(self.manifest)
+        n_changed = sum(len(files) for files in changed.values())
+        print(f'{n_changed} changed files, {len(jobs)} reports made in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+
+def watch(watcher, interval, debounce, once=False):
+    '''
+    Poll the directory every interval seconds, and rebuild when it has changed and
+    then stayed the same for debounce seconds. With once, rebuild now and return.
+    '''
+    snapshot = watcher.scan()
+    if once:
+        watcher.rebuild(snapshot)
+        return
+    last_change = time.monotonic()
+    while True:
+        if not watcher.up_to_date(snapshot) and time.monotonic() - last_change >= debounce:
+            watcher.rebuild(snapshot)
+        time.sleep(interval)
+        current = watcher.scan()
+        if current != snapshot:
+            snapshot = current
+            last_change = time.monotonic()
+
+
+def setup_arguments_parser(argv):
+    parser = argparse.ArgumentParser(prog='genomstromning watch',
+                                     description='Keep the reports on a directory of exports up to date, '
+                                     'remaking only those affected when files change.')
+    parser.add_argument('directory', help='Directory of student, result, merit and HÅP exports.')
+    parser.add_argument('--interval', type=float, default=2, help='Seconds between looks at the directory. Default: 2')
+    parser.add_argument('--debounce', type=float, default=5, help='Seconds a change must settle before reports are made. Default: 5')
+    parser.add_argument('--once', action='store_true', help='Bring the reports up to date once, and exit.')
+    parser.add_argument('--format', choices=['pdf', 'png'], default='pdf', help='File format of the per-student diagrams. Default: pdf')
+    parser.add_argument('-b', '--bootstrap', type=positive_int, default=1000, help='Number of bootstrap resamples for the merit statistics. Default: 1000')
+    parser.add_argument('--seed', type=int, help='Random seed for the bootstrap.')
+    parser.add_argument('-j', '--jobs', type=int, default=2, help='Number of worker processes parsing files and making reports. Default: 2')
+    add_cache_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = setup_arguments_parser(argv)
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=start_plot_worker) as pool:
+        watcher = Watcher(args.directory, pool, cache_from_arguments(args), args.format, args.bootstrap, args.seed)
+        try:
+            watch(watcher, args.interval, args.debounce, args.once)
+        except KeyboardInterrupt:
+            pass
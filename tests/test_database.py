@@ -0,0 +1,20 @@
+from genomstromning.database import connect, read_results
+
+
+def test_results_are_read_for_the_given_students(tmp_path):
+    filename = tmp_path / 'resultat.db'
+    connection = connect(filename)
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                               [('19900101-0000', 'MM2001', '0001', 7.5, 'G', '2020-10-01'),
+                                ('19900101-0000', 'MM2001', '0002', 3.0, 'G', None),
+                                ('19900101-0000', 'MM2001', '0002', 4.5, 'G', None),   # Replaces the one before
+                                ('19900202-0000', 'MM2001', '0001', 7.5, 'F', '2020-10-01'),
+                                ('19900303-0000', 'MM2001', '0001', 7.5, 'G', '2020-10-01')])
+    assert connection.execute('SELECT COUNT(*) FROM results').fetchone() == (4,)
+    connection.close()
+
+    table = read_results(filename, ['19900101-0000', '19900202-0000', '19900404-0000'])
+    assert table.student_codes == ['19900101-0000', '19900202-0000']
+    assert sorted(table.credits.tolist()) == [4.5, 7.5]
+    assert len(read_results(filename)) == 3
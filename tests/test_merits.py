@@ -0,0 +1,62 @@
+import math
+
+from genomstromning.io import read_nya_merits
+
+
+def write(tmp_path, lines):
+    filename = tmp_path / 'meriter.csv'
+    filename.write_text(''.join(line + '\n' for line in lines), encoding='utf-8')
+    return filename
+
+
+def merits(tmp_path, lines):
+    table = read_nya_merits(write(tmp_path, lines))
+    return {pnr: table[pnr] for pnr in table}
+
+
+def test_plain_line(tmp_path):
+    assert merits(tmp_path, ['19900101-0000;Svensson;Anna;NMDVK;1;A;BI (16.39), BII (19.80), HP (1.01);Antagen;']) == {
+        '19900101-0000': {'BI': 16.39, 'BII': 19.8, 'HP': 1.01}}
+
+
+def test_quoted_separator_in_name(tmp_path):
+    lines = ['"19900101-0000";"Svensson; jr";"Anna";"NMDVK";"1";"A";"BI (16.39), HP (1,01)";"Antagen";',
+             '19910101-0000;Berg;Bo;NMDVK;1;A;BII (12.5);Antagen;']
+    assert merits(tmp_path, lines) == {'19900101-0000': {'BI': 16.39, 'HP': 1.01},
+                                       '19910101-0000': {'BII': 12.5}}
+
+
+def test_unbalanced_parenthesis_in_name(tmp_path):
+    # The next closing parenthesis is far away, after many merits
+    lines = ['19900101-0000;Svensson (jr;Anna;NMDVK;1;A;BI (16.39);Antagen;']
+    lines += [f'19{i % 100:02}0101-{i:04};Berg;Bo;NMDVK;1;A;;Antagen;' for i in range(1, 5000)]
+    lines += ['19000101-0000;Ek;Eva;NMDVK;1;A;;Antagen (sen);']
+    lines += [f'20{i % 10:02}0101-{i:04};Berg;Bo;NMDVK;1;A;HP (1.5);Antagen;' for i in range(5000)]
+    table = read_nya_merits(write(tmp_path, lines))
+    assert len(table) == 10001
+    assert table['19900101-0000'] == {'BI': 16.39}
+    assert table['19000101-0000'] == {}
+    assert table['20010101-0001'] == {'HP': 1.5}
+
+
+def test_merits_outside_the_merit_field_are_ignored(tmp_path):
+    lines = ['19900101-0000;BI (1.0);Anna;NMDVK;1;A;HP (2.0);Note BII (3.0);']
+    assert merits(tmp_path, lines) == {'19900101-0000': {'HP': 2.0}}
+
+
+def test_first_merit_of_a_type_wins(tmp_path):
+    lines = ['19900101-0000;Svensson;Anna;NMDVK;1;A;BI (1.5), BI (2.5), HP (3);Antagen;']
+    assert merits(tmp_path, lines) == {'19900101-0000': {'BI': 1.5, 'HP': 3.0}}
+
+
+def test_unclosed_merit_is_ignored(tmp_path):
+    lines = ['19900101-0000;Svensson;Anna;NMDVK;1;A;BI (16.39, HP (1.0);Antagen (x);']
+    table = read_nya_merits(write(tmp_path, lines))
+    assert table['19900101-0000'] == {'HP': 1.0}
+
+
+def test_line_without_separators(tmp_path):
+    lines = ['x' * 100000, '19900101-0000;Svensson;Anna;NMDVK;1;A;BII (4,5);Antagen;']
+    table = read_nya_merits(write(tmp_path, lines))
+    assert list(table) == ['19900101-0000']
+    assert math.isclose(table['19900101-0000']['BII'], 4.5)
@@ -0,0 +1,20 @@
+from genomstromning.production import merge_reports
+
+
+def report(*rounds):
+    return {'MM2001': {'name': 'Kurs', 'credits': 7.5, 'rounds': list(rounds)}}
+
+
+def test_reports_without_a_period_are_not_one_report():
+    # Both reports fall back on the same period; each counts its own rows
+    period = (0, 0)
+    merged = merge_reports([(period, 0, {}, report((1.0, '10001', '100', 'okänt'))),
+                            (period, 1, {}, report((2.0, '10001', '100', 'okänt')))])
+    assert merged['MM2001']['rounds'] == [(2.0, '10001', '100', 'okänt')]
+
+
+def test_rows_of_a_round_add_up_within_a_report():
+    merged = merge_reports([((2020, 2021), 0, {}, report((1.0, '10001', '100', '2020-08-31'),
+                                                         (0.5, '10001', '100', '2020-08-31'))),
+                            ((2022, 2023), 1, {}, report((0.25, '10001', '100', '2020-08-31')))])
+    assert merged['MM2001']['rounds'] == [(1.75, '10001', '100', '2020-08-31')]
@@ -0,0 +1,28 @@
+from datetime import date
+
+from genomstromning.io import read_course_results
+
+
+HEADER = ('"Personnummer (Student)";"Efternamn (Student)";"Förnamn (Student)";"Kod (Kurs)";"Benämning (Kurs)";'
+          '"Omfattning (Kurs)";"Kurstillfälle (Kurs)";"Kod (Modul)";"Benämning (Modul)";"Omfattning (Modul)";'
+          '"Betyg (Resultat)";"Ex. datum (Resultat)"')
+
+
+def result_line(pnr, module, grade, exam_date):
+    return f'"{pnr}";"E";"F";"MM2001";"Kurs";"7,5";"2020-MM2001";"{module}";"Modul";"7,5";"{grade}";"{exam_date}"'
+
+
+def test_every_student_in_the_export_is_a_key(tmp_path):
+    lines = ['"Utdata";"Resultat"', '', HEADER,
+             result_line('19900101-0000', '0001', 'G', '2020-10-01'),
+             result_line('19900202-0000', '0001', 'F', '2020-10-01'),
+             result_line('19900303-0000', '0001', 'G', '2021-10-01')]
+    filename = tmp_path / 'resultat.csv'
+    filename.write_text('\n'.join(lines) + '\n')
+    results = read_course_results([filename], date(2021, 1, 1))
+    assert len(results) == 3
+    assert list(results) == ['19900101-0000', '19900202-0000', '19900303-0000']
+    assert results['19900101-0000'] == {'MM2001': {'0001': 7.5}}
+    assert results['19900202-0000'] == {}
+    assert results['19900303-0000'] == {}
+    assert '19900404-0000' not in results
@@ -0,0 +1,67 @@
+import pytest
+
+from genomstromning.io import iter_course_results, read_programstudents, split_preamble, starts_with_personnummer
+from genomstromning.production import read_production
+
+openpyxl = pytest.importorskip('openpyxl')
+
+
+RESULT_HEADER = ['Personnummer (Student)', 'Efternamn (Student)', 'Förnamn (Student)', 'Kod (Kurs)', 'Benämning (Kurs)',
+                 'Omfattning (Kurs)', 'Kurstillfälle (Kurs)', 'Kod (Modul)', 'Benämning (Modul)', 'Omfattning (Modul)',
+                 'Betyg (Resultat)', 'Ex. datum (Resultat)']
+HAP_HEADER = ['Kurskod', 'Kurs', 'Omfattning', 'Enhet', 'Kod', 'Studietakt', 'Finansieringsform', 'Undervisningsform',
+              'Studieort', 'Startdatum', 'Kvinnor', 'Män', 'Total']
+
+
+def workbook(path, *sheets):
+    book = openpyxl.Workbook()
+    book.remove(book.active)
+    for rows in sheets:
+        sheet = book.create_sheet()
+        for row in rows:
+            sheet.append(row)
+    book.save(path)
+    return path
+
+
+def result_row(i):
+    return [f'1990{i:04}-0000', 'Efternamn', 'Förnamn', 'MM2001', 'Kurs', '30', '2020-MM2001', '0001', 'Modul', '7,5', 'G', '2020-10-01']
+
+
+def test_split_preamble():
+    rows = [['"Utdata"', '"Resultat"'], [], ['"Personnummer (Student)"', '"Efternamn"'], ['"19900101-0000"'] * 5]
+    preamble, data = split_preamble(iter(rows), 'Personnummer', starts_with_personnummer)
+    assert preamble == rows[:2]
+    assert list(data) == rows[3:]
+
+    preamble, data = split_preamble(iter(rows[3:]), 'Personnummer', starts_with_personnummer)
+    assert preamble == []
+    assert list(data) == rows[3:]
+
+
+def test_results_on_sheets_without_preamble(tmp_path):
+    first = [['Utdata', 'Resultat'], ['Visa moduler', 'Ja'], [], RESULT_HEADER] + [result_row(i) for i in range(10)]
+    second = [result_row(i) for i in range(10, 20)]
+    third = [RESULT_HEADER] + [result_row(i) for i in range(20, 30)]
+    rows = list(iter_course_results([workbook(tmp_path / 'resultat.xlsx', first, second, third)]))
+    assert [row[0] for row in rows] == [f'1990{i:04}-0000' for i in range(30)]
+
+
+def test_students_on_sheets_without_preamble(tmp_path):
+    header = ['Personnummer (Student)', 'Förnamn (Student)', 'Efternamn (Student)', 'Kod (Kurspaketering)']
+    student = lambda i: [f'1990{i:04}-0000', 'Förnamn', 'Efternamn', 'NMDVK', 'Kandidatprogram']
+    first = [['Utbildningskod', 'NMDVK Kandidatprogram'], [], header] + [student(i) for i in range(5)]
+    second = [student(i) for i in range(5, 10)]
+    program, students = read_programstudents(workbook(tmp_path / 'studenter.xlsx', first, second))
+    assert program == 'NMDVK'
+    assert len(students) == 10
+
+
+def test_production_on_sheets_without_preamble(tmp_path):
+    round_row = lambda i: ['MM2001', 'Kurs', '7,5', 'HP', f'{10000 + i}', '100', 'Anslag', 'NML', 'Stockholm',
+                           '2020-08-31', '1', '1', '2,5']
+    first = [['Utdata', 'Helårsprestationer'], ['Period', '2020 - 2021'], HAP_HEADER] + [round_row(i) for i in range(5)]
+    second = [round_row(i) for i in range(5, 10)]
+    production, metadata = read_production(workbook(tmp_path / 'hap.xlsx', first, second))
+    assert len(production['MM2001']['rounds']) == 10
+    assert metadata == {'Utdata': 'Helårsprestationer', 'Period': '2020 - 2021'}
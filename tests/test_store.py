@@ -0,0 +1,29 @@
+from datetime import date
+
+from genomstromning.store import add_to_store, load_store
+from genomstromning.table import ResultTable
+
+
+def rows(table):
+    return sorted((table.student_codes[s], table.course_codes[c], table.module_codes[m], float(p), str(d))
+                  for s, c, m, p, d in zip(table.student, table.course, table.module, table.credits, table.dates))
+
+
+def test_only_new_and_changed_rows_are_stored(tmp_path):
+    first = ResultTable.from_rows([('19900101-0000', 'MM2001', '0001', 7.5, date(2020, 10, 1)),
+                                   ('19900101-0000', 'MM2001', '0002', 7.5, None),
+                                   ('19900202-0000', 'MM2001', '0001', 7.5, date(2020, 10, 1))])
+    assert add_to_store(tmp_path, first, 'first.csv', 'a') == (3, 0, 0)
+    assert add_to_store(tmp_path, first, 'first.csv', 'a') == (0, 0, 3)
+
+    # Different code tables: the same results, in another order, one changed and one new
+    second = ResultTable.from_rows([('19900202-0000', 'MM2001', '0001', 7.5, date(2020, 10, 1)),
+                                    ('19900101-0000', 'MM2001', '0002', 6.0, None),
+                                    ('19900303-0000', 'MM2002', '0001', 3.0, date(2021, 1, 15)),
+                                    ('19900101-0000', 'MM2001', '0001', 7.5, date(2020, 10, 1))])
+    assert add_to_store(tmp_path, second, 'second.csv', 'b') == (1, 1, 2)
+    assert rows(load_store(tmp_path)) == rows(second)
+
+    third = ResultTable.from_rows([('19900101-0000', 'MM2001', '0002', 7.5, None)])
+    assert add_to_store(tmp_path, third, 'third.csv', 'c') == (0, 1, 0)
+    assert add_to_store(tmp_path, first, 'again.csv', 'd') == (0, 0, 3)
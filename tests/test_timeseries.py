@@ -0,0 +1,17 @@
+import argparse
+from datetime import date
+
+import pytest
+
+from genomstromning.timeseries import cutoff_dates_argument, parse_cutoff_dates
+
+
+def test_date_ranges():
+    assert parse_cutoff_dates('2020-01-01:2020-01-15:week') == [date(2020, 1, 1), date(2020, 1, 8), date(2020, 1, 15)]
+    assert parse_cutoff_dates('2020-01-01:2020-01-03:1') == [date(2020, 1, 1), date(2020, 1, 2), date(2020, 1, 3)]
+
+
+@pytest.mark.parametrize('spec', ['2020-01-01:2020-02-01:0', '2020-01-01:2020-02-01:-7', '2020-01-01:2020-02-01:x'])
+def test_bad_steps_are_argument_errors(spec):
+    with pytest.raises(argparse.ArgumentTypeError):
+        cutoff_dates_argument(spec)